@@ -0,0 +1,171 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import collections
+import logging
+import threading
+
+from dspam import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+in_flight_gauge = metrics.Gauge(
+    'dspam_admission_in_flight',
+    'DSPAM transactions that run with a turn of admission control')
+queue_depth_gauge = metrics.Gauge(
+    'dspam_admission_queue_depth',
+    'Messages waiting for their turn to be classified by DSPAM')
+wait_histogram = metrics.Histogram(
+    'dspam_admission_wait_seconds',
+    'Time messages waited for their turn to be classified by DSPAM')
+timeouts_counter = metrics.Counter(
+    'dspam_admission_timeouts_total',
+    'Messages that waited too long for their turn to be classified')
+
+
+class AdmissionControl(object):
+    """
+    Limit the number of DSPAM transactions that run at once.
+
+    When a burst of messages arrives, every milter thread would otherwise
+    call DSPAM at the same time, and all messages slow down together. With
+    admission control, at most max_concurrent DSPAM transactions run at
+    once, and the other messages wait their turn in a first-in, first-out
+    queue. A message that is classified in several parallel transactions
+    takes a turn for each of them, at most max_concurrent. Messages that
+    waited for max_wait seconds are not classified: they are accepted when
+    fail_open is set, and temporarily rejected otherwise.
+
+    """
+
+    # Default configuration
+    max_concurrent = 0
+    max_wait = 10.0
+    fail_open = False
+
+    def __init__(self, max_concurrent=None, max_wait=None, fail_open=None):
+        """
+        Create a new admission control.
+
+        Args:
+        max_concurrent -- The number of DSPAM transactions to run at once.
+        max_wait       -- Seconds a message may wait for its turn.
+        fail_open      -- Whether to accept messages that waited too long.
+
+        """
+        if max_concurrent is not None:
+            self.max_concurrent = max_concurrent
+        if max_wait is not None:
+            self.max_wait = max_wait
+        if fail_open is not None:
+            self.fail_open = fail_open
+        if self.max_concurrent < 1:
+            raise ValueError('Admission control needs max_concurrent >= 1')
+
+        self._lock = threading.Lock()
+        # Waiting threads, in order of arrival. Each waiter is a list of an
+        #   Event, a flag that tells whether it was admitted, and the number
+        #   of turns it needs.
+        self._waiters = collections.deque()
+        self._in_flight = 0
+        self._stats = {
+            'admitted': 0,
+            'queued': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def acquire(self, timeout=None, turns=1):
+        """
+        Wait for the turns to classify a message.
+
+        Returns True when the message was admitted, and False when it was
+        not admitted within the timeout. Each admitted message must be
+        followed by a call to release() with the same number of turns.
+
+        Args:
+        timeout -- Seconds to wait, defaults to max_wait. A timeout of 0
+                   only admits a message when that does not need a wait.
+        turns   -- The number of DSPAM transactions of the message.
+
+        """
+        if timeout is None:
+            timeout = self.max_wait
+        turns = min(turns, self.max_concurrent)
+        with self._lock:
+            if (self._in_flight + turns <= self.max_concurrent and
+                    not self._waiters):
+                self._in_flight += turns
+                self._stats['admitted'] += 1
+                in_flight_gauge.inc(turns)
+                wait_histogram.observe(0.0)
+                return True
+            if timeout <= 0:
+                return False
+            waiter = [threading.Event(), False, turns]
+            self._waiters.append(waiter)
+            self._stats['queued'] += 1
+            queue_depth_gauge.inc()
+
+        start = utils.monotonic()
+        waiter[0].wait(timeout)
+        elapsed = utils.monotonic() - start
+        wait_histogram.observe(elapsed)
+        with self._lock:
+            self._stats['wait_time_total'] += elapsed
+            if elapsed > self._stats['wait_time_max']:
+                self._stats['wait_time_max'] = elapsed
+            if waiter[1]:
+                return True
+            # Timed out, but release() might have been just too late
+            self._waiters.remove(waiter)
+            self._stats['timeouts'] += 1
+            # Waiters that need fewer turns may fit now
+            self._admit_waiters()
+        queue_depth_gauge.inc(-1)
+        timeouts_counter.inc()
+        return False
+
+    def release(self, turns=1):
+        """
+        End the turns of a message, and admit the next waiting messages.
+
+        Args:
+        turns -- The number of turns passed to acquire().
+
+        """
+        turns = min(turns, self.max_concurrent)
+        with self._lock:
+            self._in_flight -= turns
+            in_flight_gauge.inc(-turns)
+            self._admit_waiters()
+
+    def _admit_waiters(self):
+        """
+        Admit waiting messages in order of arrival, as long as their turns
+        are free. Must be called with the lock held.
+
+        """
+        while self._waiters and (self._in_flight + self._waiters[0][2] <=
+                                 self.max_concurrent):
+            waiter = self._waiters.popleft()
+            self._in_flight += waiter[2]
+            in_flight_gauge.inc(waiter[2])
+            waiter[1] = True
+            waiter[0].set()
+            self._stats['admitted'] += 1
+            queue_depth_gauge.inc(-1)
+
+    def stats(self):
+        """
+        Return a dictionary with admission statistics.
+
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = self._in_flight
+            stats['waiting'] = len(self._waiters)
+        return stats
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from .admission import AdmissionControl
+
+
+def test_admits_up_to_limit():
+    admission = AdmissionControl(max_concurrent=2, max_wait=0.01)
+    assert admission.acquire()
+    assert admission.acquire()
+    assert not admission.acquire()
+    admission.release()
+    assert admission.acquire()
+    stats = admission.stats()
+    assert stats['admitted'] == 3
+    assert stats['timeouts'] == 1
+    assert stats['in_flight'] == 2
+    assert stats['waiting'] == 0
+
+
+def test_no_wait():
+    admission = AdmissionControl(max_concurrent=1, max_wait=10)
+    assert admission.acquire(0)
+    start = time.time()
+    assert not admission.acquire(0)
+    assert time.time() - start < 1
+    assert admission.stats()['queued'] == 0
+
+
+def test_waiters_are_admitted_in_order():
+    admission = AdmissionControl(max_concurrent=1, max_wait=10)
+    assert admission.acquire()
+    order = []
+
+    def wait(n):
+        assert admission.acquire()
+        order.append(n)
+        admission.release()
+
+    threads = []
+    for n in range(5):
+        thread = threading.Thread(target=wait, args=(n,))
+        thread.start()
+        threads.append(thread)
+        while admission.stats()['waiting'] <= n:
+            time.sleep(0.001)
+    # A newcomer does not get ahead of the queue
+    assert not admission.acquire(0)
+    admission.release()
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2, 3, 4]
+    stats = admission.stats()
+    assert stats['in_flight'] == 0
+    assert stats['queued'] == 5
+    assert stats['wait_time_max'] > 0
+
+
+def test_turns():
+    admission = AdmissionControl(max_concurrent=3, max_wait=10)
+    assert admission.acquire(turns=2)
+    assert not admission.acquire(0, turns=2)
+    assert admission.acquire(0)
+    assert admission.stats()['in_flight'] == 3
+    admission.release(2)
+    admission.release()
+    # More turns than the limit take all of them
+    assert admission.acquire(0, turns=5)
+    assert admission.stats()['in_flight'] == 3
+    admission.release(5)
+    assert admission.stats()['in_flight'] == 0
+
+
+def test_waiter_needs_all_its_turns():
+    admission = AdmissionControl(max_concurrent=2, max_wait=10)
+    assert admission.acquire()
+    assert admission.acquire()
+    admitted = []
+
+    def wait():
+        assert admission.acquire(turns=2)
+        admitted.append(True)
+        admission.release(2)
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    while not admission.stats()['waiting']:
+        time.sleep(0.001)
+    admission.release()
+    time.sleep(0.01)
+    assert not admitted
+    assert admission.stats()['waiting'] == 1
+    admission.release()
+    thread.join()
+    assert admitted
+    assert admission.stats()['in_flight'] == 0
+
+
+def test_invalid_limit():
+    with pytest.raises(ValueError):
+        AdmissionControl(max_concurrent=0)
@@ -0,0 +1,260 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+"""
+An asyncio implementation of the DSPAM client.
+
+This module requires Python 3.5 or newer.
+
+"""
+
+import asyncio
+import functools
+import logging
+import socket
+
+from dspam.client import (
+    DataEncoder, DataResponseParser, DspamClientBase, DspamClientError,
+    _buffer_types, _bytes, _native)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDspamClient(DspamClientBase):
+    """
+    A DSPAM client for use with asyncio.
+
+    This client offers the same operations as DspamClient, but all methods
+    that talk to the server are coroutines. A single event loop can drive
+    many clients concurrently, each with its own connection to the server.
+
+    Command building and response parsing are shared with DspamClient, so
+    both clients behave the same.
+
+    """
+
+    # Maximum length of a response line
+    line_limit = 2 ** 20
+
+    def __init__(self, socket=None, dlmtp_ident=None, dlmtp_pass=None):
+        super(AsyncDspamClient, self).__init__(socket, dlmtp_ident, dlmtp_pass)
+        self._writer = None
+
+    async def _read(self):
+        """
+        Read a single response line from the server.
+
+        """
+        line = _native(await self._reader.readline()).rstrip('\r\n')
+        logger.debug('Server sent: ' + line)
+        return line
+
+    async def _read_raw(self):
+        """
+        Read a single line of message data from the server, as bytes.
+
+        """
+        line = (await self._reader.readline()).rstrip(b'\r\n')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Server sent: ' + _native(line))
+        return line
+
+    async def _command(self, line, check):
+        """
+        Send a command to the server, and check the server response.
+
+        When the server supports command pipelining, the command is queued
+        instead, and sent together with the next commands by _flush().
+
+        """
+        if self.pipelining:
+            self._pipeline.append((line, check))
+        else:
+            logger.debug('Client sent: ' + line.rstrip())
+            self._writer.write(_bytes(line))
+            await self._writer.drain()
+            check(await self._read())
+
+    async def _flush(self):
+        """
+        Send all queued commands in a single write, and check the responses.
+
+        """
+        if not self._pipeline:
+            return
+        pipeline = self._pipeline
+        self._pipeline = []
+
+        for line, check in pipeline:
+            logger.debug('Client sent (pipelined): ' + line.rstrip())
+        self._writer.writelines([_bytes(line) for line, check in pipeline])
+        await self._writer.drain()
+
+        error = None
+        for line, check in pipeline:
+            resp = await self._read()
+            try:
+                check(resp)
+            except DspamClientError as err:
+                if error is None:
+                    error = err
+        if error is not None:
+            if self._in_data:
+                logger.warning(
+                    'Closing connection to DSPAM server after pipelining '
+                    'error in DATA phase')
+                self.close()
+            raise error
+
+    async def connect(self):
+        """
+        Connect to TCP or domain socket, and process the server LMTP greeting.
+
+        """
+        (family, address, description) = self._parse_socket()
+        try:
+            if family == socket.AF_UNIX:
+                self._reader, self._writer = await asyncio.open_unix_connection(
+                    address, limit=self.line_limit)
+            else:
+                self._reader, self._writer = await asyncio.open_connection(
+                    address[0], address[1], limit=self.line_limit)
+        except OSError as err:
+            raise DspamClientError(
+                'Failed to connect to DSPAM server at {}: {}'.format(
+                    description, err))
+        logger.debug('Connected to DSPAM server at {}'.format(description))
+        self._check_greeting(await self._read())
+
+    async def lhlo(self):
+        """
+        Send LMTP LHLO greeting, and process the server response.
+
+        See DspamClient.lhlo() for details.
+
+        """
+        line = self._lhlo_command()
+        logger.debug('Client sent: ' + line.rstrip())
+        self._writer.write(_bytes(line))
+        await self._writer.drain()
+        finished = False
+        while not finished:
+            finished = self._check_lhlo(await self._read())
+
+    async def mailfrom(self, sender=None, client_args=None):
+        """
+        Send LMTP MAIL FROM command, and process the server response.
+
+        See DspamClient.mailfrom() for details.
+
+        """
+        await self._command(self._mailfrom_command(sender, client_args),
+                            self._check_mailfrom)
+
+    async def rcptto(self, recipients):
+        """
+        Send LMTP RCPT TO command, and process the server response.
+
+        See DspamClient.rcptto() for details.
+
+        """
+        for rcpt in recipients:
+            await self._command('RCPT TO:<{}>\r\n'.format(rcpt),
+                                functools.partial(self._check_rcptto, rcpt))
+
+    async def data(self, message):
+        """
+        Send LMTP DATA command and process the server response.
+
+        See DspamClient.data() for details.
+
+        """
+        await self._command('DATA\r\n', self._check_data)
+        await self._flush()
+        self._in_data = False
+
+        encoder = DataEncoder()
+        if isinstance(message, _buffer_types):
+            self._writer.writelines(encoder.encode(message) + encoder.finish())
+        else:
+            for chunk in message:
+                self._writer.writelines(encoder.encode(chunk))
+                await self._writer.drain()
+            self._writer.writelines(encoder.finish())
+        await self._writer.drain()
+
+        parser = DataResponseParser(self._recipients)
+        finished = False
+        while not finished:
+            if parser.mode == parser.STDOUT:
+                finished = parser.feed(await self._read_raw())
+            else:
+                finished = parser.feed(await self._read())
+        self.results.update(parser.results)
+
+    async def rset(self):
+        """
+        Send LMTP RSET command and process the server response.
+
+        """
+        self._recipients = []
+        self.results = {}
+        await self._command('RSET\r\n', self._check_rset)
+
+    async def quit(self):
+        """
+        Send LMTP QUIT command, read the server response and disconnect.
+
+        """
+        self._pipeline = []
+        self._writer.write(b'QUIT\r\n')
+        await self._writer.drain()
+        self._check_quit(await self._read())
+        self.close()
+
+    def close(self):
+        """
+        Disconnect from the server without sending QUIT.
+
+        """
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        self._reader = None
+        self._recipients = []
+        self._pipeline = []
+        self._in_data = False
+        self.results = {}
+
+    async def _transaction(self, message, user, client_args):
+        if self._writer is None:
+            await self.connect()
+            await self.lhlo()
+        else:
+            await self.rset()
+
+        if not self.dlmtp:
+            raise DspamClientError('DLMTP mode not available')
+
+        await self.mailfrom(client_args=client_args)
+        await self.rcptto((user,))
+        await self.data(message)
+        return self._summary_result(user)
+
+    async def process(self, message, user):
+        """
+        Process a message.
+
+        """
+        return await self._transaction(
+            message, user, '--process --deliver=summary')
+
+    async def classify(self, message, user):
+        """
+        Classify a message.
+
+        """
+        return await self._transaction(
+            message, user, '--classify --deliver=summary')
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from .aioclient import AsyncDspamClient
+from .client import DspamClientError
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_connect_failed(tmpdir):
+    c = AsyncDspamClient('unix:' + str(tmpdir.join('dspam.sock')))
+    with pytest.raises(DspamClientError):
+        run(c.connect())
+
+
+@pytest.mark.parametrize('capabilities,round_trips', [
+    (('DSPAMPROCESSMODE',), 5),
+    (('PIPELINING', 'DSPAMPROCESSMODE'), 2),
+])
+def test_process(dspam_server, capabilities, round_trips):
+    dspam_server.capabilities = list(capabilities)
+    dspam_server.spam_users.add('bar')
+
+    async def session():
+        c = AsyncDspamClient(dspam_server.socket, 'foo', 'secret')
+        results = await c.process('Subject: test\r\n\r\n.test\r\n', 'bar')
+        assert results['class'] == 'Spam'
+        before = dspam_server.round_trips
+        results = await c.classify('Subject: test\r\n\r\ntest\r\n', 'qux')
+        assert dspam_server.round_trips - before == round_trips
+        assert results['class'] == 'Innocent'
+        await c.quit()
+    run(session())
+    assert dspam_server.messages[0] == b'Subject: test\r\n\r\n.test'
+
+
+def test_concurrent_clients(dspam_server):
+    dspam_server.spam_users.add('user3')
+
+    async def classify(user):
+        c = AsyncDspamClient(dspam_server.socket, 'foo', 'secret')
+        results = await c.classify('Subject: test\r\n\r\ntest\r\n', user)
+        await c.quit()
+        return results
+
+    async def main():
+        return await asyncio.gather(
+            *[classify('user{}'.format(i)) for i in range(20)])
+    results = run(main())
+    assert [r['user'] for r in results] == ['user{}'.format(i) for i in range(20)]
+    assert [r['class'] for r in results].count('Spam') == 1
+    assert dspam_server.connections == 20
+
+
+def test_rcpt_error(dspam_server):
+    async def session():
+        c = AsyncDspamClient(dspam_server.socket, 'foo', 'secret')
+        await c.connect()
+        await c.lhlo()
+        await c.mailfrom(client_args='--classify')
+        with pytest.raises(DspamClientError):
+            await c.data('Subject: test\r\n\r\ntest\r\n')
+        await c.quit()
+    run(session())
+
+
+def test_data_stdout(dspam_server):
+    dspam_server.stdout = True
+    message = b'Subject: test\r\n\r\n.\r\n\xff\r\n'
+
+    async def session():
+        c = AsyncDspamClient(dspam_server.socket, 'foo', 'secret')
+        await c.connect()
+        await c.lhlo()
+        await c.mailfrom(client_args='--classify --deliver=stdout')
+        await c.rcptto(('bar',))
+        await c.data(message)
+        assert c.results == {
+            'bar': {'result': 'INNOCENT', 'message': message},
+        }
+        await c.quit()
+    run(session())
@@ -0,0 +1,471 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import bisect
+import collections
+import hashlib
+import logging
+import random
+import re
+import socket
+import threading
+
+from dspam import metrics, utils
+from dspam.client import DeadlineExceededError, DspamClientError, _bytes
+from dspam.pool import PoolTimeoutError
+
+logger = logging.getLogger(__name__)
+
+outstanding_gauge = metrics.Gauge(
+    'dspam_backend_outstanding',
+    'DSPAM connections checked out, by DSPAM server', labels=('backend',))
+failures_counter = metrics.Counter(
+    'dspam_backend_failures_total',
+    'Failed connections and transactions, by DSPAM server',
+    labels=('backend',))
+ejections_counter = metrics.Counter(
+    'dspam_backend_ejections_total',
+    'Times a DSPAM server was taken out of use after failures',
+    labels=('backend',))
+
+
+def split_addresses(value):
+    """
+    Split a list of DSPAM socket specifications, separated by whitespace or
+    commas.
+
+    Args:
+    value -- The list, as a string.
+
+    """
+    return [address for address in re.split(r'[\s,]+', value) if address]
+
+
+class HashRing(object):
+    """
+    A consistent-hash ring, that maps keys to nodes.
+
+    Each node is placed on the ring at several points, its virtual nodes, and
+    a key belongs to the first point after the hash of the key. This spreads
+    the keys evenly over the nodes, and when a node is added or removed, only
+    the keys of that node move to another node.
+
+    """
+
+    def __init__(self, nodes, virtual_nodes=100):
+        """
+        Create a new ring.
+
+        Args:
+        nodes         -- The names of the nodes.
+        virtual_nodes -- The number of points on the ring for each node.
+
+        """
+        self.nodes = list(nodes)
+        points = sorted(
+            (self._hash('{}#{}'.format(node, replica)), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(virtual_nodes))
+        self._hashes = [point[0] for point in points]
+        self._indexes = [point[1] for point in points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(_bytes(key)).hexdigest()[:16], 16)
+
+    def lookup(self, key):
+        """
+        Return all nodes, in the order they are responsible for a key.
+
+        The node of the key comes first, followed by the other nodes in the
+        order they appear on the ring after it, to fail over to.
+
+        Args:
+        key -- The key to look up.
+
+        """
+        if not self._hashes:
+            return []
+        start = bisect.bisect(self._hashes, self._hash(key))
+        seen = set()
+        nodes = []
+        for offset in range(len(self._indexes)):
+            index = self._indexes[(start + offset) % len(self._indexes)]
+            if index not in seen:
+                seen.add(index)
+                nodes.append(self.nodes[index])
+                if len(nodes) == len(self.nodes):
+                    break
+        return nodes
+
+
+class Backend(object):
+    """
+    A DSPAM server, with its own connection pool and health state.
+
+    """
+
+    def __init__(self, address, pool):
+        """
+        Create a new backend.
+
+        Args:
+        address -- The socket specification of the DSPAM server.
+        pool    -- The DspamClientPool with connections to the server.
+
+        """
+        self.address = address
+        self.pool = pool
+        # Connections checked out from the pool
+        self.outstanding = 0
+        # Moving average of the seconds the server takes to respond
+        self.latency = None
+        # Failures since the last success
+        self.failures = 0
+        # When the backend may be used again, as a utils.monotonic()
+        #   timestamp, or None when it is in use
+        self.ejected_until = None
+        self.ejections = 0
+
+
+class BackendPool(object):
+    """
+    Spread DSPAM transactions over several DSPAM servers.
+
+    Each server has its own DspamClientPool. get() picks a server using the
+    configured strategy:
+    * round-robin: each server in turn.
+    * least-outstanding: the server with the fewest connections in use.
+    * latency: servers at random, weighted by how fast they responded to
+      recent messages.
+    * consistent-hash: the server of the DSPAM user on a consistent-hash
+      ring, so the data of a user stays on one server. Transactions without
+      a user are spread round-robin.
+    When connecting to a server fails, get() tries the next one, until the
+    timeout runs out.
+
+    The health of servers is tracked passively: a server that failed
+    max_failures times in a row is ejected, and is not used for
+    ejection_time seconds. After that, it gets another chance: one success
+    re-admits it, and one failure ejects it again. When all servers are
+    ejected, they are all tried anyway, so messages are not refused because
+    of old failures.
+
+    The pool has the interface of a DspamClientPool, so it can be used in its
+    place. With consistent-hash, the recipients of a message that belong to
+    different servers need separate transactions, see partition().
+
+    """
+
+    # Default configuration
+    strategy = 'round-robin'
+    max_failures = 3
+    ejection_time = 30.0
+    virtual_nodes = 100
+
+    STRATEGIES = ('round-robin', 'least-outstanding', 'latency',
+                  'consistent-hash')
+    # Weight of the newest response time in the moving average
+    LATENCY_DECAY = 0.3
+
+    def __init__(self, addresses, pool_factory, strategy=None,
+                 max_failures=None, ejection_time=None, virtual_nodes=None):
+        """
+        Create a new backend pool.
+
+        Args:
+        addresses     -- The socket specifications of the DSPAM servers.
+        pool_factory  -- Callable that creates the DspamClientPool for a
+                         server, it gets the socket specification as its
+                         argument.
+        strategy      -- How to pick a server, one of STRATEGIES.
+        max_failures  -- Failures in a row after which a server is ejected.
+        ejection_time -- Seconds an ejected server is not used.
+        virtual_nodes -- The number of points on the consistent-hash ring for
+                         each server.
+
+        """
+        if strategy is not None:
+            self.strategy = strategy
+        if max_failures is not None:
+            self.max_failures = max_failures
+        if ejection_time is not None:
+            self.ejection_time = ejection_time
+        if virtual_nodes is not None:
+            self.virtual_nodes = virtual_nodes
+        if self.strategy not in self.STRATEGIES:
+            raise ValueError('Unknown backend strategy: ' + self.strategy)
+        if not addresses:
+            raise ValueError('A backend pool needs at least one address')
+        if self.virtual_nodes < 1:
+            raise ValueError('A backend pool needs virtual_nodes >= 1')
+
+        self.backends = [Backend(address, pool_factory(address))
+                         for address in addresses]
+        self.checkout_timeout = self.backends[0].pool.checkout_timeout
+        self._ring = HashRing(addresses, self.virtual_nodes)
+        self._by_address = dict((backend.address, backend)
+                                for backend in self.backends)
+        self._lock = threading.Lock()
+        self._next = 0
+        # Maps the id of checked out clients to their backend
+        self._checkouts = {}
+
+    def _order(self, key=None):
+        """
+        Return the backends in the order they should be tried.
+
+        Args:
+        key -- The DSPAM user to pick a backend for.
+
+        """
+        now = utils.monotonic()
+        with self._lock:
+            available = [backend for backend in self.backends
+                         if backend.ejected_until is None or
+                         backend.ejected_until <= now]
+            if not available:
+                available = sorted(self.backends,
+                                   key=lambda backend: backend.ejected_until)
+            if self.strategy == 'consistent-hash' and key is not None:
+                return [self._by_address[address]
+                        for address in self._ring.lookup(key)
+                        if self._by_address[address] in available]
+            # Rotate, so ties are spread over the backends
+            start = self._next % len(available)
+            self._next += 1
+            available = available[start:] + available[:start]
+
+            if self.strategy == 'least-outstanding':
+                available.sort(key=lambda backend: backend.outstanding)
+            elif self.strategy == 'latency':
+                known = [backend.latency for backend in available
+                         if backend.latency is not None]
+                # Backends without a measurement yet are assumed to be fast,
+                #   so they get traffic to measure
+                default = min(known) if known else 1.0
+
+                def latency(backend):
+                    if backend.latency is None:
+                        return max(default, 0.001)
+                    return max(backend.latency, 0.001)
+
+                weights = [1 / latency(backend) for backend in available]
+                choice = random.random() * sum(weights)
+                for index, weight in enumerate(weights):
+                    choice -= weight
+                    if choice < 0:
+                        break
+                # The others are the fallbacks, fastest first
+                first = available.pop(index)
+                available.sort(key=latency)
+                available.insert(0, first)
+        return available
+
+    def _failure(self, backend):
+        """
+        Count a failure of a backend, and eject it after too many.
+
+        """
+        failures_counter.inc(labels=(backend.address,))
+        with self._lock:
+            backend.failures += 1
+            if backend.failures < self.max_failures:
+                return
+            backend.ejected_until = utils.monotonic() + self.ejection_time
+            backend.ejections += 1
+        ejections_counter.inc(labels=(backend.address,))
+        logger.warning(
+            'DSPAM server {} failed {} times, not using it for {} '
+            'seconds'.format(backend.address, backend.failures,
+                             self.ejection_time))
+
+    def _success(self, backend, response_time):
+        """
+        Count a success of a backend, and re-admit it when it was ejected.
+
+        """
+        with self._lock:
+            backend.failures = 0
+            readmitted = backend.ejected_until is not None
+            backend.ejected_until = None
+            if response_time is not None:
+                if backend.latency is None:
+                    backend.latency = response_time
+                else:
+                    backend.latency += self.LATENCY_DECAY * (
+                        response_time - backend.latency)
+        if readmitted:
+            logger.info('DSPAM server {} is available again'.format(
+                backend.address))
+
+    def fill(self):
+        """
+        Pre-warm the pools of all backends.
+
+        Raises the last error when no pool could be filled.
+
+        """
+        error = None
+        filled = False
+        for backend in self.backends:
+            try:
+                backend.pool.fill()
+            except (DspamClientError, socket.error) as err:
+                logger.warning(
+                    'Failed to pre-warm DSPAM connection pool for {}: '
+                    '{}'.format(backend.address, err))
+                self._failure(backend)
+                error = err
+            else:
+                filled = True
+        if not filled:
+            raise error
+
+    def partition(self, users):
+        """
+        Group DSPAM users by the backend their transaction goes to.
+
+        With consistent-hash, each user belongs to the first available
+        backend for it on the ring. With the other strategies, all users
+        form a single group. There is always at least one group.
+
+        Args:
+        users -- The DSPAM users.
+
+        """
+        if self.strategy != 'consistent-hash' or not users:
+            return [list(users)]
+        groups = collections.OrderedDict()
+        for user in users:
+            backend = self._order(user)[0]
+            groups.setdefault(backend.address, []).append(user)
+        return list(groups.values())
+
+    def get(self, timeout=None, key=None, deadline=None):
+        """
+        Check out a connected client from one of the backends.
+
+        Raises a DspamClientError when no backend provided a client within
+        the timeout.
+
+        With a deadline, the time left is shared by the backends that are
+        still to be tried, so a backend that hangs while connecting leaves
+        time for the others.
+
+        Args:
+        timeout  -- Seconds to wait for a client, defaults to checkout_timeout.
+        key      -- The DSPAM user the client is for, which picks the backend
+                    with consistent-hash.
+        deadline -- When the client must be checked out, as a
+                    utils.monotonic() timestamp.
+
+        """
+        if timeout is None:
+            timeout = self.checkout_timeout
+        wait_until = utils.monotonic() + timeout
+        if deadline is not None:
+            wait_until = min(wait_until, deadline)
+        backends = self._order(key)
+        error = None
+        for index, backend in enumerate(backends):
+            now = utils.monotonic()
+            remaining = wait_until - now
+            if remaining <= 0 and error is not None:
+                break
+            share = None
+            if deadline is not None:
+                share = now + max(deadline - now, 0) / (len(backends) - index)
+            try:
+                client = backend.pool.get(max(remaining, 0), deadline=share)
+            except (PoolTimeoutError, DeadlineExceededError) as err:
+                # The backend is busy or out of time, not broken
+                error = err
+                continue
+            except (DspamClientError, socket.error) as err:
+                logger.warning('Failed to connect to DSPAM server {}: '
+                               '{}'.format(backend.address, err))
+                self._failure(backend)
+                error = err
+                continue
+            client.response_time = None
+            with self._lock:
+                backend.outstanding += 1
+                self._checkouts[id(client)] = backend
+            outstanding_gauge.inc(labels=(backend.address,))
+            return client
+        # Busy servers and a lack of time are not failures, keep them apart
+        error_class = DspamClientError
+        if isinstance(error, (PoolTimeoutError, DeadlineExceededError)):
+            error_class = error.__class__
+        raise error_class('No DSPAM server available: {}'.format(error))
+
+    def put(self, client, discard=False, failed=False):
+        """
+        Return a client to the pool of its backend.
+
+        Args:
+        client  -- The client to return.
+        discard -- Disconnect the client instead of keeping it.
+        failed  -- The client is returned after an error of the server, which
+                   counts as a failure of its backend.
+
+        """
+        with self._lock:
+            backend = self._checkouts.pop(id(client))
+            backend.outstanding -= 1
+        outstanding_gauge.inc(-1, labels=(backend.address,))
+        response_time = client.response_time
+        backend.pool.put(client, discard=discard, failed=failed)
+        if failed:
+            self._failure(backend)
+        elif response_time is not None:
+            self._success(backend, response_time)
+
+    def close(self):
+        """
+        Disconnect the idle clients of all backends.
+
+        """
+        for backend in self.backends:
+            backend.pool.close()
+
+    def stats(self):
+        """
+        Return a dictionary with the statistics of all backend pools added
+        up.
+
+        """
+        stats = {}
+        for backend in self.backends:
+            for key, value in backend.pool.stats().items():
+                if key == 'checkout_time_max':
+                    stats[key] = max(stats.get(key, 0.0), value)
+                elif key != 'checkout_time_avg':
+                    stats[key] = stats.get(key, 0) + value
+        if stats['checkouts']:
+            stats['checkout_time_avg'] = (
+                stats['checkout_time_total'] / stats['checkouts'])
+        else:
+            stats['checkout_time_avg'] = 0.0
+        return stats
+
+    def backend_stats(self):
+        """
+        Return a dictionary with a dictionary of health statistics for each
+        backend, keyed on address.
+
+        """
+        stats = {}
+        with self._lock:
+            for backend in self.backends:
+                stats[backend.address] = {
+                    'outstanding': backend.outstanding,
+                    'latency': backend.latency,
+                    'failures': backend.failures,
+                    'ejected': backend.ejected_until is not None,
+                    'ejections': backend.ejections,
+                }
+        return stats
@@ -0,0 +1,242 @@
+import random
+import time
+
+import pytest
+from flexmock import flexmock
+
+from . import utils
+from .backend import BackendPool, HashRing, split_addresses
+from .client import DeadlineExceededError, DspamClientError
+from .fanout import WorkerPool, classify_groups
+
+
+def classify(pool):
+    client = pool.get()
+    client.process('Subject: test\r\n\r\ntest', 'bar')
+    pool.put(client)
+    return client.socket
+
+
+def test_split_addresses():
+    assert split_addresses('inet:24@localhost') == ['inet:24@localhost']
+    assert split_addresses(' unix:/a, inet:24@b\n  inet:24@c ') == [
+        'unix:/a', 'inet:24@b', 'inet:24@c']
+
+
+def test_init_invalid(make_backend_pool):
+    with pytest.raises(ValueError):
+        make_backend_pool(['unix:/a'], strategy='random')
+    with pytest.raises(ValueError):
+        make_backend_pool([])
+    with pytest.raises(ValueError):
+        make_backend_pool(['unix:/a'], virtual_nodes=0)
+
+
+def test_hash_ring():
+    ring = HashRing(['a', 'b', 'c'])
+    keys = ['user{}'.format(i) for i in range(300)]
+    owners = dict((key, ring.lookup(key)[0]) for key in keys)
+    assert sorted(ring.lookup('user0')) == ['a', 'b', 'c']
+    assert ring.lookup('user0') == ring.lookup('user0')
+    counts = [list(owners.values()).count(node) for node in 'abc']
+    assert min(counts) > 50
+
+    # Only the keys of a removed node move, to the next node on the ring
+    smaller = HashRing(['a', 'c'])
+    for key in keys:
+        if owners[key] != 'b':
+            assert smaller.lookup(key)[0] == owners[key]
+        else:
+            assert smaller.lookup(key)[0] == ring.lookup(key)[1]
+    assert HashRing([]).lookup('user0') == []
+
+
+def test_round_robin(dspam_servers, make_backend_pool):
+    addresses = [server.socket for server in dspam_servers]
+    pool = make_backend_pool(addresses)
+    used = [classify(pool) for i in range(4)]
+    assert sorted(used) == sorted(addresses * 2)
+    assert used[0] != used[1]
+    assert [server.connections for server in dspam_servers] == [1, 1]
+    stats = pool.stats()
+    assert stats['checkouts'] == 4
+    assert stats['size'] == 2
+    assert stats['in_use'] == 0
+    assert pool.backend_stats()[addresses[0]]['latency'] > 0
+    pool.close()
+
+
+def test_least_outstanding(dspam_servers, make_backend_pool):
+    pool = make_backend_pool([server.socket for server in dspam_servers],
+                             strategy='least-outstanding')
+    client = pool.get()
+    # The other server has no connections in use
+    for i in range(3):
+        assert classify(pool) != client.socket
+    pool.put(client)
+    pool.close()
+
+
+def test_latency(dspam_servers, make_backend_pool):
+    fast, slow = [server.socket for server in dspam_servers]
+    pool = make_backend_pool([slow, fast], strategy='latency')
+    pool.backends[0].latency = 10.0
+    pool.backends[1].latency = 0.01
+    flexmock(random).should_receive('random').and_return(0.5)
+    assert classify(pool) == fast
+    pool.close()
+
+
+def test_failover_and_ejection(dspam_servers, tmpdir, make_backend_pool):
+    dead = 'unix:' + str(tmpdir.join('nonexistent'))
+    alive = dspam_servers[0].socket
+    pool = make_backend_pool([dead, alive], max_failures=2)
+    for i in range(4):
+        assert classify(pool) == alive
+    stats = pool.backend_stats()
+    assert stats[dead]['failures'] == 2
+    assert stats[dead]['ejected'] is True
+    assert stats[dead]['ejections'] == 1
+    assert stats[alive]['failures'] == 0
+    pool.close()
+
+
+def test_failed_transaction_ejects(dspam_servers, make_backend_pool):
+    address = dspam_servers[0].socket
+    pool = make_backend_pool([address, dspam_servers[1].socket],
+                             max_failures=1)
+    while True:
+        client = pool.get()
+        if client.socket == address:
+            break
+        pool.put(client)
+    pool.put(client, failed=True)
+    assert client._socket is None
+    assert pool.backend_stats()[address]['ejected'] is True
+    for i in range(3):
+        assert classify(pool) != address
+    pool.close()
+
+
+def test_readmission(dspam_servers, make_backend_pool):
+    address = dspam_servers[0].socket
+    pool = make_backend_pool([address, dspam_servers[1].socket],
+                             max_failures=2, ejection_time=30)
+    backend = pool.backends[0]
+    flexmock(utils).should_receive('monotonic').and_return(100)
+    pool._failure(backend)
+    pool._failure(backend)
+    assert pool.backend_stats()[address]['ejected'] is True
+    assert [other.address for other in pool._order()] == [
+        dspam_servers[1].socket]
+
+    # After the ejection time, a single failure ejects the server again
+    flexmock(utils).should_receive('monotonic').and_return(130)
+    assert len(pool._order()) == 2
+    pool._failure(backend)
+    assert len(pool._order()) == 1
+    assert pool.backend_stats()[address]['ejections'] == 2
+
+    # And a single success re-admits it
+    flexmock(utils).should_receive('monotonic').and_return(160)
+    pool._success(backend, 0.1)
+    stats = pool.backend_stats()[address]
+    assert stats['ejected'] is False
+    assert stats['failures'] == 0
+    assert stats['latency'] == 0.1
+
+
+def test_all_ejected_are_tried(tmpdir, make_backend_pool):
+    dead = ['unix:' + str(tmpdir.join(name)) for name in ('a', 'b')]
+    pool = make_backend_pool(dead, max_failures=1)
+    for i in range(3):
+        with pytest.raises(DspamClientError):
+            pool.get(timeout=1)
+    stats = pool.backend_stats()
+    assert [stats[address]['failures'] for address in dead] == [3, 3]
+
+
+def test_fill(dspam_servers, tmpdir, make_backend_pool):
+    dead = 'unix:' + str(tmpdir.join('nonexistent'))
+    pool = make_backend_pool([dead, dspam_servers[0].socket], min_size=1)
+    pool.fill()
+    assert pool.stats()['idle'] == 1
+    assert pool.backend_stats()[dead]['failures'] == 1
+    pool.close()
+
+    with pytest.raises(DspamClientError):
+        make_backend_pool([dead], min_size=1).fill()
+
+
+def test_consistent_hash(dspam_servers, tmpdir, make_backend_pool):
+    addresses = [server.socket for server in dspam_servers]
+    pool = make_backend_pool(addresses, strategy='consistent-hash')
+    users = ['user{}'.format(i) for i in range(20)]
+    groups = pool.partition(users)
+    assert len(groups) == 2
+    assert sorted(groups[0] + groups[1]) == sorted(users)
+    assert pool.partition([]) == [[]]
+    servers = []
+    for group in groups:
+        used = set()
+        for user in group:
+            client = pool.get(key=user)
+            used.add(client.socket)
+            pool.put(client)
+        assert len(used) == 1
+        servers.extend(used)
+    assert sorted(servers) == sorted(addresses)
+
+    # Users of an unavailable server fail over to the next one
+    dead = 'unix:' + str(tmpdir.join('nonexistent'))
+    pool = make_backend_pool([dead] + addresses,
+                             strategy='consistent-hash', max_failures=1)
+    user = next(user for user in users
+                if pool._ring.lookup(user)[0] == dead)
+    fallback = pool._ring.lookup(user)[1]
+    for i in range(3):
+        client = pool.get(key=user)
+        assert client.socket == fallback
+        pool.put(client)
+    assert pool.backend_stats()[dead]['ejected'] is True
+    assert len(pool.partition(users)) == 2
+    pool.close()
+
+
+def test_classify_groups(dspam_servers, make_backend_pool):
+    pool = make_backend_pool([server.socket for server in dspam_servers],
+                             strategy='consistent-hash')
+    workers = WorkerPool(2)
+    users = ['user{}'.format(i) for i in range(20)]
+    dspam_servers[0].spam_users.update(users)
+    results = classify_groups(
+        pool, workers, b'Subject: test\r\n\r\ntest\r\n',
+        pool.partition(users), '--classify --deliver=summary')
+    assert sorted(results) == sorted(users)
+    # Each server classified the message once, for its own users
+    assert [len(server.messages) for server in dspam_servers] == [1, 1]
+    spam = sorted(user for user in users if results[user]['class'] == 'Spam')
+    assert spam == sorted(user for user in users
+                          if pool._order(user)[0].address ==
+                          dspam_servers[0].socket)
+    workers.close()
+    pool.close()
+
+
+def test_failover_within_deadline(dspam_servers, silent_server,
+                                  make_backend_pool):
+    alive = dspam_servers[0].socket
+    pool = make_backend_pool([silent_server, alive], max_failures=1)
+    start = time.time()
+    client = pool.get(deadline=utils.monotonic() + 0.4)
+    # The server that never greets only gets its share of the time
+    assert client.socket == alive
+    assert time.time() - start < 1
+    pool.put(client)
+    assert pool.backend_stats()[silent_server]['ejected'] is True
+
+    # Running out of time is not held against a server
+    pool = make_backend_pool([alive], max_failures=1)
+    with pytest.raises(DeadlineExceededError):
+        pool.get(deadline=utils.monotonic() - 1)
+    assert pool.backend_stats()[alive]['failures'] == 0
@@ -0,0 +1,144 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import logging
+import threading
+
+from dspam import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+transitions_counter = metrics.Counter(
+    'dspam_breaker_transitions_total',
+    'State changes of the DSPAM circuit breaker', labels=('state',))
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling DSPAM for a while after it failed repeatedly.
+
+    The breaker starts closed: all calls are allowed. After failure_threshold
+    consecutive calls failed or took longer than slow_call_time seconds, the
+    breaker opens, and no calls are allowed for cooldown seconds. After that,
+    the breaker is half-open: a single probe call is allowed. When the probe
+    succeeds the breaker closes again, otherwise it opens for another
+    cooldown period.
+
+    While the breaker is open, messages are accepted without classification
+    when fail_open is set, and temporarily rejected otherwise.
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    # Default configuration
+    failure_threshold = 5
+    slow_call_time = 0.0
+    cooldown = 30.0
+    fail_open = False
+
+    def __init__(self, failure_threshold=None, slow_call_time=None,
+                 cooldown=None, fail_open=None):
+        """
+        Create a new, closed breaker.
+
+        Args:
+        failure_threshold -- Consecutive failures after which to open.
+        slow_call_time    -- Seconds after which a call counts as failed,
+                             0 means calls are never too slow.
+        cooldown          -- Seconds to stay open before probing.
+        fail_open         -- Whether to accept messages while open.
+
+        """
+        if failure_threshold is not None:
+            self.failure_threshold = failure_threshold
+        if slow_call_time is not None:
+            self.slow_call_time = slow_call_time
+        if cooldown is not None:
+            self.cooldown = cooldown
+        if fail_open is not None:
+            self.fail_open = fail_open
+
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        transitions_counter.inc(labels=(state,))
+        if state == self.OPEN:
+            logger.warning(
+                'DSPAM circuit breaker opened after {} failures, not calling '
+                'DSPAM for {} seconds'.format(self._failures, self.cooldown))
+        else:
+            logger.info('DSPAM circuit breaker is ' + state)
+
+    def allow(self):
+        """
+        Return whether DSPAM may be called.
+
+        When the breaker is half-open, only the first caller is allowed, to
+        probe the server. Each allowed call must be followed by a call to
+        success(), failure() or release().
+
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if utils.monotonic() < self._opened_at + self.cooldown:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self, duration=0):
+        """
+        Record a successful call.
+
+        Args:
+        duration -- The number of seconds the call took.
+
+        """
+        if self.slow_call_time and duration > self.slow_call_time:
+            logger.warning(
+                'DSPAM call took {:.1f} seconds, more than {} seconds'.format(
+                    duration, self.slow_call_time))
+            self.failure()
+            return
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    def release(self):
+        """
+        Release the probe of a half-open breaker when the call ended without
+        an outcome, so the next caller can probe instead.
+
+        """
+        with self._lock:
+            self._probing = False
+
+    def failure(self):
+        """
+        Record a failed call.
+
+        """
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if (self.state == self.HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                self._opened_at = utils.monotonic()
+                self._set_state(self.OPEN)
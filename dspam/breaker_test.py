@@ -0,0 +1,78 @@
+from flexmock import flexmock
+
+from . import utils
+from .breaker import CircuitBreaker
+
+
+def test_opens_after_failures():
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=30)
+    flexmock(utils).should_receive('monotonic').and_return(100)
+    for i in range(2):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_success_resets_failures():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.failure()
+    breaker.success(0.1)
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_slow_calls_count_as_failures():
+    breaker = CircuitBreaker(failure_threshold=2, slow_call_time=1)
+    breaker.success(0.5)
+    breaker.success(1.5)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.success(2)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_probe():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+    flexmock(utils).should_receive('monotonic').and_return(100)
+    breaker.failure()
+    flexmock(utils).should_receive('monotonic').and_return(129)
+    assert not breaker.allow()
+    flexmock(utils).should_receive('monotonic').and_return(130)
+    # Only a single probe is allowed
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.success(0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens():
+    breaker = CircuitBreaker(failure_threshold=5, cooldown=30)
+    flexmock(utils).should_receive('monotonic').and_return(100)
+    for i in range(5):
+        breaker.failure()
+    flexmock(utils).should_receive('monotonic').and_return(130)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    flexmock(utils).should_receive('monotonic').and_return(159)
+    assert not breaker.allow()
+    flexmock(utils).should_receive('monotonic').and_return(160)
+    assert breaker.allow()
+
+
+def test_release_probe():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+    flexmock(utils).should_receive('monotonic').and_return(100)
+    breaker.failure()
+    flexmock(utils).should_receive('monotonic').and_return(130)
+    assert breaker.allow()
+    assert not breaker.allow()
+    # A probe without an outcome lets the next caller probe
+    breaker.release()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
@@ -0,0 +1,134 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBuffer(object):
+    """
+    A buffer for message data that spills to disk when it grows large.
+
+    Data is kept in memory as a list of chunks, so appending does not copy
+    the data received so far. When the buffer grows beyond max_memory_size
+    bytes, all data is moved to an anonymous temporary file, and new data is
+    appended to that file. This keeps memory usage bounded when many large
+    messages are received at the same time.
+
+    Iterating over the buffer returns the data in chunks, so it can be passed
+    to DspamClient.data() without reading the whole message into memory.
+    Several threads can iterate over the same buffer at the same time.
+
+    """
+
+    # Size of the chunks returned when reading back from disk
+    chunk_size = 65536
+
+    def __init__(self, max_memory_size=1048576, directory=None):
+        """
+        Create a new, empty buffer.
+
+        Args:
+        max_memory_size -- The number of bytes to keep in memory, before the
+                           data is moved to a temporary file.
+        directory       -- Where to create the temporary file, defaults to
+                           the system temporary directory.
+
+        """
+        self.max_memory_size = max_memory_size
+        self.directory = directory
+        self._chunks = []
+        self._size = 0
+        self._file = None
+        # Serializes access to the file position
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def on_disk(self):
+        """
+        Whether the data was moved to a temporary file.
+
+        """
+        return self._file is not None
+
+    def write(self, data):
+        """
+        Append data to the buffer.
+
+        Args:
+        data -- The bytes to append.
+
+        """
+        if not data:
+            return
+        self._size += len(data)
+        if self._file is not None:
+            with self._lock:
+                self._file.write(data)
+            return
+        self._chunks.append(data)
+        if self._size > self.max_memory_size:
+            self._rollover()
+
+    def _rollover(self):
+        """
+        Move the buffered data to a temporary file.
+
+        """
+        self._file = tempfile.TemporaryFile(
+            prefix='dspam-milter-', dir=self.directory)
+        logger.debug(
+            'Message data exceeds {} bytes, moving it to disk'.format(
+                self.max_memory_size))
+        for chunk in self._chunks:
+            self._file.write(chunk)
+        self._chunks = []
+
+    def __iter__(self):
+        """
+        Return the buffered data in chunks.
+
+        """
+        if self._file is None:
+            for chunk in self._chunks:
+                yield chunk
+            return
+        offset = 0
+        while True:
+            with self._lock:
+                self._file.seek(offset)
+                chunk = self._file.read(self.chunk_size)
+                # Continue appending at the end
+                self._file.seek(0, 2)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def getvalue(self):
+        """
+        Return all buffered data as a single bytes object.
+
+        """
+        return b''.join(self)
+
+    def close(self):
+        """
+        Discard all buffered data, and remove the temporary file.
+
+        The buffer is empty afterwards, and can be used again.
+
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._chunks = []
+        self._size = 0
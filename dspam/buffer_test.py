@@ -0,0 +1,59 @@
+import os
+
+from .buffer import MessageBuffer
+from .client import DspamClient
+
+
+def test_in_memory():
+    buf = MessageBuffer(max_memory_size=10)
+    buf.write(b'foo\r\n')
+    buf.write(b'')
+    buf.write(b'bar\r\n')
+    assert len(buf) == 10
+    assert buf.on_disk is False
+    assert list(buf) == [b'foo\r\n', b'bar\r\n']
+    assert buf.getvalue() == b'foo\r\nbar\r\n'
+
+
+def test_spill_to_disk(tmpdir):
+    buf = MessageBuffer(max_memory_size=10, directory=str(tmpdir))
+    buf.chunk_size = 4
+    buf.write(b'foo\r\n')
+    buf.write(b'bar\r\n')
+    buf.write(b'baz')
+    assert buf.on_disk is True
+    assert len(buf) == 13
+    assert list(buf) == [b'foo\r', b'\nbar', b'\r\nba', b'z']
+    # appending after reading continues at the end
+    buf.write(b'\r\n')
+    assert buf.getvalue() == b'foo\r\nbar\r\nbaz\r\n'
+    # the temporary file is anonymous
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_close():
+    buf = MessageBuffer(max_memory_size=2)
+    buf.write(b'foo')
+    assert buf.on_disk is True
+    buf.close()
+    assert buf.on_disk is False
+    assert len(buf) == 0
+    buf.write(b'a')
+    assert buf.getvalue() == b'a'
+
+
+def test_data_from_buffer(dspam_server, tmpdir):
+    buf = MessageBuffer(max_memory_size=16, directory=str(tmpdir))
+    buf.chunk_size = 7
+    for line in (b'Subject: test\r\n', b'\r\n', b'.foo\r\n', b'bar\r\n' * 10):
+        buf.write(line)
+    assert buf.on_disk is True
+    c = DspamClient(dspam_server.socket, 'foo', 'secret')
+    c.connect()
+    c.lhlo()
+    c.mailfrom(client_args='--classify --deliver=summary')
+    c.rcptto(('bar',))
+    c.data(buf)
+    assert c.results['bar']['class'] == 'Innocent'
+    assert dspam_server.messages[-1] + b'\r\n' == buf.getvalue()
+    c.quit()
@@ -0,0 +1,236 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import binascii
+import logging
+import re
+import socket
+
+from dspam.rcptmap import RecipientMap
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(address):
+    """
+    Convert an IPv4 or IPv6 address to an integer.
+
+    Returns a tuple of the address family and the integer. IPv4-mapped IPv6
+    addresses are returned as IPv4 addresses.
+    Raises a ValueError when the address is invalid.
+
+    Args:
+    address -- The address as a string.
+
+    """
+    if address.startswith('[') and address.endswith(']'):
+        address = address[1:-1]
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            continue
+        value = int(binascii.hexlify(packed), 16)
+        if family == socket.AF_INET6 and value >> 32 == 0xffff:
+            return socket.AF_INET, value & 0xffffffff
+        return family, value
+    raise ValueError('Invalid IP address: ' + address)
+
+
+class CidrSet(object):
+    """
+    A set of IPv4 and IPv6 networks.
+
+    Networks are stored in a binary trie per address family, with one level
+    for each bit of the network prefix. Looking up an address walks down the
+    trie along the bits of the address, until it reaches the end of a
+    network, so a lookup does not depend on the number of networks.
+
+    """
+
+    _bits = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+    def __init__(self, networks=()):
+        """
+        Create a new set.
+
+        Args:
+        networks -- Networks to add, in CIDR notation.
+
+        """
+        # A trie node is a list of the child nodes for bit 0 and bit 1, and
+        #   a flag telling whether a network ends at the node.
+        self._roots = {socket.AF_INET: [None, None, False],
+                       socket.AF_INET6: [None, None, False]}
+        self._size = 0
+        for network in networks:
+            self.add(network)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, network):
+        """
+        Add a network to the set.
+
+        A single address is added as a network of one address. Host bits
+        in the network address are ignored.
+        Raises a ValueError when the network is invalid.
+
+        Args:
+        network -- The network in CIDR notation, like 192.0.2.0/24.
+
+        """
+        address, slash, prefix = network.partition('/')
+        family, value = parse_address(address)
+        bits = self._bits[family]
+        if not slash:
+            length = bits
+        elif prefix.isdigit():
+            length = int(prefix)
+            if family == socket.AF_INET and ':' in address:
+                # An IPv4-mapped IPv6 network has an IPv6 prefix length
+                length -= 96
+        else:
+            length = -1
+        if not 0 <= length <= bits:
+            raise ValueError('Invalid network: ' + network)
+
+        node = self._roots[family]
+        for i in range(length):
+            if node[2]:
+                # Already covered by a larger network
+                return
+            bit = (value >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        if not node[2]:
+            node[2] = True
+            self._size += 1
+
+    def __contains__(self, address):
+        """
+        Return whether an address is in one of the networks.
+
+        Addresses that can not be parsed are never in the set.
+
+        Args:
+        address -- The address as a string.
+
+        """
+        try:
+            family, value = parse_address(address)
+        except ValueError:
+            return False
+        bits = self._bits[family]
+        node = self._roots[family]
+        for i in range(bits):
+            if node[2]:
+                return True
+            node = node[(value >> (bits - 1 - i)) & 1]
+            if node is None:
+                return False
+        return node[2]
+
+
+class BypassRules(object):
+    """
+    Rules for messages that are accepted without classification.
+
+    Messages are bypassed when they are received from a client in one of the
+    client_networks, when the client authenticated with SASL and
+    authenticated is set, or when the sender matches one of the senders.
+    Recipients matching one of the recipients are not classified, and a
+    message is bypassed when none of its recipients is left.
+
+    Senders and recipients are matched with the same patterns as a
+    RecipientMap: user@example.org, @example.org, @*.example.org and *.
+
+    """
+
+    # Default configuration
+    client_networks = ''
+    authenticated = False
+    senders = ''
+    recipients = ''
+
+    def __init__(self, client_networks=None, authenticated=None,
+                 senders=None, recipients=None):
+        """
+        Create the rules, from the configuration or from arguments.
+
+        Networks and patterns are separated by whitespace or commas.
+        Raises a ValueError when a network or pattern is invalid.
+
+        Args:
+        client_networks -- Networks of clients to bypass, in CIDR notation.
+        authenticated   -- Whether to bypass clients that authenticated.
+        senders         -- Sender patterns to bypass.
+        recipients      -- Recipient patterns to bypass.
+
+        """
+        if client_networks is not None:
+            self.client_networks = client_networks
+        if authenticated is not None:
+            self.authenticated = authenticated
+        if senders is not None:
+            self.senders = senders
+        if recipients is not None:
+            self.recipients = recipients
+
+        self.networks = CidrSet(self._split(self.client_networks))
+        self.sender_map = self._patterns(self.senders)
+        self.recipient_map = self._patterns(self.recipients)
+
+    @staticmethod
+    def _split(value):
+        if not value:
+            return []
+        return [item for item in re.split(r'[\s,]+', value) if item]
+
+    def _patterns(self, value):
+        patterns = RecipientMap()
+        for pattern in self._split(value):
+            patterns.add(pattern, True)
+        return patterns
+
+    def __bool__(self):
+        return bool(len(self.networks) or self.authenticated or
+                    len(self.sender_map) or len(self.recipient_map))
+    __nonzero__ = __bool__
+
+    def match_client(self, address):
+        """
+        Return whether messages from a client are bypassed.
+
+        Args:
+        address -- The IP address of the client.
+
+        """
+        return address is not None and address in self.networks
+
+    def match_sender(self, sender, auth_user=None):
+        """
+        Return whether messages from a sender are bypassed.
+
+        Args:
+        sender    -- The envelope sender address.
+        auth_user -- The SASL login name of the client, if it authenticated.
+
+        """
+        if self.authenticated and auth_user:
+            return True
+        return bool(sender) and self.sender_map.match(sender) is not None
+
+    def match_recipient(self, recipient):
+        """
+        Return whether a recipient is not classified.
+
+        Args:
+        recipient -- The envelope recipient address.
+
+        """
+        return self.recipient_map.match(recipient) is not None
@@ -0,0 +1,92 @@
+import socket
+
+import pytest
+
+from .bypass import BypassRules, CidrSet, parse_address
+
+
+def test_parse_address():
+    assert parse_address('192.0.2.1') == (socket.AF_INET, 0xc0000201)
+    assert parse_address('::1') == (socket.AF_INET6, 1)
+    assert parse_address('[::1]') == (socket.AF_INET6, 1)
+    assert parse_address('::ffff:192.0.2.1') == (socket.AF_INET, 0xc0000201)
+    with pytest.raises(ValueError):
+        parse_address('192.0.2.256')
+    with pytest.raises(ValueError):
+        parse_address('localhost')
+
+
+def test_cidr_set():
+    networks = CidrSet(['10.0.0.0/8', '192.0.2.1', '2001:db8::/32',
+                        '172.16.5.4/12'])
+    assert len(networks) == 4
+    assert '10.1.2.3' in networks
+    assert '11.1.2.3' not in networks
+    assert '192.0.2.1' in networks
+    assert '192.0.2.2' not in networks
+    assert '172.31.255.255' in networks
+    assert '172.32.0.0' not in networks
+    assert '2001:db8:1::1' in networks
+    assert '2001:db9::1' not in networks
+    assert '::ffff:10.0.0.1' in networks
+    assert 'unknown' not in networks
+
+
+def test_cidr_set_nested_networks():
+    networks = CidrSet(['10.1.0.0/16', '10.0.0.0/8', '10.2.0.0/16'])
+    assert len(networks) == 2
+    assert '10.2.3.4' in networks
+
+
+def test_cidr_set_everything():
+    networks = CidrSet(['0.0.0.0/0', '::ffff:0.0.0.0/96'])
+    assert len(networks) == 1
+    assert '198.51.100.1' in networks
+    assert '::1' not in networks
+
+
+@pytest.mark.parametrize('network', [
+    '10.0.0.0/33', '10.0.0.0/', '10.0.0.0/x', '::/129', '::ffff:0.0.0.0/95',
+    'example.org/8',
+])
+def test_cidr_set_invalid(network):
+    with pytest.raises(ValueError):
+        CidrSet([network])
+
+
+def test_bypass_rules():
+    rules = BypassRules(
+        client_networks='127.0.0.0/8, ::1  192.0.2.0/24',
+        senders='@trusted.example.org',
+        recipients='postmaster@example.org @*.lists.example.org')
+    assert rules
+    assert rules.match_client('127.0.0.1')
+    assert rules.match_client('::1')
+    assert not rules.match_client('198.51.100.1')
+    assert not rules.match_client(None)
+    assert rules.match_sender('news@Trusted.example.org')
+    assert not rules.match_sender('news@example.org')
+    assert not rules.match_sender('')
+    assert not rules.match_sender('news@example.org', 'john')
+    assert rules.match_recipient('Postmaster@example.org')
+    assert rules.match_recipient('dev@eng.lists.example.org')
+    assert not rules.match_recipient('john@example.org')
+
+
+def test_bypass_rules_authenticated():
+    rules = BypassRules(authenticated=True)
+    assert rules
+    assert rules.match_sender('john@example.org', 'john')
+    assert rules.match_sender('', 'john')
+    assert not rules.match_sender('john@example.org', None)
+
+
+def test_bypass_rules_empty():
+    assert not BypassRules()
+
+
+def test_bypass_rules_invalid():
+    with pytest.raises(ValueError):
+        BypassRules(client_networks='10.0.0.0/40')
+    with pytest.raises(ValueError):
+        BypassRules(recipients='john@*')
@@ -0,0 +1,149 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import collections
+import logging
+import threading
+
+from dspam import utils
+
+logger = logging.getLogger(__name__)
+
+
+class VerdictCache(object):
+    """
+    A thread-safe LRU cache for DSPAM results.
+
+    Results are cached per message fingerprint and DSPAM user, so a message
+    that is received again, for instance when the MTA retries it after a
+    temporary failure, can be answered without asking DSPAM again.
+
+    Entries expire after ttl seconds. The cache holds results up to an
+    estimated max_size bytes, and evicts the least recently used entries
+    when it grows beyond that.
+
+    """
+
+    # Default configuration
+    max_size = 0
+    ttl = 3600.0
+
+    # Estimated memory used by an entry, besides its strings
+    entry_overhead = 256
+
+    def __init__(self, max_size=None, ttl=None):
+        """
+        Create a new cache.
+
+        Args:
+        max_size -- The maximum estimated size of the cache in bytes.
+        ttl      -- The number of seconds entries stay valid.
+
+        """
+        if max_size is not None:
+            self.max_size = max_size
+        if ttl is not None:
+            self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # Maps (fingerprint, user) to (expiry time, size, result)
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def _entry_size(self, key, result):
+        size = self.entry_overhead + len(key[0]) + len(key[1])
+        for field in ('user', 'result', 'class_', 'signature'):
+            value = getattr(result, field, None)
+            if value is not None:
+                size += len(value)
+        return size
+
+    def _remove(self, key):
+        expires, size, result = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, fingerprint, users):
+        """
+        Return the cached results of a message for all users.
+
+        Returns a dictionary of results keyed on user, or None when the
+        results for one or more of the users are not in the cache.
+
+        Args:
+        fingerprint -- The fingerprint of the message.
+        users       -- The DSPAM users the message is classified for.
+
+        """
+        now = utils.monotonic()
+        results = {}
+        with self._lock:
+            for user in users:
+                key = (fingerprint, user)
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] <= now:
+                    self._remove(key)
+                    self._stats['expirations'] += 1
+                    entry = None
+                if entry is None:
+                    self._stats['misses'] += 1
+                    return None
+                results[user] = entry[2]
+            for user in users:
+                # Mark as most recently used
+                key = (fingerprint, user)
+                self._entries[key] = self._entries.pop(key)
+            self._stats['hits'] += 1
+        return results
+
+    def put(self, fingerprint, results):
+        """
+        Store the results of a message.
+
+        Args:
+        fingerprint -- The fingerprint of the message.
+        results     -- A dictionary of results keyed on DSPAM user.
+
+        """
+        expires = utils.monotonic() + self.ttl
+        with self._lock:
+            for user, result in results.items():
+                key = (fingerprint, user)
+                if key in self._entries:
+                    self._remove(key)
+                size = self._entry_size(key, result)
+                if size > self.max_size:
+                    continue
+                self._entries[key] = (expires, size, result)
+                self._size += size
+            while self._size > self.max_size:
+                key = next(iter(self._entries))
+                self._remove(key)
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Return a dictionary with cache statistics.
+
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['size'] = self._size
+        return stats
@@ -0,0 +1,78 @@
+from flexmock import flexmock
+
+from . import utils
+from .cache import VerdictCache
+from .client import DspamResult
+
+
+def result(user, class_='Innocent'):
+    return DspamResult(user, class_, class_, '0.0000', '1.0000',
+                       '5bc2b9e1220641279615812')
+
+
+def test_get_and_put():
+    cache = VerdictCache(max_size=10000)
+    assert cache.get(b'abc', ['foo']) is None
+    results = {'foo': result('foo'), 'bar': result('bar', 'Spam')}
+    cache.put(b'abc', results)
+    assert cache.get(b'abc', ['foo', 'bar']) == results
+    assert cache.get(b'abc', ['foo']) == {'foo': results['foo']}
+    assert cache.get(b'def', ['foo']) is None
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['entries'] == 2
+    assert stats['size'] > 0
+
+
+def test_partial_users_miss():
+    cache = VerdictCache(max_size=10000)
+    cache.put(b'abc', {'foo': result('foo')})
+    assert cache.get(b'abc', ['foo', 'bar']) is None
+    assert cache.stats()['misses'] == 1
+
+
+def test_ttl():
+    cache = VerdictCache(max_size=10000, ttl=60)
+    flexmock(utils).should_receive('monotonic').and_return(100)
+    cache.put(b'abc', {'foo': result('foo')})
+    flexmock(utils).should_receive('monotonic').and_return(159)
+    assert cache.get(b'abc', ['foo']) is not None
+    flexmock(utils).should_receive('monotonic').and_return(160)
+    assert cache.get(b'abc', ['foo']) is None
+    stats = cache.stats()
+    assert stats['expirations'] == 1
+    assert stats['entries'] == 0
+    assert stats['size'] == 0
+
+
+def test_lru_eviction():
+    entry = result('foo')
+    size = VerdictCache()._entry_size((b'a', 'foo'), entry)
+    cache = VerdictCache(max_size=size * 2)
+    cache.put(b'a', {'foo': entry})
+    cache.put(b'b', {'foo': entry})
+    # Use a, so b is evicted first
+    assert cache.get(b'a', ['foo']) is not None
+    cache.put(b'c', {'foo': entry})
+    assert cache.get(b'b', ['foo']) is None
+    assert cache.get(b'a', ['foo']) is not None
+    assert cache.get(b'c', ['foo']) is not None
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['size'] <= cache.max_size
+
+
+def test_entry_too_large():
+    cache = VerdictCache(max_size=10)
+    cache.put(b'abc', {'foo': result('foo')})
+    assert cache.get(b'abc', ['foo']) is None
+    assert cache.stats()['size'] == 0
+
+
+def test_clear():
+    cache = VerdictCache(max_size=10000)
+    cache.put(b'abc', {'foo': result('foo')})
+    cache.clear()
+    assert cache.get(b'abc', ['foo']) is None
+    assert cache.stats()['entries'] == 0
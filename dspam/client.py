@@ -3,48 +3,463 @@
 #
 # See LICENSE for the license.
 
+import functools
 import socket
 import logging
 import re
+import select
+import sys
+import time
+
+from dspam import metrics, utils
 
 
 class DspamClientError(Exception):
     pass
 
+
+# The deadline of a DSPAM transaction passed before it was finished
+class DeadlineExceededError(DspamClientError):
+    pass
+
+
+# The server did not accept a recipient
+class RecipientRejectedError(DspamClientError):
+    pass
+
 logger = logging.getLogger(__name__)
 
+if sys.version_info >= (3,):
+    def _native(data):
+        return data.decode('utf-8', 'surrogateescape')
+
+    def _bytes(data):
+        if isinstance(data, str):
+            return data.encode('utf-8', 'surrogateescape')
+        elif isinstance(data, memoryview):
+            return data.tobytes()
+        return data
+
+    _join = b''.join
+    _intern = sys.intern
+    _buffer_types = (str, bytes, bytearray, memoryview)
+else:
+    def _native(data):
+        return data
+
+    def _bytes(data):
+        if isinstance(data, unicode):
+            return data.encode('utf-8')
+        elif isinstance(data, memoryview):
+            return data.tobytes()
+        return data
+
+    # str.join() does not accept bytearrays
+    _join = bytearray().join
+    _intern = intern
+    _buffer_types = (str, unicode, bytearray, memoryview)
+
+# Maximum number of buffers passed to a single sendmsg() call
+_IOV_MAX = 1024
+
+# Time spent in the phases of DSPAM transactions: connect, lhlo, each
+#   command, pipelined command batches, sending message data (upload) and
+#   waiting for the results (response)
+phase_histogram = metrics.Histogram(
+    'dspam_client_phase_seconds',
+    'Time spent in each phase of DSPAM transactions', labels=('phase',))
+data_counter = metrics.Counter(
+    'dspam_client_data_bytes_total',
+    'Message data sent to DSPAM, after dot-stuffing')
+
+
+class LineReader(object):
+    """
+    A buffered reader for line-based server responses.
+
+    Data is read from the socket in large chunks and kept in a receive
+    buffer, so that framing a response line costs at most a few recv()
+    calls instead of one per byte.
 
-class DspamClient(object):
     """
-    A DSPAM client can be used to interact with a DSPAM server.
 
-    The client is able to speak to a DSPAM server over both a TCP or UNIX
-    domain socket exposed by a running DSPAM server, and interact with it
-    through its supported protocols: LMTP and DLMTP. The latter is an
-    enhanced version of LMTP to facilitate some options that are not possible
-    when using strict LMTP.
+    chunk_size = 8192
 
-    Some common DSPAM operations are included in this class, custom
-    operations can be built by creating a new LMTP dialog with the
-    low-level LMTP commands.
+    def __init__(self, sock):
+        """
+        Create a new reader.
 
-    DSPAM server setup
-    ==================
-    To use the client to speak with a DSPAM server, the server must be
-    configured to expose a TCP (dspam.conf: ServerHost, ServerPort) or
-    UNIX domain socket (dspam.conf: ServerDomainSocketPath).
-    The server can support mulitple modes (dspam.conf: ServerMode) for
-    interaction with connecting clients. Which mode you need, depends on
-    the operations you need to perform. Most of the time you'll want to
-    use DLMTP though, which means that you'll also need to setup
-    authentication (dspam.conf: ServerPass.<ident>).
+        Args:
+        sock -- The connected socket to read from.
 
-    Python DspamClient setup
-    ========================
-    Each DspamClient instance needs to talk to a DSPAM server.
-    You need to specify the socket where DSPAM is listening when creating
-    a new instance. If you need to use DLMTP features (probably most of the
-    time), you also need to pass the ident and password.
+        """
+        self._socket = sock
+        self._buffer = bytearray()
+        # Offset up to which the buffer is known not to contain a newline
+        self._scanned = 0
+
+    def _fill(self):
+        """
+        Read one chunk from the socket into the buffer.
+
+        Returns the number of bytes read, 0 means end-of-file.
+
+        """
+        data = self._socket.recv(self.chunk_size)
+        self._buffer.extend(data)
+        return len(data)
+
+    def pending(self):
+        """
+        Return the number of bytes received, but not consumed yet.
+
+        """
+        return len(self._buffer)
+
+    def readline(self):
+        """
+        Read a single line, including its line terminator.
+
+        When the connection is closed before a complete line is received,
+        the remaining data is returned. On end-of-file, an empty string
+        is returned.
+
+        """
+        while True:
+            pos = self._buffer.find(b'\n', self._scanned)
+            if pos >= 0:
+                return self._consume(pos + 1)
+            self._scanned = len(self._buffer)
+            if not self._fill():
+                return self._consume(len(self._buffer))
+
+    def _consume(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._scanned = 0
+        return data
+
+
+class DataEncoder(object):
+    """
+    Encode message data for transmission in the LMTP DATA phase.
+
+    Line endings are normalized to CRLF, and every line starting with a dot
+    is dot-stuffed. This is done on the data as a whole instead of line by
+    line. Data can be passed in one go, or in consecutive chunks: line state
+    is kept between calls to encode().
+
+    """
+
+    def __init__(self):
+        # Whether the next byte starts a new line
+        self._bol = True
+        # Whether the previous chunk ended in a CR that might be part of CRLF
+        self._cr = False
+
+    def encode(self, data):
+        """
+        Encode a chunk of message data.
+
+        Returns a list of buffers, ready to be sent to the server.
+
+        Args:
+        data -- The message data to encode.
+
+        """
+        data = _bytes(data)
+        if not data:
+            return []
+
+        buffers = []
+        if self._cr:
+            self._cr = False
+            if data[0:1] != b'\n':
+                # Not a CRLF pair after all, pass the bare CR unaltered
+                buffers.append(b'\r')
+                self._bol = False
+        if self._bol and data[0:1] == b'.':
+            buffers.append(b'.')
+
+        # A trailing CR is held back, it might be part of a CRLF pair
+        cr = data[-1:] == b'\r'
+        if cr:
+            last = data[-2:-1]
+        else:
+            last = data[-1:]
+
+        if data.count(b'\n') != data.count(b'\r\n') or b'\n.' in data:
+            # Plain replace() runs at memchr() speed, which makes it a lot
+            #   faster than a single regex substitution with group references.
+            if cr:
+                data = data[:-1]
+            data = data.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+            data = data.replace(b'\n.', b'\n..')
+        elif cr:
+            data = data[:-1]
+        # else: the data is encoded properly already, and is passed on as is
+
+        self._cr = cr
+        if len(data):
+            buffers.append(data)
+            self._bol = last == b'\n'
+        return buffers
+
+    def finish(self):
+        """
+        Return the buffers that terminate the message data.
+
+        """
+        buffers = []
+        if self._cr or not self._bol:
+            buffers.append(b'\r\n')
+        buffers.append(b'.\r\n')
+        self._bol = True
+        self._cr = False
+        return buffers
+
+
+class DspamResult(object):
+    """
+    The classification results for a single recipient in DLMTP summary mode.
+
+    Fields are converted once when the result is created: probability and
+    confidence are floats, and result and class are interned strings, so they
+    can be compared cheaply. A signature of 'N/A' is stored as None.
+
+    Results can also be accessed like the dictionaries returned by earlier
+    versions, for instance <DspamResult>['confidence'].
+
+    """
+
+    __slots__ = ('user', 'result', 'class_', 'probability', 'confidence',
+                 'signature')
+
+    # Dictionary keys that differ from the attribute name
+    _aliases = {'class': 'class_'}
+
+    def __init__(self, user, result, class_, probability, confidence,
+                 signature=None):
+        """
+        Create a new result.
+
+        Args:
+        user        -- The DSPAM user the message was classified for.
+        result      -- The result: Spam, Innocent, Whitelisted, etc.
+        class_      -- The classification: Spam, Innocent, Virus, etc.
+        probability -- The probability that the message is spam.
+        confidence  -- The confidence DSPAM has in the classification.
+        signature   -- The signature that can be used for retraining.
+
+        """
+        self.user = user
+        self.result = _intern(result)
+        self.class_ = _intern(class_)
+        self.probability = float(probability)
+        self.confidence = float(confidence)
+        if signature == 'N/A':
+            signature = None
+        self.signature = signature
+
+    def __getitem__(self, key):
+        value = getattr(self, self._aliases.get(key, key), None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return getattr(self, self._aliases.get(key, key), None) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def format(self, key):
+        """
+        Return a field as a string, the way DSPAM formats it in headers.
+
+        Args:
+        key -- The name of the field, like the dictionary key.
+
+        """
+        value = self[key]
+        if isinstance(value, float):
+            return '{:.4f}'.format(value)
+        return value
+
+    def __str__(self):
+        text = ('user=%s result=%s class=%s probability=%.4f confidence=%.4f'
+                % (self.user, self.result, self.class_, self.probability,
+                   self.confidence))
+        if self.signature is not None:
+            text += ' signature=' + self.signature
+        return text
+
+    def __repr__(self):
+        return '<DspamResult {}>'.format(self)
+
+
+class DataResponseParser(object):
+    """
+    Parse the server response at end-of-data.
+
+    The parser is fed the response one line at a time, and determines the
+    response format from the first line. Parsed results are collected in
+    <DataResponseParser>.results, keyed on recipient name. The parser does no
+    IO of its own, so it can be used by all client implementations.
+
+    In stdout mode, the server returns a message for each recipient, and the
+    response ends with a single dot. Message boundaries are determined by the
+    number of recipients, and message lines are kept as bytes: once the mode
+    is known, callers must feed the remaining lines as raw bytes.
+
+    """
+
+    # Response formats
+    LMTP = 'lmtp'
+    SUMMARY = 'summary'
+    STDOUT = 'stdout'
+
+    _lmtp_re = re.compile(r'250 \d\.\d\.\d <([^>]+)>')
+    _summary_re = re.compile(r'X-DSPAM-Result: ([^;]+); result="(\w+)"; '
+                             r'class="(\w+)"; probability=([\d\.]+); '
+                             r'confidence=([\d\.]+); signature=([\w,/]+)')
+
+    def __init__(self, recipients):
+        """
+        Create a new parser.
+
+        Args:
+        recipients -- The recipients accepted by the server at RCPT TO.
+
+        """
+        self.recipients = recipients
+        self.mode = None
+        self.results = {}
+        self._summary_done = False
+        # State for stdout mode: the number of messages seen so far, and the
+        #   result and lines of the current message
+        self._messages = 0
+        self._result = None
+        self._lines = []
+
+    def feed(self, line):
+        """
+        Parse a single response line.
+
+        Returns True when the response is complete.
+
+        Args:
+        line -- The response line, without line terminator.
+
+        """
+        if self.mode is None:
+            if line.startswith('250'):
+                self.mode = self.LMTP
+            elif line.startswith('X-DSPAM-Result:'):
+                self.mode = self.SUMMARY
+            elif line.startswith('X-Daemon-Classification:'):
+                self.mode = self.STDOUT
+                self._start_message(_bytes(line))
+                return False
+            else:
+                raise DspamClientError(
+                    'Unexpected server response at END-OF-DATA: ' + line)
+
+        if self.mode == self.LMTP:
+            match = self._lmtp_re.match(line)
+            if not match:
+                raise DspamClientError(
+                    'Unexpected server response at END-OF-DATA: ' + line)
+            rcpt = match.group(1)
+            self.results[rcpt] = {'accepted': True}
+            logger.debug(
+                'Message accepted for recipient {} in LMTP mode'.format(rcpt))
+            return len(self.results) == len(self.recipients)
+
+        elif self.mode == self.SUMMARY:
+            if self._summary_done:
+                # after the last summary line, a single dot is sent
+                if line != '.':
+                    raise DspamClientError(
+                        'Unexpected server response at END-OF-DATA: ' + line)
+                return True
+
+            match = self._summary_re.match(line)
+            if not match:
+                raise DspamClientError(
+                    'Unexpected server response at END-OF-DATA: ' + line)
+            rcpt = match.group(1)
+            self.results[rcpt] = DspamResult(*match.groups())
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    'Message handled for recipient {} in DLMTP summary mode, '
+                    'result is {}'.format(rcpt, match.group(2)))
+            if len(self.results) == len(self.recipients):
+                # we received responses for all accepted recipients
+                self._summary_done = True
+            return False
+
+        elif self.mode == self.STDOUT:
+            if line == b'.':
+                self._finish_message()
+                return True
+            if (line.startswith(b'X-Daemon-Classification:') and
+                    self._messages < len(self.recipients)):
+                self._finish_message()
+                self._start_message(line)
+            elif line.startswith(b'.'):
+                self._lines.append(line[1:])
+            else:
+                self._lines.append(line)
+            return False
+
+        raise DspamClientError(
+            'Unexpected server response at END-OF-DATA: ' + line)
+
+    def _start_message(self, line):
+        """
+        Start collecting a message returned in stdout mode.
+
+        """
+        self._messages += 1
+        self._result = _native(line[24:].strip())
+        self._lines = []
+
+    def _finish_message(self):
+        """
+        Store the message returned in stdout mode for the next recipient.
+
+        """
+        if self._messages > len(self.recipients):
+            raise DspamClientError(
+                'Server returned more messages than recipients at '
+                'END-OF-DATA')
+        rcpt = self.recipients[self._messages - 1]
+        # Every line is terminated, like the message that was sent
+        self._lines.append(b'')
+        message = b'\r\n'.join(self._lines)
+        self._lines = []
+        self.results[rcpt] = {
+            'result': self._result,
+            'message': message,
+        }
+        logger.debug(
+            'Message handled for recipient {} in DLMTP stdout mode, result '
+            'is {}, message body is {} bytes'.format(
+                rcpt, self._result, len(message)))
+
+
+class DspamClientBase(object):
+    """
+    Protocol logic shared by the DSPAM client implementations.
+
+    This class builds the LMTP commands and validates the server responses,
+    but leaves the actual network IO to its subclasses. See DspamClient for
+    details on using a client.
 
     """
 
@@ -76,10 +491,198 @@ class DspamClient(object):
             self.dlmtp_pass = dlmtp_pass
 
         self.dlmtp = False
+        self.pipelining = False
         self.results = {}
+        # Seconds the server took to respond to the last message data
+        self.response_time = None
         # Some internal structures
         self._socket = None
+        self._reader = None
         self._recipients = []
+        self._pipeline = []
+        self._in_data = False
+        self._encoder = None
+
+    def _parse_socket(self):
+        """
+        Parse the socket specification.
+
+        Returns a tuple with the socket family, the address to connect to, and
+        a description of the address for use in log messages.
+
+        """
+        # extract proto from socket setting
+        try:
+            (proto, spec) = self.socket.split(':')
+        except ValueError:
+            raise DspamClientError(
+                'Failed to parse DSPAM socket specification, '
+                'no proto found: ' + self.socket)
+
+        if proto == 'unix':
+            return (socket.AF_UNIX, spec, 'socket {}'.format(spec))
+        elif proto == 'inet' or proto == 'inet6':
+            try:
+                (port, host) = spec.split('@')
+                port = int(port)
+                if host == '':
+                    host = 'localhost'
+            except ValueError:
+                port = int(spec)
+                host = 'localhost'
+            return (socket.AF_INET, (host, port),
+                    'host {} port {}'.format(host, port))
+        else:
+            raise DspamClientError(
+                'Failed to parse DSPAM socket specification, '
+                'unknown proto ' + proto)
+
+    def _check_greeting(self, resp):
+        if not resp.startswith('220'):
+            raise DspamClientError(
+                'Unexpected server response at connect: ' + resp)
+
+    def _lhlo_command(self):
+        if self.dlmtp_ident is not None:
+            host = self.dlmtp_ident
+        else:
+            host = socket.getfqdn()
+        return 'LHLO ' + host + '\r\n'
+
+    def _check_lhlo(self, resp):
+        """
+        Check a line of the LHLO response, and parse the capability in it.
+
+        Returns True when this was the last line of the response.
+
+        """
+        if not resp.startswith('250'):
+            raise DspamClientError(
+                'Unexpected server response at LHLO: ' + resp)
+        if resp[4:20] == 'DSPAMPROCESSMODE':
+            self.dlmtp = True
+            logger.debug('Detected DLMTP extension in LHLO response')
+        elif resp[4:14] == 'PIPELINING':
+            self.pipelining = True
+            logger.debug('Detected PIPELINING extension in LHLO response')
+        # difference between "250-8BITMIME" and "250 SIZE"
+        return resp[3:4] == ' '
+
+    def _mailfrom_command(self, sender=None, client_args=None):
+        if sender and client_args:
+            raise DspamClientError('Arguments are mutually exclusive')
+
+        if client_args and not self.dlmtp:
+            raise DspamClientError(
+                'Cannot send client args, server does not support DLMTP')
+
+        command = 'MAIL FROM:'
+        if not sender:
+            if self.dlmtp_ident and self.dlmtp_pass:
+                sender = self.dlmtp_pass + '@' + self.dlmtp_ident
+            else:
+                sender = ''
+        command = command + '<' + sender + '>'
+
+        if client_args:
+            command = command + ' DSPAMPROCESSMODE="{}"'.format(client_args)
+        return command + '\r\n'
+
+    def _check_mailfrom(self, resp):
+        if not resp.startswith('250'):
+            raise DspamClientError(
+                'Unexpected server response at MAIL FROM: ' + resp)
+
+    def _check_rcptto(self, rcpt, resp):
+        if not resp.startswith('250'):
+            raise RecipientRejectedError(
+                'Unexpected server response at RCPT TO for '
+                'recipient {}: {}'.format(rcpt, resp))
+        self._recipients.append(rcpt)
+
+    def _check_data(self, resp):
+        if not resp.startswith('354'):
+            raise DspamClientError(
+                'Unexpected server response at DATA: ' + resp)
+        self._in_data = True
+
+    def _check_rset(self, resp):
+        if not resp.startswith('250'):
+            logger.warn('Unexpected server response at RSET: ' + resp)
+
+    def _check_quit(self, resp):
+        if not resp.startswith('221'):
+            logger.warning('Unexpected server response at QUIT: ' + resp)
+
+    def _summary_result(self, user):
+        """
+        Return the summary results for user, after processing a message.
+
+        """
+        # check for valid result format
+        if 'class' not in self.results.get(user, {}):
+            raise DspamClientError(
+                'Unexpected response format from server at END-OF-DATA, '
+                'an error occured')
+        return self.results[user]
+
+
+class DspamClient(DspamClientBase):
+    """
+    A DSPAM client can be used to interact with a DSPAM server.
+
+    The client is able to speak to a DSPAM server over both a TCP or UNIX
+    domain socket exposed by a running DSPAM server, and interact with it
+    through its supported protocols: LMTP and DLMTP. The latter is an
+    enhanced version of LMTP to facilitate some options that are not possible
+    when using strict LMTP.
+
+    Some common DSPAM operations are included in this class, custom
+    operations can be built by creating a new LMTP dialog with the
+    low-level LMTP commands.
+
+    DSPAM server setup
+    ==================
+    To use the client to speak with a DSPAM server, the server must be
+    configured to expose a TCP (dspam.conf: ServerHost, ServerPort) or
+    UNIX domain socket (dspam.conf: ServerDomainSocketPath).
+    The server can support mulitple modes (dspam.conf: ServerMode) for
+    interaction with connecting clients. Which mode you need, depends on
+    the operations you need to perform. Most of the time you'll want to
+    use DLMTP though, which means that you'll also need to setup
+    authentication (dspam.conf: ServerPass.<ident>).
+
+    Python DspamClient setup
+    ========================
+    Each DspamClient instance needs to talk to a DSPAM server.
+    You need to specify the socket where DSPAM is listening when creating
+    a new instance. If you need to use DLMTP features (probably most of the
+    time), you also need to pass the ident and password.
+
+    Connections are reused for many transactions. When the server closed the
+    connection in the meantime, the client reconnects before the next
+    transaction, see reconnect().
+
+    Connecting fails after connect_timeout seconds, and waiting for the
+    server to send or accept data fails after read_timeout seconds, with a
+    socket.timeout error. A deadline for a whole transaction can be set
+    with set_deadline().
+
+    """
+
+    # Default configuration
+    reconnect_attempts = 3
+    reconnect_timeout = 10.0
+    connect_timeout = 10.0
+    read_timeout = 60.0
+
+    def __init__(self, socket=None, dlmtp_ident=None, dlmtp_pass=None):
+        super(DspamClient, self).__init__(socket, dlmtp_ident, dlmtp_pass)
+        # Number of times the connection to the server was re-established
+        self.reconnects = 0
+        # Time spent sending the data of the current message
+        self._upload_time = 0.0
+        self.deadline = None
 
     def __del__(self):
         """
@@ -106,105 +709,155 @@ class DspamClient(object):
                     'Fixing missing CRLF before sending data to socket')
                 line = line + '\r\n'
         logger.debug('Client sent: ' + line.rstrip())
-        self._socket.send(line)
+        self._socket.sendall(_bytes(line))
 
-    def _read(self):
+    def _sendall(self, buffers):
         """
-        Read a single response line from the server.
+        Write a list of buffers to the server.
+
+        When the platform supports it, the buffers are written using
+        scatter-gather IO, so they don't need to be joined first.
+
+        Args:
+        buffers -- A list of bytes-like objects to write to the socket.
 
         """
-        line = ''
-        finished = False
-        while not finished:
-            char = self._socket.recv(1)
-            if char == '':
-                return ''
-            elif char == '\r':
-                continue
-            elif char == '\n':
-                finished = True
-                continue
-            else:
-                line = line + char
-        logger.debug('Server sent: ' + line.rstrip())
-        return line
+        if not hasattr(self._socket, 'sendmsg'):
+            self._socket.sendall(_join(buffers))
+            return
+
+        buffers = [memoryview(buf) for buf in buffers if len(buf)]
+        index = 0
+        while index < len(buffers):
+            sent = self._socket.sendmsg(buffers[index:index + _IOV_MAX])
+            while sent:
+                if sent >= len(buffers[index]):
+                    sent -= len(buffers[index])
+                    index += 1
+                else:
+                    # Partial write, continue in the middle of this buffer
+                    buffers[index] = buffers[index][sent:]
+                    sent = 0
 
-    def _peek(self, chars=1):
+    def _command(self, line, check):
         """
-        Peek at the data in the server response.
+        Send a command to the server, and check the server response.
 
-        Peeking should only be done when the response can be predicted.
-        Make sure that the socket will not block by requesting too
-        much data from it while peeking.
+        When the server supports command pipelining, the command is queued
+        instead, and sent together with the next commands by _flush().
 
         Args:
-        chars -- the number of characters to peek.
+        line  -- The command line to send.
+        check -- A callable that validates the server response, and raises
+                 a DspamClientError for invalid responses.
 
         """
-        line = self._socket.recv(chars, socket.MSG_PEEK)
-        logger.debug('Server sent (peek): ' + line.rstrip())
+        if self.pipelining:
+            self._pipeline.append((line, check))
+        else:
+            if self.deadline is not None:
+                self._update_timeout()
+            start = utils.monotonic()
+            self._send(line)
+            check(self._read())
+            phase_histogram.observe(
+                utils.monotonic() - start,
+                (line.split(' ', 1)[0].rstrip().lower(),))
+
+    def _flush(self):
+        """
+        Send all queued commands in a single write, and check the responses.
+
+        The responses for all commands are read, even when one of them fails,
+        so the next command on the connection will see the proper response.
+        When an error occurs after the server accepted the DATA command, the
+        connection can not be used anymore, and is closed.
+
+        """
+        if not self._pipeline:
+            return
+        pipeline = self._pipeline
+        self._pipeline = []
+        if self.deadline is not None:
+            self._update_timeout()
+        start = utils.monotonic()
+
+        buffers = []
+        for line, check in pipeline:
+            logger.debug('Client sent (pipelined): ' + line.rstrip())
+            buffers.append(_bytes(line))
+        self._sendall(buffers)
+
+        error = None
+        for line, check in pipeline:
+            resp = self._read()
+            try:
+                check(resp)
+            except DspamClientError as err:
+                if error is None:
+                    error = err
+        phase_histogram.observe(utils.monotonic() - start, ('pipeline',))
+        if error is not None:
+            if self._in_data:
+                logger.warning(
+                    'Closing connection to DSPAM server after pipelining '
+                    'error in DATA phase')
+                self.close()
+            raise error
+
+    def _read(self):
+        """
+        Read a single response line from the server.
+
+        """
+        line = _native(self._reader.readline()).rstrip('\r\n')
+        logger.debug('Server sent: ' + line)
         return line
 
-    def connect(self):
+    def _read_raw(self):
         """
-        Connect to TCP or domain socket, and process the server LMTP greeting.
+        Read a single line of message data from the server, as bytes.
 
         """
-        # extract proto from socket setting
-        try:
-            (proto, spec) = self.socket.split(':')
-        except ValueError:
-            raise DspamClientError(
-                'Failed to parse DSPAM socket specification, '
-                'no proto found: ' + self.socket)
+        line = self._reader.readline().rstrip(b'\r\n')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Server sent: ' + _native(line))
+        return line
 
-        if proto == 'unix':
-            # connect to UNIX domain socket
-            try:
-                self._socket = socket.socket(
-                    socket.AF_UNIX, socket.SOCK_STREAM)
-                self._socket.connect(spec)
-            except socket.error as err:
-                self._socket = None
-                raise DspamClientError(
-                    'Failed to connect to DSPAM server '
-                    'at socket {}: {}'.format(spec, err))
-            logger.debug('Connected to DSPAM server at socket {}'.format(spec))
+    def connect(self, deadline=None):
+        """
+        Connect to TCP or domain socket, and process the server LMTP greeting.
 
-        elif proto == 'inet' or proto == 'inet6':
-            # connect to TCP socket
-            try:
-                (port, host) = spec.split('@')
-                port = int(port)
-                if host == '':
-                    host = 'localhost'
-            except ValueError:
-                port = int(spec)
-                host = 'localhost'
+        Connecting and waiting for the greeting end at the deadline, and at
+        the deadline set with set_deadline(), if that is earlier than
+        connect_timeout and read_timeout.
 
-            try:
-                self._socket = socket.socket(
-                    socket.AF_INET, socket.SOCK_STREAM)
-                self._socket.connect((host, port))
-            except socket.error as err:
-                self._socket = None
-                raise DspamClientError(
-                    'Failed to connect to DSPAM server at host {} '
-                    'port {}: {}'.format(host, port, err))
-            logger.debug(
-                'Connected to DSPAM server at host {}, port {}'.format(
-                    host, port))
-        else:
-            raise DspamClientError(
-                'Failed to parse DSPAM socket specification, '
-                'unknown proto ' + proto)
+        Args:
+        deadline -- When to give up, as a utils.monotonic() timestamp.
 
-        resp = self._read()
-        if not resp.startswith('220'):
+        """
+        (family, address, description) = self._parse_socket()
+        timeout = self._limit_timeout(self.connect_timeout, deadline)
+        start = utils.monotonic()
+        try:
+            self._socket = socket.socket(family, socket.SOCK_STREAM)
+            self._socket.settimeout(timeout)
+            self._socket.connect(address)
+        except socket.error as err:
+            self._socket = None
             raise DspamClientError(
-                'Unexpected server response at connect: ' + resp)
-
-    def lhlo(self):
+                'Failed to connect to DSPAM server at {}: {}'.format(
+                    description, err))
+        logger.debug('Connected to DSPAM server at {}'.format(description))
+
+        self._reader = LineReader(self._socket)
+        self._update_timeout(deadline)
+        self._check_greeting(self._read())
+        if deadline is not None:
+            self._socket.settimeout(self.read_timeout or None)
+        phase_histogram.observe(utils.monotonic() - start, ('connect',))
+
+    def lhlo(self, deadline=None):
         """
         Send LMTP LHLO greeting, and process the server response.
 
@@ -218,25 +871,31 @@ class DspamClient(object):
         When this capability is detected, the <DspamClient>.dlmtp flag
         will be enabled.
 
-        """
-        if self.dlmtp_ident is not None:
-            host = self.dlmtp_ident
-        else:
-            host = socket.getfqdn()
-        self._send('LHLO ' + host + '\r\n')
+        When the server announces the PIPELINING capability (RFC 2920), the
+        <DspamClient>.pipelining flag will be enabled. The RSET, MAIL FROM,
+        RCPT TO and DATA commands are then sent to the server in a single
+        batch by data(), so errors in the responses to rset(), mailfrom() and
+        rcptto() will be raised from data().
+
+        Like connect(), the greeting ends at the deadline.
 
+        Args:
+        deadline -- When to give up, as a utils.monotonic() timestamp.
+
+        """
+        start = utils.monotonic()
+        limited = deadline is not None or self.deadline is not None
+        if limited:
+            self._update_timeout(deadline)
+        self._send(self._lhlo_command())
         finished = False
         while not finished:
-            resp = self._read()
-            if not resp.startswith('250'):
-                raise DspamClientError(
-                    'Unexpected server response at LHLO: ' + resp)
-            if resp[4:20] == 'DSPAMPROCESSMODE':
-                self.dlmtp = True
-                logger.debug('Detected DLMTP extension in LHLO response')
-            if resp[3] == ' ':
-                # difference between "250-8BITMIME" and "250 SIZE"
-                finished = True
+            if limited and not self._reader.pending():
+                self._update_timeout(deadline)
+            finished = self._check_lhlo(self._read())
+        if deadline is not None:
+            self._socket.settimeout(self.read_timeout or None)
+        phase_histogram.observe(utils.monotonic() - start, ('lhlo',))
 
     def mailfrom(self, sender=None, client_args=None):
         """
@@ -268,29 +927,8 @@ class DspamClient(object):
         client_args -- DSPAM parameters to pass to the server in DLMTP mode.
 
         """
-        if sender and client_args:
-            raise DspamClientError('Arguments are mutually exclusive')
-
-        if client_args and not self.dlmtp:
-            raise DspamClientError(
-                'Cannot send client args, server does not support DLMTP')
-
-        command = 'MAIL FROM:'
-        if not sender:
-            if self.dlmtp_ident and self.dlmtp_pass:
-                sender = self.dlmtp_pass + '@' + self.dlmtp_ident
-            else:
-                sender = ''
-        command = command + '<' + sender + '>'
-
-        if client_args:
-            command = command + ' DSPAMPROCESSMODE="{}"'.format(client_args)
-
-        self._send(command + '\r\n')
-        resp = self._read()
-        if not resp.startswith('250'):
-            raise DspamClientError(
-                'Unexpected server response at MAIL FROM: ' + resp)
+        self._command(self._mailfrom_command(sender, client_args),
+                      self._check_mailfrom)
 
     def rcptto(self, recipients):
         """
@@ -310,28 +948,23 @@ class DspamClient(object):
 
         """
         for rcpt in recipients:
-            self._send('RCPT TO:<{}>\r\n'.format(rcpt))
-            resp = self._read()
-            if not resp.startswith('250'):
-                raise DspamClientError(
-                    'Unexpected server response at RCPT TO for '
-                    'recipient {}: {}'.format(rcpt, resp))
-            self._recipients.append(rcpt)
+            self._command('RCPT TO:<{}>\r\n'.format(rcpt),
+                          functools.partial(self._check_rcptto, rcpt))
 
     def data(self, message):
         """
         Send LMTP DATA command and process the server response.
 
-        The server response is stored as a list of dicts in
+        The server response is stored as a dict of results in
         <DspamClient>.results, keyed on the recipient name(s). Depending
         on the server return data, different formats are available:
         * LMTP mode    -- Dict containing 'accepted', a bool indicating
                           that the message was handed to the server.
-        * Summary mode -- Dict containing 'username', 'result',
-                          'classification', 'probability', 'confidence'
-                          and 'signature'.
+        * Summary mode -- A DspamResult with the user, result, class,
+                          probability, confidence and signature.
         * Stdout mode  -- Dict containing 'result' and 'message', the
-                          complete message payload including added headers.
+                          complete message payload including added headers,
+                          as bytes.
 
         The return data is always parsed and stored, independent of its format.
         If you requested a regular LMTP response, but the server
@@ -349,25 +982,79 @@ class DspamClient(object):
         belongs to the recipient 'foo'. If this relationship needs to be
         guaranteed, send each message with a single recipient in rcptto().
 
+        The message can also be sent in parts, while it is still being
+        received from elsewhere: call data_start(), then data_write() for
+        each part of the message, and data_end() to finish.
+
         args:
-        message -- The full message payload to pass to the server.
+        message -- The full message payload to pass to the server. Bytes
+                   (or a bytearray) are sent as is, text is encoded as UTF-8.
+                   An iterable of chunks, like a MessageBuffer, is sent one
+                   chunk at a time.
 
         """
-        self._send('DATA\r\n')
-        resp = self._read()
-        if not resp.startswith('354'):
-            raise DspamClientError(
-                'Unexpected server response at DATA: ' + resp)
+        self.data_start()
+        if isinstance(message, _buffer_types):
+            # Send message payload and end-of-data in one go
+            buffers = self._encoder.encode(message)
+            buffers.extend(self._encoder.finish())
+            self._send_data(buffers)
+            self._encoder = None
+            self._read_data_response()
+        else:
+            for chunk in message:
+                self.data_write(chunk)
+            self.data_end()
 
-        # Send message payload
-        for line in message.split('\n'):
-            if line == '.':
-                # Dot stuffing
-                line = '..'
-            self._send(line)
+    def data_start(self):
+        """
+        Send LMTP DATA command, to start sending a message in parts.
+
+        """
+        self._command('DATA\r\n', self._check_data)
+        self._flush()
+        self._encoder = DataEncoder()
+        self._upload_time = 0.0
+
+    def data_write(self, data):
+        """
+        Send a part of the message payload, after data_start().
 
-        # Send end-of-data
-        self._send('.\r\n')
+        Args:
+        data -- The next part of the message.
+
+        """
+        self._send_data(self._encoder.encode(data))
+
+    def data_end(self):
+        """
+        Finish sending the message after data_start(), and process the server
+        response. See data() for details on the response.
+
+        """
+        self._send_data(self._encoder.finish())
+        self._encoder = None
+        self._read_data_response()
+
+    def _send_data(self, buffers):
+        if logger.isEnabledFor(logging.DEBUG):
+            for line in _join(buffers).split(b'\r\n')[:-1]:
+                logger.debug('Client sent: ' + _native(line))
+        if self.deadline is not None:
+            self._update_timeout()
+        start = utils.monotonic()
+        self._sendall(buffers)
+        self._upload_time += utils.monotonic() - start
+        data_counter.inc(sum(len(buf) for buf in buffers))
+
+    def _read_data_response(self):
+        """
+        Process the server response at end-of-data.
+
+        """
+        self._in_data = False
+        phase_histogram.observe(self._upload_time, ('upload',))
+        start = utils.monotonic()
 
         # Depending on server configuration, several responses are possible:
         # * Standard LMTP response code, once for each recipient:
@@ -380,149 +1067,182 @@ class DspamClient(object):
         # * Stdout response (--delivery=stdout), once for each recipient:
         #   X-Daemon-Classification: INNOCENT
         #   <complete mail body>
+        #   (after the last message, a single dot is sent)
         #
         # Note that when an unknown recipient is passed in, DSPAM will simply
         #   deliver the message (dspam.conf: (Un)TrustedDeliveryAgent,
         #   DeliveryHost) unaltered and unfiltered. The response for unknown
         #   recipients will still be something indicating 'accepted'.
 
-        peek = self._peek(24)
-        if peek.startswith('250'):
-            # Response is LTMP formatted
-            regex = re.compile('250 \d\.\d\.\d <([^>]+)>')
-            finished = False
-            while not finished:
-                resp = self._read()
-                match = regex.match(resp)
-                if not match:
-                    raise DspamClientError(
-                        'Unexpected server response at END-OF-DATA: ' + resp)
-                rcpt = match.group(1)
-                self.results[rcpt] = {'accepted': True}
-                logger.debug(
-                    'Message accepted for recipient {} in LMTP mode'.format(
-                        rcpt))
-                if len(self.results) == len(self._recipients):
-                    finished = True
-
-        elif peek.startswith('X-DSPAM-Result:'):
-            # Response is in summary format
-            regex = re.compile('X-DSPAM-Result: ([^;]+); result="(\w+)"; '
-                               'class="(\w+)"; probability=([\d\.]+); '
-                               'confidence=([\d\.]+); signature=([\w,/]+)')
-            finished = False
-            while not finished:
-                resp = self._read()
-                match = regex.match(resp)
-                if not match:
-                    raise DspamClientError(
-                        'Unexpected server response at END-OF-DATA: ' + resp)
-                rcpt = match.group(1)
+        parser = DataResponseParser(self._recipients)
+        finished = False
+        while not finished:
+            if self.deadline is not None and not self._reader.pending():
+                self._update_timeout()
+            if parser.mode == parser.STDOUT:
+                # Message data is passed on as is
+                finished = parser.feed(self._read_raw())
+            else:
+                finished = parser.feed(self._read())
+        self.results.update(parser.results)
+        self.response_time = utils.monotonic() - start
+        phase_histogram.observe(self.response_time, ('response',))
+
+    def set_deadline(self, deadline):
+        """
+        Limit the time the next commands may take in total.
 
-                # map results to their DSPAM classification result names
-                fields = ('user', 'result', 'class',
-                          'probability', 'confidence', 'signature')
-                self.results[rcpt] = dict(zip(fields, match.groups()))
-                if self.results[rcpt]['signature'] == 'N/A':
-                    del(self.results[rcpt]['signature'])
+        Before each command and each line of the response to the message
+        data, the socket timeout is lowered to the time left until the
+        deadline. When the deadline has passed, a DeadlineExceededError is
+        raised.
+        The deadline stays in effect until it is reset by passing None.
 
-                logger.debug(
-                    'Message handled for recipient {} in DLMTP summary mode, '
-                    'result is {}'.format(rcpt, match.group(2)))
-                if len(self.results) == len(self._recipients):
-                    # we received responses for all accepted recipients
-                    finished = True
-            # read final dot
-            resp = self._read()
-            if resp != '.':
-                raise DspamClientError(
-                    'Unexpected server response at END-OF-DATA: ' + resp)
-
-        elif peek.startswith('X-Daemon-Classification:'):
-            # Response is in stdout format
-            finished = False
-            message = ''
-            while not finished:
-                resp = self._read()
-                if resp.startswith('X-Daemon-Classification:'):
-                    if message != '':
-                        # A new message body starts, store the previous one
-                        rcpt = self._recipients.pop(0)
-                        self.results[rcpt] = {
-                            'result': result,
-                            'message': message
-                        }
-                        logger.debug(
-                            'Message handled for recipient {} in DLMTP '
-                            'stdout mode, result is {}, message body '
-                            'is {} chars'.format(rcpt, result, len(message)))
-                        message = ''
-                    # Remember next result
-                    result = resp[25:]
-
-                elif resp == '.':
-                    # A single dot can signal end-of-data, or might be just
-                    #   regular mail data.
-                    self._socket.setblocking(False)
-                    try:
-                        # If _peek() succeeds, we did not reach end-of-data yet
-                        #   so it was message content.
-                        peek = self._peek(1)
-                        message = message + '\r\n' + resp
-                    except socket.error:
-                        # reached end-of-data, store message and finish
-                        finished = True
-                        rcpt = self._recipients.pop(0)
-                        # strip final newline
-                        message = message[0:-2]
-                        self.results[rcpt] = {
-                            'result': result,
-                            'message': message
-                        }
-                        logger.debug(
-                            'Message accepted for recipient {} in DLMTP '
-                            'stdout mode, result is {}, message body '
-                            'is {} chars'.format(rcpt, result, len(message)))
-
-                    self._socket.setblocking(True)
+        Args:
+        deadline -- The deadline as a utils.monotonic() timestamp, or None.
 
-                else:
-                    # regular message data
-                    if message == '':
-                        message = resp
-                    else:
-                        message = message + '\r\n' + resp
+        """
+        self.deadline = deadline
+        if deadline is None and self._socket is not None:
+            self._socket.settimeout(self.read_timeout or None)
 
-        else:
-            raise DspamClientError(
-                'Unexpected server response at END-OF-DATA: ' + resp)
+    def _limit_timeout(self, timeout, deadline=None):
+        """
+        Return the socket timeout to use instead of timeout seconds, which is
+        lowered to the time left until deadline, and until the deadline set
+        with set_deadline().
+
+        Raises a DeadlineExceededError when either deadline has passed.
+
+        """
+        if self.deadline is not None and (
+                deadline is None or self.deadline < deadline):
+            deadline = self.deadline
+        if deadline is None:
+            return timeout or None
+        remaining = deadline - utils.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceededError(
+                'Deadline for DSPAM transaction exceeded')
+        if timeout and timeout < remaining:
+            return timeout
+        return remaining
+
+    def _update_timeout(self, deadline=None):
+        self._socket.settimeout(self._limit_timeout(self.read_timeout,
+                                                    deadline))
 
     def rset(self):
         """
         Send LMTP RSET command and process the server response.
 
+        When the connection turns out to be unusable, the client reconnects
+        instead, which leaves it in the same state as a successful RSET.
+
         """
-        self._send('RSET\r\n')
-        resp = self._read()
-        if not resp.startswith('250'):
-            logger.warn('Unexpected server response at RSET: ' + resp)
         self._recipients = []
         self.results = {}
+        if not self.is_alive():
+            logger.info('Connection to DSPAM server was lost, reconnecting')
+            self.reconnect()
+            return
+        self._command('RSET\r\n', self._check_rset)
 
     def quit(self):
         """
         Send LMTP QUIT command, read the server response and disconnect.
 
         """
+        # Commands that are still queued have become useless
+        self._pipeline = []
         self._send('QUIT\r\n')
-        resp = self._read()
-        if not resp.startswith('221'):
-            logger.warning('Unexpected server response at QUIT: ' + resp)
-        self._socket.close()
+        self._check_quit(self._read())
+        self.close()
+
+    def close(self):
+        """
+        Disconnect from the server without sending QUIT.
+
+        """
+        if self._socket:
+            self._socket.close()
         self._socket = None
+        self._reader = None
         self._recipients = []
+        self._pipeline = []
+        self._in_data = False
+        self._encoder = None
         self.results = {}
 
+    def reconnect(self, deadline=None):
+        """
+        Drop the current connection, and connect to the server again.
+
+        A new connection is attempted up to reconnect_attempts times, with a
+        growing delay between attempts, as long as the time spent stays within
+        reconnect_timeout seconds, the deadline, and the deadline set with
+        set_deadline(). The attempts themselves are cut short at that time as
+        well. When all attempts fail, the last error is raised.
+
+        Args:
+        deadline -- When to give up, as a utils.monotonic() timestamp.
+
+        """
+        self.close()
+        budget = utils.monotonic() + self.reconnect_timeout
+        if deadline is None or budget < deadline:
+            deadline = budget
+        if self.deadline is not None and self.deadline < deadline:
+            deadline = self.deadline
+        delay = 0.1
+        attempt = 1
+        while True:
+            try:
+                self.connect(deadline)
+                self.lhlo(deadline)
+            except (DspamClientError, socket.error) as err:
+                self.close()
+                remaining = deadline - utils.monotonic()
+                if attempt >= self.reconnect_attempts or remaining <= 0:
+                    raise
+                # Don't sleep past the deadline
+                delay = min(delay, remaining)
+                logger.warning(
+                    'Failed to reconnect to DSPAM server (attempt {} of {}), '
+                    'retrying in {:.1f}s: {}'.format(
+                        attempt, self.reconnect_attempts, delay, err))
+                time.sleep(delay)
+                delay *= 2
+                attempt += 1
+            else:
+                self.reconnects += 1
+                return
+
+    def is_alive(self):
+        """
+        Check whether the connection to the server is still usable.
+
+        This is a cheap check that does not exchange any data with the
+        server. When the connection is idle, the socket should not be
+        readable: if it is, the server either closed the connection or sent
+        data we did not ask for. In both cases, the connection is unusable.
+
+        """
+        if self._socket is None or self._in_data:
+            return False
+        if self._reader.pending():
+            return False
+        try:
+            if hasattr(select, 'poll'):
+                poller = select.poll()
+                poller.register(self._socket, select.POLLIN)
+                readable = poller.poll(0)
+            else:
+                readable = select.select([self._socket], [], [], 0)[0]
+        except (select.error, ValueError):
+            return False
+        return not readable
+
     def process(self, message, user):
         """
         Process a message.
@@ -539,14 +1259,7 @@ class DspamClient(object):
         self.mailfrom(client_args='--process --deliver=summary')
         self.rcptto((user,))
         self.data(message)
-
-        # check for valid result format
-        if 'class' not in self.results[user]:
-            raise DspamClientError(
-                'Unexpected response format from server at END-OF-DATA, '
-                'an error occured')
-
-        return self.results[user]
+        return self._summary_result(user)
 
     def classify(self, message, user):
         """
@@ -565,14 +1278,7 @@ class DspamClient(object):
         self.mailfrom(client_args='--classify --deliver=summary')
         self.rcptto((user,))
         self.data(message)
-
-        # check for valid result format
-        if 'class' not in self.results[user]:
-            raise DspamClientError(
-                'Unexpected response format from server at END-OF-DATA, '
-                'an error occured')
-
-        return self.results[user]
+        return self._summary_result(user)
 
     def train(self, message, user, class_):
         """
@@ -1,8 +1,11 @@
 import os.path
+import socket
+import time
 
 import pytest
 from flexmock import flexmock
 
+from . import utils
 from .client import *
 
 
@@ -24,29 +27,113 @@ def test_init_with_args(tmpdir):
 
 
 @pytest.mark.parametrize('input,expected', [
-    ('foo\r\n', 'foo\r\n'),
-    ('foo\n', 'foo\r\n'),
-    ('foo', 'foo\r\n'),
-    ('foo\r', 'foo\r\r\n'),
+    ('foo\r\n', b'foo\r\n'),
+    ('foo\n', b'foo\r\n'),
+    ('foo', b'foo\r\n'),
+    ('foo\r', b'foo\r\r\n'),
 ])
 def test_send(input, expected):
     sock = flexmock()
-    sock.should_receive('send').once().with_args(expected)
+    sock.should_receive('sendall').once().with_args(expected)
     c = DspamClient()
     c._socket = sock
     c._send(input)
 
 
+class ScatterSocket(object):
+    """
+    Fake socket that accepts at most a few bytes per sendmsg() call.
+
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = b''
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(memoryview(buf).tobytes() for buf in buffers)[:self.limit]
+        self.data += data
+        return len(data)
+
+
+def test_sendall_scatter_gather():
+    sock = ScatterSocket(limit=5)
+    c = DspamClient()
+    c._socket = sock
+    c._sendall([b'foo\r\n', b'', b'bar baz\r\n', b'.\r\n'])
+    c._socket = None
+    assert sock.data == b'foo\r\nbar baz\r\n.\r\n'
+    assert sock.calls == 4
+
+
+@pytest.mark.parametrize('chunks,expected', [
+    (['foo'], b'foo\r\n.\r\n'),
+    (['foo\n'], b'foo\r\n.\r\n'),
+    (['foo\r\nbar\r\n'], b'foo\r\nbar\r\n.\r\n'),
+    (['.'], b'..\r\n.\r\n'),
+    (['.foo\r\n.\nbar\n..baz'], b'..foo\r\n..\r\nbar\r\n...baz\r\n.\r\n'),
+    (['a\rb'], b'a\rb\r\n.\r\n'),
+    ([b'foo\r', b'\n.bar\r', b'baz'], b'foo\r\n..bar\rbaz\r\n.\r\n'),
+    ([b'foo\n', b'.bar', b'.baz\r'], b'foo\r\n..bar.baz\r\n.\r\n'),
+    ([], b'.\r\n'),
+])
+def test_data_encoder(chunks, expected):
+    encoder = DataEncoder()
+    buffers = []
+    for chunk in chunks:
+        buffers.extend(encoder.encode(chunk))
+    buffers.extend(encoder.finish())
+    assert b''.join(buffers) == expected
+
+
+def test_data_encoder_no_copy():
+    data = b'Subject: test\r\n\r\nfoo\r\n'
+    encoder = DataEncoder()
+    buffers = encoder.encode(data)
+    assert buffers == [data]
+    assert buffers[0] is data
+
+
+def test_data_encoder_bytearray():
+    encoder = DataEncoder()
+    buffers = encoder.encode(bytearray(b'foo\n.bar\xff\r'))
+    buffers.extend(encoder.finish())
+    assert b''.join(bytes(buf) for buf in buffers) == (
+        b'foo\r\n..bar\xff\r\n.\r\n')
+
+
 def test_read():
     sock = flexmock()
     sock.should_receive('recv').and_return(
-        '', 'f', 'o', 'o', '\r', '\n', 'b', 'a', 'r', '\n', 'qux').one_by_one()
+        b'', b'f', b'o', b'o', b'\r', b'\n', b'b', b'a', b'r', b'\n', b'qux').one_by_one()
     c = DspamClient()
-    c._socket = sock
+    c._reader = LineReader(sock)
     assert c._read() == ''
     assert c._read() == 'foo'
     assert c._read() == 'bar'
-    assert c._peek() == 'qux'
+
+
+def test_read_buffered():
+    sock = flexmock()
+    sock.should_receive('recv').once().and_return(
+        b'250-localhost\r\n250-PIPELINING\r\n250 SIZE\r\n')
+    c = DspamClient()
+    c._reader = LineReader(sock)
+    assert c._read() == '250-localhost'
+    assert c._read() == '250-PIPELINING'
+    assert c._read() == '250 SIZE'
+
+
+def test_readline_partial_chunks():
+    sock = flexmock()
+    sock.should_receive('recv').and_return(
+        b'X-DSPAM-Result: foo; re', b'sult="Spam"\r', b'\n.\r\n').one_by_one()
+    reader = LineReader(sock)
+    assert reader.readline() == b'X-DSPAM-Result: foo; result="Spam"\r\n'
+    assert reader.pending() == 3
+    assert reader.readline() == b'.\r\n'
+    assert reader.pending() == 0
 
 
 def test_connect(monkeypatch):
@@ -96,6 +183,7 @@ def test_lhlo():
         .and_return('250 SIZE'))
     c.lhlo()
     assert c.dlmtp is True
+    assert c.pipelining is True
 
 
 def test_lhlo_no_dlmtp():
@@ -193,6 +281,10 @@ def test_rcptto_unexpected_response():
         c.rcptto(('foo'))
 
 
+def assert_sent(buffers, expected):
+    assert b''.join(memoryview(buf).tobytes() for buf in buffers) == expected
+
+
 def test_data_unexpected_response_at_data():
     c = DspamClient()
     flexmock(c).should_receive('_send').once().with_args('DATA\r\n')
@@ -209,10 +301,8 @@ def test_data_dotstuffing():
     flexmock(c).should_receive('_read').and_return(
         '354 Enter mail, end with "." on a line by itself').and_return(
         '250 2.5.0 <foo> Message accepted for delivery')
-    flexmock(c).should_receive('_send').with_args('..')
-    flexmock(c).should_receive('_send').with_args('.\r\n')
-    flexmock(c).should_receive('_peek').once().and_return(
-        '250 2.5.0 <foo> Message ')
+    flexmock(c).should_receive('_sendall').once().replace_with(
+        lambda buffers: assert_sent(buffers, b'..\r\n.\r\n'))
     c.data('.')
 
 
@@ -223,10 +313,8 @@ def test_case_insensitive_recipient_lmtp_mode():
     flexmock(c).should_receive('_read').and_return(
         '354 Enter mail, end with "." on a line by itself').and_return(
         '250 2.5.0 <foo> Message accepted for delivery')
-    flexmock(c).should_receive('_send').with_args('Some message for FOO')
-    flexmock(c).should_receive('_send').with_args('.\r\n')
-    flexmock(c).should_receive('_peek').once().and_return(
-        '250 2.5.0 <foo> Message ')
+    flexmock(c).should_receive('_sendall').once().replace_with(
+        lambda buffers: assert_sent(buffers, b'Some message for FOO\r\n.\r\n'))
     c.data('Some message for FOO')
 
 
@@ -243,10 +331,8 @@ def test_case_insensitive_recipient_summary_mode():
         'X-DSPAM-Result: foo; result="Innocent"; class="Innocent"; '
         'probability=0.4000; confidence=1.00; signature=5328aeee248441704964098').and_return(
         '.')
-    flexmock(c).should_receive('_send').with_args('Some message for FOO')
-    flexmock(c).should_receive('_send').with_args('.\r\n')
-    flexmock(c).should_receive('_peek').once().and_return(
-        'X-DSPAM-Result: foo; res')
+    flexmock(c).should_receive('_sendall').once().replace_with(
+        lambda buffers: assert_sent(buffers, b'Some message for FOO\r\n.\r\n'))
     c.data('Some message for FOO')
 
 
@@ -263,8 +349,352 @@ def test_result_for_different_recipient():
     flexmock(c).should_receive('_read').and_return(
         '354 Enter mail, end with "." on a line by itself').and_return(
         '250 2.5.0 <USER> Message accepted for delivery')
-    flexmock(c).should_receive('_send').with_args('Some message for USER but sent to ALIAS address')
-    flexmock(c).should_receive('_send').with_args('.\r\n')
-    flexmock(c).should_receive('_peek').once().and_return(
-        '250 2.5.0 <USER> Message ')
+    flexmock(c).should_receive('_sendall').once().replace_with(
+        lambda buffers: assert_sent(buffers, b'Some message for USER but sent to ALIAS address\r\n.\r\n'))
     c.data('Some message for USER but sent to ALIAS address')
+
+
+def test_pipelining_batches_commands():
+    c = DspamClient()
+    c.pipelining = True
+    c.dlmtp = True
+    flexmock(c).should_receive('is_alive').and_return(True)
+    c.rset()
+    c.mailfrom(client_args='--classify')
+    c.rcptto(('foo', 'bar'))
+    sent = []
+    flexmock(c).should_receive('_sendall').twice().replace_with(sent.append)
+    (flexmock(c)
+        .should_receive('_read')
+        .and_return('250 2.0.0 OK')
+        .and_return('250 2.1.0 OK')
+        .and_return('250 2.1.5 OK')
+        .and_return('250 2.1.5 OK')
+        .and_return('354 Enter mail, end with "." on a line by itself')
+        .and_return('250 2.6.0 <foo> Message accepted for delivery')
+        .and_return('250 2.6.0 <bar> Message accepted for delivery'))
+    c.data('Some message')
+    assert_sent(sent[0], b'RSET\r\nMAIL FROM:<> DSPAMPROCESSMODE="--classify"\r\n'
+                b'RCPT TO:<foo>\r\nRCPT TO:<bar>\r\nDATA\r\n')
+    assert_sent(sent[1], b'Some message\r\n.\r\n')
+    assert c._recipients == ['foo', 'bar']
+    assert c.results == {'foo': {'accepted': True}, 'bar': {'accepted': True}}
+
+
+def test_pipelining_error_reads_all_responses():
+    c = DspamClient()
+    c.pipelining = True
+    c._socket = flexmock(sendall=lambda data: None, close=lambda: None)
+    c.mailfrom()
+    c.rcptto(('foo', 'bar'))
+    (flexmock(c)
+        .should_receive('_read')
+        .times(4)
+        .and_return('250 2.1.0 OK')
+        .and_return('550 5.1.1 No such user')
+        .and_return('250 2.1.5 OK')
+        .and_return('354 Enter mail, end with "." on a line by itself'))
+    with pytest.raises(DspamClientError) as excinfo:
+        c.data('Some message')
+    assert 'recipient foo' in str(excinfo.value)
+    # the server is waiting for message data, so the connection is dropped
+    assert c._socket is None
+
+
+@pytest.mark.parametrize('capabilities,round_trips', [
+    (('DSPAMPROCESSMODE',), 5),
+    (('PIPELINING', 'DSPAMPROCESSMODE'), 2),
+])
+def test_pipelining_round_trips(dspam_server, capabilities, round_trips):
+    dspam_server.capabilities = list(capabilities)
+    dspam_server.spam_users.add('bar')
+    c = DspamClient(dspam_server.socket, 'foo', 'secret')
+    c.connect()
+    c.lhlo()
+    assert c.pipelining is ('PIPELINING' in capabilities)
+    for i in range(3):
+        before = dspam_server.round_trips
+        results = c.process('Subject: test\r\n\r\n.test\r\n', 'bar')
+        assert dspam_server.round_trips - before == round_trips
+        assert results['class'] == 'Spam'
+    assert dspam_server.messages[-1] == b'Subject: test\r\n\r\n.test'
+    c.quit()
+
+
+def test_data_response_parser_summary():
+    parser = DataResponseParser(['foo', 'bar'])
+    assert parser.feed(
+        'X-DSPAM-Result: foo; result="Spam"; class="Spam"; '
+        'probability=1.0000; confidence=0.85; signature=N/A') is False
+    assert parser.mode == parser.SUMMARY
+    assert parser.feed(
+        'X-DSPAM-Result: bar; result="Innocent"; class="Innocent"; '
+        'probability=0.0023; confidence=1.00; signature=5328aeee248441704964098') is False
+    assert parser.feed('.') is True
+    foo = parser.results['foo']
+    assert (foo.user, foo.result, foo.class_) == ('foo', 'Spam', 'Spam')
+    assert (foo.probability, foo.confidence) == (1.0, 0.85)
+    assert foo.signature is None
+    assert parser.results['bar']['signature'] == '5328aeee248441704964098'
+
+
+def test_dspam_result():
+    result = DspamResult('foo', 'Spam', 'Virus', '0.9900', '1.00', 'N/A')
+    assert result['class'] == result.class_ == 'Virus'
+    assert result['confidence'] == 1.0
+    assert 'confidence' in result
+    assert 'signature' not in result
+    assert result.get('signature') is None
+    with pytest.raises(KeyError):
+        result['signature']
+    with pytest.raises(KeyError):
+        result['foo']
+    assert result.format('probability') == '0.9900'
+    assert result.format('result') == 'Spam'
+    assert str(result) == ('user=foo result=Spam class=Virus '
+                           'probability=0.9900 confidence=1.0000')
+    with pytest.raises(AttributeError):
+        result.foo = 'bar'
+
+
+def test_data_response_parser_lmtp():
+    parser = DataResponseParser(['foo', 'bar'])
+    assert parser.feed('250 2.6.0 <foo> Message accepted for delivery') is False
+    assert parser.feed('250 2.6.0 <bar> Message accepted for delivery') is True
+    assert parser.mode == parser.LMTP
+
+
+@pytest.mark.parametrize('lines', [
+    ['451 4.3.0 Temporary failure'],
+    ['250 2.6.0 <foo> Message accepted for delivery', 'foo'],
+    ['X-DSPAM-Result: foo; result="Spam"; class="Spam"; '
+     'probability=1.0000; confidence=0.85; signature=N/A', 'foo'],
+])
+def test_data_response_parser_unexpected(lines):
+    parser = DataResponseParser(['foo', 'bar'])
+    with pytest.raises(DspamClientError):
+        for line in lines:
+            parser.feed(line)
+
+
+def test_data_response_parser_stdout():
+    parser = DataResponseParser(['foo', 'bar'])
+    assert parser.feed('X-Daemon-Classification: INNOCENT') is False
+    for line in (b'Subject: one', b'', b'..', b'X-Daemon-Classification: SPAM',
+                 b'Subject: two', b'', b'...foo',
+                 b'X-Daemon-Classification: INNOCENT'):
+        assert parser.feed(line) is False
+    assert parser.feed(b'.') is True
+    assert parser.results == {
+        'foo': {
+            'result': 'INNOCENT',
+            'message': b'Subject: one\r\n\r\n.\r\n',
+        },
+        'bar': {
+            'result': 'SPAM',
+            'message': (b'Subject: two\r\n\r\n..foo\r\n'
+                        b'X-Daemon-Classification: INNOCENT\r\n'),
+        },
+    }
+
+
+def test_data_stdout(dspam_server):
+    dspam_server.stdout = True
+    dspam_server.spam_users.add('baz')
+    message = b'Subject: test\r\n\r\n.\r\nfoo\r\n'
+    c = DspamClient(dspam_server.socket, 'foo', 'secret')
+    c.connect()
+    c.lhlo()
+    c.mailfrom(client_args='--classify --deliver=stdout')
+    c.rcptto(('bar', 'baz'))
+    c.data(message)
+    assert c.results == {
+        'bar': {'result': 'INNOCENT', 'message': message},
+        'baz': {'result': 'SPAM', 'message': message},
+    }
+    assert c.is_alive() is True
+    c.quit()
+
+
+def test_data_in_parts(dspam_server):
+    c = DspamClient(dspam_server.socket, 'foo', 'secret')
+    c.connect()
+    c.lhlo()
+    c.mailfrom(client_args='--classify --deliver=summary')
+    c.rcptto(('bar',))
+    c.data_start()
+    assert c.is_alive() is False
+    for part in ('Subject: test\r', '\n\r\n', '.foo\n', 'bar'):
+        c.data_write(part)
+    c.data_end()
+    assert c.results['bar']['class'] == 'Innocent'
+    assert dspam_server.messages[-1] == b'Subject: test\r\n\r\n.foo\r\nbar'
+    assert c.is_alive() is True
+    c.quit()
+
+
+def test_data_non_utf8(dspam_server):
+    message = b'Subject: test\r\n\r\n\xe9t\xe9\r\n\xff'
+    c = DspamClient(dspam_server.socket, 'foo', 'secret')
+    c.connect()
+    c.lhlo()
+    c.mailfrom(client_args='--classify --deliver=summary')
+    c.rcptto(('bar',))
+    c.data(bytearray(message))
+    assert c.results['bar']['class'] == 'Innocent'
+    assert dspam_server.messages[-1] == message
+    c.quit()
+
+
+def test_data_stdout_bytes():
+    chunks = [
+        b'354 Enter mail\r\n',
+        b'X-Daemon-Classification: INNOCENT\r\n'
+        b'Subject: test\r\n\r\n\xe9t\xe9\r\n.\r\n',
+    ]
+
+    def recv(size, flags=0):
+        if not chunks:
+            raise socket.error('Resource temporarily unavailable')
+        return chunks.pop(0)
+
+    sock = flexmock(close=lambda: None, recv=recv)
+    sock.should_receive('sendall')
+    c = DspamClient()
+    c._socket = sock
+    c._reader = LineReader(sock)
+    c._recipients = ['bar']
+    c.data(b'Subject: test\r\n\r\n\xe9t\xe9')
+    assert c.results['bar'] == {
+        'result': 'INNOCENT',
+        'message': b'Subject: test\r\n\r\n\xe9t\xe9\r\n',
+    }
+    c.close()
+
+
+def test_rset_reconnects(dspam_server):
+    c = DspamClient(dspam_server.socket, 'foo', 'secret')
+    assert c.process('Subject: test\r\n\r\ntest', 'bar')['class'] == 'Innocent'
+    dspam_server.drop_connections()
+    time.sleep(0.05)
+    assert c.process('Subject: test\r\n\r\ntest', 'bar')['class'] == 'Innocent'
+    assert c.reconnects == 1
+    assert dspam_server.connections == 2
+    c.quit()
+
+
+def test_reconnect_retries(tmpdir):
+    c = DspamClient('unix:' + str(tmpdir.join('dspam.sock')))
+    c.reconnect_attempts = 3
+    flexmock(time).should_receive('sleep').with_args(0.1).once()
+    flexmock(time).should_receive('sleep').with_args(0.2).once()
+    with pytest.raises(DspamClientError):
+        c.reconnect()
+    assert c.reconnects == 0
+    assert c._socket is None
+
+
+def test_reconnect_timeout(tmpdir):
+    c = DspamClient('unix:' + str(tmpdir.join('dspam.sock')))
+    c.reconnect_timeout = 0
+    flexmock(time).should_receive('sleep').never()
+    with pytest.raises(DspamClientError):
+        c.reconnect()
+
+
+def test_reconnect_deadline(tmpdir):
+    c = DspamClient('unix:' + str(tmpdir.join('dspam.sock')))
+    c.reconnect_attempts = 3
+    flexmock(utils).should_receive('monotonic').and_return(100)
+
+    def sleep(delay):
+        flexmock(utils).should_receive('monotonic').and_return(100 + delay)
+
+    # The sleep is cut short by the deadline, after which the reconnect
+    #   attempts stop
+    c.set_deadline(100.0625)
+    flexmock(time).should_receive('sleep').with_args(
+        0.0625).once().replace_with(sleep)
+    with pytest.raises(DspamClientError):
+        c.reconnect()
+    assert c._socket is None
+
+    c.set_deadline(99)
+    flexmock(time).should_receive('sleep').never()
+    with pytest.raises(DspamClientError):
+        c.reconnect()
+
+
+def test_read_timeout(silent_server):
+    c = DspamClient(silent_server)
+    c.read_timeout = 0.05
+    start = time.time()
+    with pytest.raises(socket.timeout):
+        c.connect()
+    assert time.time() - start < 1
+    c.close()
+
+
+def test_connect_deadline(silent_server):
+    c = DspamClient(silent_server)
+    c.read_timeout = 2
+    start = time.time()
+    with pytest.raises(socket.timeout):
+        c.connect(utils.monotonic() + 0.05)
+    assert time.time() - start < 1
+    c.close()
+
+    with pytest.raises(DspamClientError):
+        c.connect(utils.monotonic() - 1)
+    assert c._socket is None
+
+
+def test_reconnect_timeout_attempt(silent_server):
+    c = DspamClient(silent_server)
+    c.read_timeout = 2
+    c.reconnect_timeout = 0.1
+    start = time.time()
+    with pytest.raises(socket.timeout):
+        c.reconnect()
+    # Each attempt is cut short, and no attempt starts after the timeout
+    assert time.time() - start < 1
+    assert c._socket is None
+
+
+def test_deadline(dspam_server):
+    c = DspamClient(dspam_server.socket, 'foo', 'secret')
+    c.connect()
+    c.lhlo()
+    c.set_deadline(utils.monotonic() - 1)
+    with pytest.raises(DspamClientError):
+        c.mailfrom(client_args='--process --deliver=summary')
+        c.rcptto(['bar'])
+        c.data(b'Subject: test\r\n\r\ntest\r\n')
+    c.close()
+
+
+def test_deadline_slow_server(dspam_server):
+    dspam_server.delay = 0.5
+    c = DspamClient(dspam_server.socket, 'foo', 'secret')
+    c.connect()
+    c.lhlo()
+    c.set_deadline(utils.monotonic() + 0.1)
+    c.mailfrom(client_args='--process --deliver=summary')
+    c.rcptto(['bar'])
+    with pytest.raises(socket.timeout):
+        c.data(b'Subject: test\r\n\r\ntest\r\n')
+    c.close()
+
+
+def test_deadline_reset(dspam_server):
+    c = DspamClient(dspam_server.socket, 'foo', 'secret')
+    c.read_timeout = 5
+    c.connect()
+    c.lhlo()
+    c.pipelining = False
+    c.set_deadline(utils.monotonic() + 1)
+    c.rset()
+    assert c._socket.gettimeout() <= 1
+    c.set_deadline(None)
+    assert c._socket.gettimeout() == 5
+    c.quit()
@@ -0,0 +1,185 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import json
+import logging
+
+from dspam import utils
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+logger = logging.getLogger(__name__)
+
+
+class Config(object):
+    """
+    A snapshot of the options in a configuration file.
+
+    Options are grouped by section, and their values are converted to the
+    type of the default value of the class that the section configures. A
+    Config is not changed after it was created, so it can be shared between
+    threads, and compared to a newer snapshot to find out what changed.
+
+    """
+
+    # Options that are parsed into a dictionary
+    DICT_OPTIONS = ('headers', 'reject_classes', 'quarantine_classes',
+                    'accept_classes')
+
+    def __init__(self, sections=None):
+        """
+        Create a new snapshot.
+
+        Args:
+        sections -- A dictionary that maps section names to dictionaries of
+                    option values.
+
+        """
+        self._sections = {}
+        for section, options in (sections or {}).items():
+            self._sections[section] = dict(options)
+
+    @classmethod
+    def from_file(cls, config_file, section_class_map):
+        """
+        Read and validate a configuration file.
+
+        Unknown sections and options are logged and ignored. Raises an
+        IOError when the file can not be read, and a ValueError when an
+        option has an invalid value.
+
+        Args:
+        config_file       -- The path of the file to read.
+        section_class_map -- A dictionary that maps section names to the
+                             object that holds the defaults for the section.
+
+        """
+        cfg = configparser.RawConfigParser()
+        with open(config_file) as f:
+            try:
+                if hasattr(cfg, 'read_file'):
+                    cfg.read_file(f)
+                else:
+                    cfg.readfp(f)
+            except configparser.Error as err:
+                raise ValueError(str(err))
+
+        sections = {}
+        for section in cfg.sections():
+            try:
+                class_ = section_class_map[section]
+            except KeyError:
+                logger.warning('Config contains unknown section: ' + section)
+                continue
+
+            for option in cfg.options(section):
+                value = cfg.get(section, option)
+                # Kludge: static_user needs to be set on the milter,
+                #   not on the client
+                if section == 'dspam' and option == 'static_user':
+                    sections.setdefault('classification', {})[option] = value
+                    continue
+
+                if not hasattr(class_, option):
+                    logger.warning(
+                        'Config contains unknown option: {}->{}'.format(
+                            section, option))
+                    continue
+
+                default = getattr(class_, option)
+                if option in cls.DICT_OPTIONS:
+                    value = utils.config_str2dict(value)
+                elif value.lower() in ['false', 'no']:
+                    value = False
+                elif value.lower() in ['true', 'yes']:
+                    value = True
+                elif (isinstance(default, (int, float)) and
+                        not isinstance(default, bool)):
+                    # Numeric options get the type of their default value
+                    try:
+                        value = type(default)(value)
+                    except ValueError:
+                        raise ValueError(
+                            'Config contains invalid number for option '
+                            '{}->{}: {}'.format(section, option, value))
+                sections.setdefault(section, {})[option] = value
+
+        loglevel = sections.get('milter', {}).get('loglevel')
+        if (loglevel is not None and
+                not isinstance(getattr(logging, loglevel.upper(), None), int)):
+            raise ValueError(
+                'Config contains unsupported loglevel: ' + loglevel)
+        return cls(sections)
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Create a snapshot from the output of to_json().
+
+        Args:
+        data -- The JSON string.
+
+        """
+        return cls(json.loads(data))
+
+    def to_json(self):
+        """
+        Return the snapshot as a JSON string.
+
+        """
+        return json.dumps(self._sections, sort_keys=True)
+
+    def __eq__(self, other):
+        return (isinstance(other, Config) and
+                self._sections == other._sections)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def sections(self):
+        """
+        Return the names of the sections that have options.
+
+        """
+        return sorted(self._sections)
+
+    def options(self, section):
+        """
+        Return a copy of the options of a section, as a dictionary.
+
+        Args:
+        section -- The name of the section.
+
+        """
+        return dict(self._sections.get(section, {}))
+
+    def changed(self, other, section):
+        """
+        Return whether a section has different options in another snapshot.
+
+        Args:
+        other   -- The snapshot to compare with.
+        section -- The name of the section.
+
+        """
+        return self.options(section) != other.options(section)
+
+    def configure(self, class_, section):
+        """
+        Return a subclass of a class, with the options of a section set as
+        class attributes.
+
+        The class itself is left alone, so objects created from it before
+        keep their configuration.
+
+        Args:
+        class_  -- The class that holds the defaults for the section.
+        section -- The name of the section.
+
+        """
+        return type(class_.__name__, (class_,), self.options(section))
@@ -0,0 +1,112 @@
+import pytest
+
+from .admission import AdmissionControl
+from .backend import BackendPool
+from .breaker import CircuitBreaker
+from .cache import VerdictCache
+from .client import DspamClient
+from .config import Config
+from .pool import DspamClientPool
+
+
+class Defaults(object):
+    socket = 'inet:2424@localhost'
+    timeout = 300
+    ratio = 0.5
+    enabled = False
+    headers = {}
+
+
+SECTIONS = {'test': Defaults, 'dspam': Defaults}
+
+
+def write_config(tmpdir, text):
+    path = tmpdir.join('dspam-milter.cfg')
+    path.write(text)
+    return str(path)
+
+
+def test_from_file(tmpdir):
+    path = write_config(tmpdir, '\n'.join([
+        '[test]',
+        'socket = unix:/run/dspam.sock',
+        'timeout = 60',
+        'ratio = 1',
+        'enabled = yes',
+        'headers = Processed,Result',
+        'unknown = 1',
+        '[dspam]',
+        'static_user = shared',
+        '[unknown]',
+        'foo = bar',
+    ]))
+    config = Config.from_file(path, SECTIONS)
+    assert config.options('test') == {
+        'socket': 'unix:/run/dspam.sock',
+        'timeout': 60,
+        'ratio': 1.0,
+        'enabled': True,
+        'headers': {'Processed': 0, 'Result': 0},
+    }
+    assert isinstance(config.options('test')['ratio'], float)
+    assert config.options('classification') == {'static_user': 'shared'}
+    assert config.sections() == ['classification', 'test']
+
+
+def test_from_file_invalid_number(tmpdir):
+    path = write_config(tmpdir, '[test]\ntimeout = soon\n')
+    with pytest.raises(ValueError):
+        Config.from_file(path, SECTIONS)
+
+
+@pytest.mark.parametrize('class_,option', [
+    (AdmissionControl, 'max_wait'),
+    (CircuitBreaker, 'slow_call_time'),
+    (CircuitBreaker, 'cooldown'),
+    (DspamClient, 'connect_timeout'),
+    (DspamClient, 'read_timeout'),
+    (DspamClientPool, 'checkout_timeout'),
+    (BackendPool, 'ejection_time'),
+    (VerdictCache, 'ttl'),
+])
+def test_from_file_fractional_seconds(tmpdir, class_, option):
+    path = write_config(tmpdir, '[test]\n{} = 0.5\n'.format(option))
+    config = Config.from_file(path, {'test': class_})
+    assert config.options('test') == {option: 0.5}
+
+
+def test_from_file_invalid_loglevel(tmpdir):
+    path = write_config(tmpdir, '[milter]\nloglevel = LOUD\n')
+    with pytest.raises(ValueError):
+        Config.from_file(path, {'milter': type('Milter', (object,), {
+            'loglevel': 'INFO'})})
+
+
+def test_from_file_missing(tmpdir):
+    with pytest.raises(IOError):
+        Config.from_file(str(tmpdir.join('missing.cfg')), SECTIONS)
+
+
+def test_json_roundtrip():
+    config = Config({'test': {'timeout': 60, 'ratio': 0.5,
+                              'headers': {'Result': 0}}})
+    copy = Config.from_json(config.to_json())
+    assert copy == config
+    assert not copy.changed(config, 'test')
+    assert copy.changed(Config(), 'test')
+    assert not copy.changed(Config(), 'other')
+
+
+def test_configure():
+    config = Config({'pool': {'max_size': 3}})
+    pool_class = config.configure(DspamClientPool, 'pool')
+    assert issubclass(pool_class, DspamClientPool)
+    assert pool_class.max_size == 3
+    assert pool_class().max_size == 3
+    assert DspamClientPool.max_size == 10
+
+
+def test_options_are_copies():
+    config = Config({'test': {'timeout': 60}})
+    config.options('test')['timeout'] = 1
+    assert config.options('test') == {'timeout': 60}
@@ -0,0 +1,357 @@
+import functools
+import os.path
+import socket
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from .backend import BackendPool
+from .client import DspamClient
+from .pool import DspamClientPool
+
+# The asyncio client uses syntax that is not available before Python 3.5
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('aioclient_test.py')
+
+
+def make_milter_stub():
+    """
+    Create a stand-in for the Milter module of pymilter, which needs
+    libmilter to be installed.
+
+    It has the parts of the API that the milter uses. Protocol negotiation,
+    Milter.noreply and Milter.nocallback work like they do in pymilter, so
+    the milter can be tested against the protocol options it negotiates.
+
+    """
+    Milter = types.ModuleType('Milter')
+    # Callback responses, actions and protocol options from libmilter
+    Milter.CONTINUE, Milter.REJECT, Milter.DISCARD = 0, 1, 2
+    Milter.ACCEPT, Milter.TEMPFAIL, Milter.NOREPLY = 3, 4, 7
+    Milter.ADDHDRS, Milter.CHGBODY, Milter.ADDRCPT = 0x01, 0x02, 0x04
+    Milter.DELRCPT, Milter.CHGHDRS, Milter.QUARANTINE = 0x08, 0x10, 0x20
+    Milter.CURR_ACTS = 0x1ff
+    Milter.P_NOCONNECT, Milter.P_NOHELO, Milter.P_NOMAIL = 0x01, 0x02, 0x04
+    Milter.P_NORCPT, Milter.P_NOBODY, Milter.P_NOHDRS = 0x08, 0x10, 0x20
+    Milter.P_NOEOH, Milter.P_NR_HDR, Milter.P_NOUNKNOWN = 0x40, 0x80, 0x100
+    Milter.P_NODATA, Milter.P_SKIP, Milter.P_RCPT_REJ = 0x200, 0x400, 0x800
+    Milter.P_NR_CONN, Milter.P_NR_HELO = 0x1000, 0x2000
+    Milter.P_NR_MAIL, Milter.P_NR_RCPT = 0x4000, 0x8000
+    Milter.P_NR_DATA, Milter.P_NR_UNKN = 0x10000, 0x20000
+    Milter.P_NR_EOH, Milter.P_NR_BODY = 0x40000, 0x80000
+    Milter.P_HDR_LEADSPC = 0x100000
+
+    # Callback name: (flag to not reply to it, flag to skip it)
+    optional_callbacks = {
+        'connect': (Milter.P_NR_CONN, Milter.P_NOCONNECT),
+        'hello': (Milter.P_NR_HELO, Milter.P_NOHELO),
+        'envfrom': (Milter.P_NR_MAIL, Milter.P_NOMAIL),
+        'envrcpt': (Milter.P_NR_RCPT, Milter.P_NORCPT),
+        'data': (Milter.P_NR_DATA, Milter.P_NODATA),
+        'unknown': (Milter.P_NR_UNKN, Milter.P_NOUNKNOWN),
+        'eoh': (Milter.P_NR_EOH, Milter.P_NOEOH),
+        'body': (Milter.P_NR_BODY, Milter.P_NOBODY),
+        'header': (Milter.P_NR_HDR, Milter.P_NOHDRS),
+    }
+    ids = [0]
+
+    def uniqueID():
+        ids[0] += 1
+        return ids[0]
+
+    def nocallback(func):
+        def wrapper(self, *args):
+            if func(self, *args) != Milter.CONTINUE:
+                raise RuntimeError('{} return code must be CONTINUE with '
+                                   '@nocallback'.format(func.__name__))
+            return Milter.CONTINUE
+        wrapper.__name__ = func.__name__
+        wrapper.milter_protocol = optional_callbacks[func.__name__][1]
+        return wrapper
+
+    def noreply(func):
+        mask = optional_callbacks[func.__name__][0]
+
+        def wrapper(self, *args):
+            rc = func(self, *args)
+            if self._protocol & mask:
+                if rc != Milter.CONTINUE:
+                    raise RuntimeError('{} return code must be CONTINUE '
+                                       'with @noreply'.format(func.__name__))
+                return Milter.NOREPLY
+            return rc
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.milter_protocol = mask
+        return wrapper
+
+    class Base(object):
+        _actions = Milter.CURR_ACTS
+        _protocol = 0
+
+        @classmethod
+        def protocol_mask(cls):
+            # The protocol options that the milter does not want
+            mask = Milter.P_RCPT_REJ | Milter.P_HDR_LEADSPC
+            for name, (no_reply, skip) in optional_callbacks.items():
+                wanted = getattr(getattr(cls, name), 'milter_protocol', 0)
+                mask |= (no_reply | skip) & ~wanted
+            return mask
+
+        def negotiate(self, opts):
+            self._actions = opts[0]
+            opts[1] = self._protocol = opts[1] & ~self.protocol_mask()
+            opts[2] = 0
+            opts[3] = 0
+            return Milter.CONTINUE
+
+        def getsymval(self, name):
+            return None
+
+    # Callbacks that are not overridden are skipped by the MTA
+    def skipped_callback(name):
+        def callback(self, *args):
+            return Milter.CONTINUE
+        callback.__name__ = name
+        return nocallback(callback)
+
+    for name in optional_callbacks:
+        setattr(Base, name, skipped_callback(name))
+
+    Milter.uniqueID = uniqueID
+    Milter.nocallback = nocallback
+    Milter.noreply = noreply
+    Milter.Base = Base
+    Milter.factory = None
+    Milter.set_flags = lambda flags: None
+    Milter.runmilter = lambda name, socket, timeout: None
+    Milter.milter = types.ModuleType('milter')
+    Milter.milter.main = lambda: None
+    return Milter
+
+
+try:
+    import Milter
+except ImportError:
+    sys.modules['Milter'] = make_milter_stub()
+
+
+class StubDspamServer(threading.Thread):
+    """
+    A minimal DSPAM server that speaks just enough DLMTP for the tests.
+
+    The server listens on a UNIX domain socket. Like a real pipelining
+    server, it collects its responses and only writes them when there is no
+    more client input to process, so round_trips counts the number of times
+    the client had to wait for a response.
+
+    Each message is classified as Innocent, except for users listed in
+    <StubDspamServer>.spam_users. When <StubDspamServer>.stdout is set, the
+    message is returned in stdout mode instead of a summary. Set
+    <StubDspamServer>.delay to simulate the time DSPAM needs to process a
+    message, in seconds per recipient.
+
+    """
+
+    def __init__(self, path, capabilities=('PIPELINING', 'DSPAMPROCESSMODE')):
+        super(StubDspamServer, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.socket = 'unix:' + path
+        self.capabilities = list(capabilities)
+        self.spam_users = set()
+        self.stdout = False
+        self.delay = 0
+        self.round_trips = 0
+        self.connections = 0
+        self.messages = []
+        self._conns = []
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(128)
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self._listener.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            self._conns.append(conn)
+            handler = threading.Thread(target=self.handle, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    def stop(self):
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._listener.close()
+
+    def drop_connections(self):
+        """
+        Close all client connections, like a server timing out idle clients.
+
+        """
+        for conn in self._conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self._conns = []
+
+    def handle(self, conn):
+        state = {'rcpts': [], 'data': None}
+        output = [b'220 DSPAM DLMTP 3.10.2 Authentication Required\r\n']
+        buf = b''
+        while True:
+            try:
+                if output:
+                    self.round_trips += 1
+                    conn.sendall(b''.join(output))
+                    output = []
+                data = conn.recv(65536)
+            except socket.error:
+                # The client went away, for instance after a timeout
+                break
+            if not data:
+                break
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                output.extend(self.respond(line.rstrip(b'\r'), state))
+            if state.get('quit'):
+                conn.sendall(b''.join(output))
+                break
+        conn.close()
+
+    def respond(self, line, state):
+        if state['data'] is not None:
+            if line != b'.':
+                if line.startswith(b'..'):
+                    line = line[1:]
+                state['data'].append(line)
+                return []
+            self.messages.append(b'\r\n'.join(state['data']))
+            state['data'] = None
+            if self.delay:
+                time.sleep(self.delay * len(state['rcpts']))
+            resp = []
+            for rcpt in state['rcpts']:
+                class_ = 'Spam' if rcpt in self.spam_users else 'Innocent'
+                if self.stdout:
+                    resp.append('X-Daemon-Classification: {}\r\n'.format(
+                        class_.upper()).encode('ascii'))
+                    resp.extend(
+                        (b'.' + line if line.startswith(b'.') else line) +
+                        b'\r\n' for line in self.messages[-1].split(b'\r\n'))
+                    continue
+                resp.append(
+                    'X-DSPAM-Result: {0}; result="{1}"; class="{1}"; '
+                    'probability=0.0023; confidence=0.99; '
+                    'signature=5328aeee248441704964098\r\n'.format(
+                        rcpt, class_).encode('ascii'))
+            resp.append(b'.\r\n')
+            return resp
+
+        command = line[:4].upper()
+        if command == b'LHLO':
+            caps = ['localhost'] + self.capabilities + ['8BITMIME', 'SIZE']
+            return [
+                '250{}{}\r\n'.format('-' if i < len(caps) - 1 else ' ',
+                                     cap).encode('ascii')
+                for i, cap in enumerate(caps)]
+        elif command == b'MAIL':
+            state['rcpts'] = []
+            return [b'250 2.1.0 OK\r\n']
+        elif command == b'RCPT':
+            rcpt = line[9:-1].decode('ascii')
+            state['rcpts'].append(rcpt)
+            return [b'250 2.1.5 OK\r\n']
+        elif command == b'DATA':
+            if not state['rcpts']:
+                return [b'503 5.5.1 No valid recipients\r\n']
+            state['data'] = []
+            return [b'354 Enter mail, end with "." on a line by itself\r\n']
+        elif command == b'RSET':
+            state['rcpts'] = []
+            return [b'250 2.0.0 OK\r\n']
+        elif command == b'QUIT':
+            state['quit'] = True
+            return [b'221 2.0.0 Bye\r\n']
+        return [b'500 5.5.2 Unknown command\r\n']
+
+
+@pytest.fixture
+def dspam_server(tmpdir):
+    server = StubDspamServer(os.path.join(str(tmpdir), 'dspam.sock'))
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def dspam_servers(tmpdir):
+    servers = [StubDspamServer(os.path.join(str(tmpdir), name))
+               for name in ('a.sock', 'b.sock')]
+    for server in servers:
+        server.start()
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def silent_server(tmpdir):
+    """
+    Return the socket specification of a server that accepts connections,
+    but never responds.
+
+    """
+    path = str(tmpdir.join('silent.sock'))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(5)
+    yield 'unix:' + path
+    listener.close()
+
+
+@pytest.fixture
+def make_pool():
+    """
+    Return a function that creates a DspamClientPool for the DSPAM server at
+    a socket specification. The pools are closed after the test.
+
+    """
+    pools = []
+
+    def make_pool(socket, min_size=0, max_size=4, **kwargs):
+        pool = DspamClientPool(
+            min_size=min_size, max_size=max_size,
+            factory=functools.partial(DspamClient, socket, 'foo', 'secret'),
+            **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield make_pool
+    for pool in pools:
+        pool.close()
+
+
+@pytest.fixture
+def make_backend_pool(make_pool):
+    """
+    Return a function that creates a BackendPool for the DSPAM servers at
+    a list of socket specifications, with a pool of at most two
+    connections per server.
+
+    """
+    def make_backend_pool(addresses, min_size=0, **kwargs):
+        return BackendPool(addresses, functools.partial(
+            make_pool, min_size=min_size, max_size=2), **kwargs)
+    return make_backend_pool
@@ -0,0 +1,267 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+"""
+Classify a message for many recipients in parallel DSPAM transactions.
+
+DSPAM processes the recipients of a single transaction one after another.
+By splitting the recipients over several transactions on separate
+connections, the work is spread over several DSPAM threads.
+
+"""
+
+import logging
+import signal
+import socket
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from dspam import utils
+from dspam.client import DeadlineExceededError, DspamClientError
+from dspam.prefork import Supervisor
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """
+    A function call that is run by a WorkerPool.
+
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        try:
+            self._result = self.func(*self.args)
+        except Exception:
+            self._error = sys.exc_info()[1]
+        self._done.set()
+
+    def result(self):
+        """
+        Wait for the job to finish, and return its result.
+
+        When the function raised an exception, it is raised here.
+
+        """
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class WorkerPool(object):
+    """
+    A fixed number of threads that run jobs from a shared queue.
+
+    The threads are shared by all SMTP sessions, which bounds the number of
+    DSPAM transactions that run in parallel for the fan-out.
+
+    """
+
+    def __init__(self, size):
+        """
+        Create a new worker pool, and start its threads.
+
+        Args:
+        size -- The number of worker threads.
+
+        """
+        self.size = size
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # Threads inherit the signal mask. Block the signals that libmilter
+        #   waits for in its own thread, so a worker thread can not take one
+        #   and kill the process.
+        mask = None
+        if hasattr(signal, 'pthread_sigmask'):
+            mask = signal.pthread_sigmask(signal.SIG_BLOCK, Supervisor.SIGNALS)
+        try:
+            for i in range(size):
+                thread = threading.Thread(
+                    target=self._work, name='dspam-fanout-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            if mask is not None:
+                signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, func, *args):
+        """
+        Queue a function call, and return its Job.
+
+        After the pool was closed, the call is run right away in the calling
+        thread.
+
+        Args:
+        func -- The function to call.
+        args -- The arguments to pass.
+
+        """
+        job = Job(func, args)
+        with self._lock:
+            if not self._closed:
+                self._queue.put(job)
+                return job
+        job.run()
+        return job
+
+    def close(self):
+        """
+        Stop the worker threads, after the queued jobs have been run.
+
+        """
+        with self._lock:
+            self._closed = True
+            for thread in self._threads:
+                self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+def split_recipients(recipients, parts):
+    """
+    Split recipients into at most parts groups of about the same size.
+
+    Args:
+    recipients -- The list of recipients.
+    parts      -- The maximum number of groups.
+
+    """
+    size = -(-len(recipients) // parts)
+    return [recipients[i:i + size] for i in range(0, len(recipients), size)]
+
+
+def transaction(pool, message, recipients, client_args, deadline=None):
+    """
+    Run a DSPAM transaction for recipients on a client from the pool.
+
+    The client is checked out for the first recipient, so with consistent-hash
+    routing all recipients should belong to the same DSPAM server.
+
+    Returns the results of the transaction.
+
+    Args:
+    pool        -- The DspamClientPool or BackendPool to use.
+    message     -- The message to classify.
+    recipients  -- The recipients to classify the message for.
+    client_args -- The DSPAM arguments for the transaction.
+    deadline    -- When the transaction must be finished, as a
+                   utils.monotonic() timestamp.
+
+    """
+    # Jobs can be queued for a while, don't start them too late
+    if deadline is not None and deadline <= utils.monotonic():
+        raise DeadlineExceededError(
+            'Deadline passed before the DSPAM transaction started')
+    client = pool.get(key=recipients[0], deadline=deadline)
+    try:
+        client.set_deadline(deadline)
+        client.rset()
+        client.mailfrom(client_args=client_args)
+        client.rcptto(recipients)
+        client.data(message)
+    except (DspamClientError, socket.error):
+        pool.put(client, failed=True)
+        raise
+    results = client.results
+    client.set_deadline(None)
+    pool.put(client)
+    return results
+
+
+def classify_recipients(pool, workers, message, recipients, client_args,
+                        parts, deadline=None):
+    """
+    Classify a message for recipients in parallel DSPAM transactions.
+
+    The recipients are split in up to parts groups, which are classified by
+    classify_groups().
+
+    Returns the merged results of all transactions.
+
+    Args:
+    pool        -- The DspamClientPool or BackendPool to use.
+    workers     -- The WorkerPool to run transactions on.
+    message     -- The message to classify.
+    recipients  -- The recipients to classify the message for.
+    client_args -- The DSPAM arguments for the transactions.
+    parts       -- The maximum number of parallel transactions.
+    deadline    -- When the transactions must be finished, as a
+                   utils.monotonic() timestamp.
+
+    """
+    return classify_groups(pool, workers, message,
+                           split_recipients(recipients, parts), client_args,
+                           deadline)
+
+
+def classify_groups(pool, workers, message, groups, client_args,
+                    deadline=None):
+    """
+    Classify a message in a parallel DSPAM transaction for each group of
+    recipients.
+
+    The first group is handled by the calling thread, the others by the
+    worker pool. When any transaction fails, its error is raised after all
+    transactions finished.
+
+    Returns the merged results of all transactions.
+
+    Args:
+    pool        -- The DspamClientPool or BackendPool to use.
+    workers     -- The WorkerPool to run transactions on.
+    message     -- The message to classify.
+    groups      -- The lists of recipients to classify the message for.
+    client_args -- The DSPAM arguments for the transactions.
+    deadline    -- When the transactions must be finished, as a
+                   utils.monotonic() timestamp.
+
+    """
+    jobs = [workers.submit(transaction, pool, message, group, client_args,
+                           deadline)
+            for group in groups[1:]]
+    logger.debug(
+        'Classifying message for {} recipients in {} transactions'.format(
+            sum(len(group) for group in groups), len(groups)))
+
+    results = {}
+    error = None
+    try:
+        results.update(transaction(pool, message, groups[0], client_args,
+                                   deadline))
+    except (DspamClientError, socket.error) as err:
+        error = err
+    for job in jobs:
+        try:
+            results.update(job.result())
+        except (DspamClientError, socket.error) as err:
+            if error is None:
+                error = err
+    if error is not None:
+        raise error
+    return results
@@ -0,0 +1,125 @@
+import signal
+import socket
+import threading
+import time
+
+import pytest
+from flexmock import flexmock
+
+from . import utils
+from .client import DspamClient, DspamClientError
+from .fanout import (WorkerPool, classify_recipients, split_recipients,
+                     transaction)
+
+
+@pytest.mark.parametrize('count,parts,sizes', [
+    (1, 4, [1]),
+    (4, 4, [1, 1, 1, 1]),
+    (10, 4, [3, 3, 3, 1]),
+    (10, 3, [4, 4, 2]),
+    (3, 1, [3]),
+])
+def test_split_recipients(count, parts, sizes):
+    recipients = ['user{}'.format(i) for i in range(count)]
+    groups = split_recipients(recipients, parts)
+    assert [len(group) for group in groups] == sizes
+    assert sum(groups, []) == recipients
+
+
+def test_worker_pool():
+    def divide(a, b):
+        return a / b
+    workers = WorkerPool(2)
+    jobs = [workers.submit(divide, 6, i) for i in (1, 2, 0)]
+    assert jobs[0].result() == 6
+    assert jobs[1].result() == 3
+    with pytest.raises(ZeroDivisionError):
+        jobs[2].result()
+    workers.close()
+
+
+@pytest.mark.skipif(not hasattr(signal, 'pthread_sigmask'),
+                    reason='needs signal.pthread_sigmask')
+def test_worker_pool_blocks_signals():
+    def blocked():
+        return signal.pthread_sigmask(signal.SIG_BLOCK, [])
+    before = blocked()
+    workers = WorkerPool(1)
+    mask = workers.submit(blocked).result()
+    assert {signal.SIGTERM, signal.SIGINT, signal.SIGHUP} <= mask
+    assert blocked() == before
+    workers.close()
+
+
+def test_worker_pool_closed():
+    workers = WorkerPool(1)
+    workers.close()
+    assert workers.submit(lambda: threading.current_thread()).result() is (
+        threading.current_thread())
+
+
+def test_classify_recipients(dspam_server, make_pool):
+    dspam_server.spam_users.add('user3')
+    pool = make_pool(dspam_server.socket)
+    workers = WorkerPool(3)
+    recipients = ['user{}'.format(i) for i in range(10)]
+    results = classify_recipients(
+        pool, workers, b'Subject: test\r\n\r\ntest\r\n', recipients,
+        '--classify --deliver=summary', 4)
+    assert sorted(results) == sorted(recipients)
+    assert [r for r in recipients if results[r]['class'] == 'Spam'] == ['user3']
+    assert len(dspam_server.messages) == 4
+    assert pool.stats()['in_use'] == 0
+    workers.close()
+    pool.close()
+
+
+def test_classify_recipients_error(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket)
+    workers = WorkerPool(2)
+    # The server refuses DATA when RCPT TO is missing
+    flexmock(DspamClient).should_receive('rcptto').and_return(None)
+    with pytest.raises(DspamClientError):
+        classify_recipients(
+            pool, workers, b'Subject: test\r\n\r\ntest\r\n', ['foo', 'bar'],
+            '--classify --deliver=summary', 2)
+    stats = pool.stats()
+    assert stats['in_use'] == 0
+    assert stats['discards'] == 2
+    workers.close()
+    pool.close()
+
+
+def test_classify_recipients_deadline(dspam_server, make_pool):
+    dspam_server.delay = 0.5
+    pool = make_pool(dspam_server.socket)
+    workers = WorkerPool(2)
+    with pytest.raises(socket.error):
+        classify_recipients(
+            pool, workers, b'Subject: test\r\n\r\ntest\r\n', ['foo', 'bar'],
+            '--classify --deliver=summary', 2, utils.monotonic() + 0.1)
+    assert pool.stats()['discards'] == 2
+    workers.close()
+    pool.close()
+
+
+def test_transaction_deadline(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket)
+    pool.checkout_timeout = 5
+    message = b'Subject: test\r\n\r\ntest\r\n'
+    with pytest.raises(DspamClientError):
+        transaction(pool, message, ['foo'], '--classify --deliver=summary',
+                    utils.monotonic() - 1)
+    assert pool.stats()['checkouts'] == 0
+
+    # Waiting for a connection stops at the deadline
+    busy = [pool.get() for i in range(4)]
+    start = time.time()
+    with pytest.raises(DspamClientError):
+        transaction(pool, message, ['foo'], '--classify --deliver=summary',
+                    utils.monotonic() + 0.1)
+    elapsed = time.time() - start
+    for client in busy:
+        pool.put(client)
+    assert elapsed < 1
+    pool.close()
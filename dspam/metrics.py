@@ -0,0 +1,410 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+"""
+Counters, gauges and latency histograms, exposed in the Prometheus text format.
+
+Metrics are registered in a Registry when they are created. Updating a
+metric takes a lock and a few integer operations, so they can be updated
+for every message and DSPAM command. The MetricsServer serves the metrics
+of a registry over HTTP, on a TCP or UNIX domain socket.
+
+"""
+
+import bisect
+import logging
+import os
+import socket
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from 1 ms to 10 seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                              .replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+class Registry(object):
+    """
+    A collection of metrics, that are rendered together.
+
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric to the registry.
+
+        Args:
+        metric -- The Counter or Histogram to add.
+
+        """
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text format.
+
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        return ''.join(metric.render() for metric in metrics)
+
+
+# The registry for the metrics of the milter and the DSPAM client
+REGISTRY = Registry()
+
+
+class Counter(object):
+    """
+    A value that only goes up, optionally split by labels.
+
+    """
+
+    def __init__(self, name, description, labels=(), registry=REGISTRY):
+        """
+        Create a new counter, and register it.
+
+        Args:
+        name        -- The metric name.
+        description -- The help text of the metric.
+        labels      -- The names of the labels of the counter.
+        registry    -- The registry to add the counter to.
+
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, amount=1, labels=()):
+        """
+        Increase the counter.
+
+        Args:
+        amount -- The amount to add.
+        labels -- The label values, in the order of the label names.
+
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """
+        Return the current value for the label values.
+
+        """
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ['# HELP {} {}\n'.format(self.name, self.description),
+                 '# TYPE {} counter\n'.format(self.name)]
+        if not values and not self.labels:
+            values = [((), 0)]
+        for labels, value in values:
+            lines.append('{}{} {}\n'.format(
+                self.name, _format_labels(self.labels, labels),
+                _format_value(value)))
+        return ''.join(lines)
+
+
+class Gauge(object):
+    """
+    A value that goes up and down, optionally split by labels.
+
+    """
+
+    def __init__(self, name, description, labels=(), registry=REGISTRY):
+        """
+        Create a new gauge, and register it.
+
+        Args:
+        name        -- The metric name.
+        description -- The help text of the metric.
+        labels      -- The names of the labels of the gauge.
+        registry    -- The registry to add the gauge to.
+
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def set(self, value, labels=()):
+        """
+        Set the gauge to a value.
+
+        Args:
+        value  -- The new value.
+        labels -- The label values, in the order of the label names.
+
+        """
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        """
+        Increase the gauge, use a negative amount to decrease it.
+
+        Args:
+        amount -- The amount to add.
+        labels -- The label values, in the order of the label names.
+
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """
+        Return the current value for the label values.
+
+        """
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ['# HELP {} {}\n'.format(self.name, self.description),
+                 '# TYPE {} gauge\n'.format(self.name)]
+        if not values and not self.labels:
+            values = [((), 0)]
+        for labels, value in values:
+            lines.append('{}{} {}\n'.format(
+                self.name, _format_labels(self.labels, labels),
+                _format_value(value)))
+        return ''.join(lines)
+
+
+class Histogram(object):
+    """
+    A distribution of observed values over fixed buckets, optionally split
+    by labels.
+
+    Each observation increments one bucket, the cumulative counts that
+    Prometheus expects are computed when rendering.
+
+    """
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        """
+        Create a new histogram, and register it.
+
+        Args:
+        name        -- The metric name.
+        description -- The help text of the metric.
+        labels      -- The names of the labels of the histogram.
+        buckets     -- The sorted upper bounds of the buckets, an extra +Inf
+                       bucket is always added.
+        registry    -- The registry to add the histogram to.
+
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(float(bound) for bound in buckets)
+        # Maps label values to a list of bucket counts, and their sum
+        self._series = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, labels=()):
+        """
+        Add an observation.
+
+        Args:
+        value  -- The observed value.
+        labels -- The label values, in the order of the label names.
+
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, labels=()):
+        """
+        Return the number of observations for the label values.
+
+        """
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[0]) if series is not None else 0
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, list(counts), total)
+                            for labels, (counts, total)
+                            in self._series.items())
+        lines = ['# HELP {} {}\n'.format(self.name, self.description),
+                 '# TYPE {} histogram\n'.format(self.name)]
+        bounds = self.buckets + (float('inf'),)
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}\n'.format(
+                    self.name, _format_labels(
+                        self.labels, labels,
+                        'le="{}"'.format(_format_value(bound))),
+                    cumulative))
+            label_str = _format_labels(self.labels, labels)
+            lines.append('{}_sum{} {}\n'.format(
+                self.name, label_str, _format_value(total)))
+            lines.append('{}_count{} {}\n'.format(
+                self.name, label_str, cumulative))
+        return ''.join(lines)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # UNIX domain sockets have no client address
+        return str(self.client_address[0]) if self.client_address else '-'
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request: ' + format % args)
+
+
+class _TCPMetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixMetricsServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        UnixStreamServer.server_bind(self)
+        # Attributes that BaseHTTPRequestHandler expects
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class MetricsServer(object):
+    """
+    Serve the metrics of a registry over HTTP in a background thread.
+
+    """
+
+    def __init__(self, address, registry=REGISTRY):
+        """
+        Create a new server, and start listening.
+
+        The address is given in the same form as the milter socket:
+        unix:PATH or inet:PORT[@HOST]. Raises a ValueError for invalid
+        addresses, and a socket.error when listening fails.
+
+        Args:
+        address  -- Where to listen for requests.
+        registry -- The registry with the metrics to serve.
+
+        """
+        proto, sep, spec = address.partition(':')
+        if proto == 'unix' and spec:
+            self._server = _UnixMetricsServer(spec, _MetricsHandler)
+        elif proto in ('inet', 'inet6') and spec:
+            port, sep, host = spec.partition('@')
+            try:
+                port = int(port)
+            except ValueError:
+                raise ValueError('Invalid metrics address: ' + address)
+            server_class = _TCPMetricsServer
+            if proto == 'inet6':
+                server_class = type('_TCP6MetricsServer', (server_class,),
+                                    {'address_family': socket.AF_INET6})
+            self._server = server_class((host or 'localhost', port),
+                                        _MetricsHandler)
+        else:
+            raise ValueError('Invalid metrics address: ' + address)
+        self.address = address
+        self._server.registry = registry
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='dspam-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info('Serving metrics on {}'.format(address))
+
+    @property
+    def server_address(self):
+        """
+        The address the server is bound to.
+
+        """
+        return self._server.server_address
+
+    def close(self):
+        """
+        Stop serving, and close the listening socket.
+
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if isinstance(self._server, _UnixMetricsServer):
+            try:
+                os.unlink(self._server.server_address)
+            except OSError:
+                pass
@@ -0,0 +1,137 @@
+import os
+import socket
+
+import pytest
+
+from .client import DspamClient, phase_histogram
+from .metrics import Counter, Gauge, Histogram, MetricsServer, Registry
+
+
+def http_get(sock, path='/metrics'):
+    sock.sendall('GET {} HTTP/1.0\r\n\r\n'.format(path).encode('ascii'))
+    data = b''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+    headers, body = data.split(b'\r\n\r\n', 1)
+    return headers.decode('ascii'), body.decode('utf-8')
+
+
+def test_counter():
+    registry = Registry()
+    counter = Counter('test_total', 'A test counter', registry=registry)
+    assert registry.render() == (
+        '# HELP test_total A test counter\n'
+        '# TYPE test_total counter\n'
+        'test_total 0\n')
+    counter.inc()
+    counter.inc(2)
+    assert counter.value() == 3
+    assert registry.render().endswith('test_total 3\n')
+
+
+def test_counter_labels():
+    registry = Registry()
+    counter = Counter('test_total', 'A test counter', labels=('action',),
+                      registry=registry)
+    counter.inc(labels=('reject',))
+    counter.inc(labels=('accept',))
+    counter.inc(labels=('say "hi"\n',))
+    assert registry.render().split('\n')[2:] == [
+        'test_total{action="accept"} 1',
+        'test_total{action="reject"} 1',
+        'test_total{action="say \\"hi\\"\\n"} 1',
+        '',
+    ]
+
+
+def test_gauge():
+    registry = Registry()
+    gauge = Gauge('test_depth', 'A test gauge', registry=registry)
+    gauge.inc(3)
+    gauge.inc(-1)
+    assert gauge.value() == 2
+    gauge.set(0.5)
+    assert registry.render() == (
+        '# HELP test_depth A test gauge\n'
+        '# TYPE test_depth gauge\n'
+        'test_depth 0.5\n')
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = Histogram('test_seconds', 'A test histogram',
+                          labels=('phase',), buckets=(0.1, 1),
+                          registry=registry)
+    histogram.observe(0.05, ('connect',))
+    histogram.observe(0.1, ('connect',))
+    histogram.observe(0.5, ('connect',))
+    histogram.observe(5, ('connect',))
+    assert histogram.count(('connect',)) == 4
+    assert histogram.count(('lhlo',)) == 0
+    assert registry.render() == (
+        '# HELP test_seconds A test histogram\n'
+        '# TYPE test_seconds histogram\n'
+        'test_seconds_bucket{phase="connect",le="0.1"} 2\n'
+        'test_seconds_bucket{phase="connect",le="1.0"} 3\n'
+        'test_seconds_bucket{phase="connect",le="+Inf"} 4\n'
+        'test_seconds_sum{phase="connect"} 5.65\n'
+        'test_seconds_count{phase="connect"} 4\n')
+
+
+def test_client_phases(dspam_server):
+    before = dict((phase, phase_histogram.count((phase,))) for phase in (
+        'connect', 'lhlo', 'upload', 'response'))
+    client = DspamClient(dspam_server.socket, 'foo', 'secret')
+    client.connect()
+    client.lhlo()
+    client.mailfrom(client_args='--process --deliver=summary')
+    client.rcptto(['bar'])
+    client.data(b'Subject: test\r\n\r\ntest\r\n')
+    client.quit()
+    for phase in before:
+        assert phase_histogram.count((phase,)) == before[phase] + 1
+
+
+def test_server_unix(tmpdir):
+    registry = Registry()
+    Counter('test_total', 'A test counter', registry=registry).inc()
+    path = str(tmpdir.join('metrics.sock'))
+    server = MetricsServer('unix:' + path, registry)
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        headers, body = http_get(sock)
+        assert headers.startswith('HTTP/1.0 200')
+        assert 'text/plain; version=0.0.4' in headers
+        assert body == registry.render()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        headers, body = http_get(sock, '/other')
+        assert headers.startswith('HTTP/1.0 404')
+    finally:
+        server.close()
+    assert not os.path.exists(path)
+
+
+def test_server_inet():
+    registry = Registry()
+    Counter('test_total', 'A test counter', registry=registry)
+    server = MetricsServer('inet:0@127.0.0.1', registry)
+    try:
+        sock = socket.create_connection(server.server_address)
+        headers, body = http_get(sock)
+        assert headers.startswith('HTTP/1.0 200')
+        assert 'test_total 0' in body
+    finally:
+        server.close()
+
+
+@pytest.mark.parametrize('address', ['tcp:9125', 'inet:x@localhost', 'unix:'])
+def test_server_invalid_address(address):
+    with pytest.raises(ValueError):
+        MetricsServer(address)
@@ -5,24 +5,54 @@
 
 import argparse
 import datetime
+import functools
+import hashlib
+import json
 import logging
 import os.path
-import re
+import signal
 import sys
+import threading
 import time
 from pkg_resources import resource_string
 
 import Milter
 
-from dspam import VERSION, utils
+from dspam import VERSION, metrics, utils
 from dspam.client import *
-
-if sys.version_info >= (3,):
-    import configparser
-else:
-    import ConfigParser as configparser
+from dspam.client import _bytes
+from dspam.admission import AdmissionControl
+from dspam.backend import BackendPool, split_addresses
+from dspam.breaker import CircuitBreaker
+from dspam.buffer import MessageBuffer
+from dspam.bypass import BypassRules
+from dspam.cache import VerdictCache
+from dspam.config import Config
+from dspam.fanout import WorkerPool, classify_groups, split_recipients
+from dspam.pool import DspamClientPool, PoolTimeoutError
+from dspam.prefork import Supervisor, worker_address
+from dspam.rcptmap import RecipientMap, strip_extension
+from dspam.truncate import MimeTruncator
 
 logger = logging.getLogger(__name__)
+transaction_logger = logging.getLogger(__name__ + '.transaction')
+
+# Time spent on each message: receiving headers and body from the MTA,
+#   classification (dspam), changing the message (modify), and in total
+phase_histogram = metrics.Histogram(
+    'dspam_milter_phase_seconds',
+    'Time spent in each phase of message handling', labels=('phase',))
+messages_counter = metrics.Counter(
+    'dspam_milter_messages_total',
+    'Messages handled, by milter response', labels=('action',))
+verdicts_counter = metrics.Counter(
+    'dspam_milter_verdicts_total',
+    'Verdicts for classified messages', labels=('verdict',))
+errors_counter = metrics.Counter(
+    'dspam_milter_errors_total',
+    'Messages that could not be classified because of DSPAM errors')
+body_bytes_counter = metrics.Counter(
+    'dspam_milter_body_bytes_total', 'Message body data received from the MTA')
 
 
 class DspamMilter(Milter.Base):
@@ -40,6 +70,22 @@ class DspamMilter(Milter.Base):
     VERDICT_QUARANTINE = 2
     VERDICT_REJECT = 3
 
+    # Names of milter responses in transaction records
+    RESPONSE_NAMES = {
+        Milter.ACCEPT: 'accept',
+        Milter.REJECT: 'reject',
+        Milter.TEMPFAIL: 'tempfail',
+    }
+
+    # Headers that are part of the message fingerprint for the verdict cache,
+    #   besides the body. Trace headers differ for each delivery attempt.
+    FINGERPRINT_HEADERS = frozenset(['from', 'to', 'cc', 'subject', 'date',
+                                     'message-id'])
+
+    # Milter actions used at end-of-message, other actions are not requested
+    #   from the MTA.
+    ACTIONS = Milter.ADDHDRS | Milter.CHGHDRS | Milter.QUARANTINE
+
     # Default configuration
     static_user = None
     headers = {
@@ -54,6 +100,37 @@ class DspamMilter(Milter.Base):
     quarantine_classes = {'Virus': 0}
     accept_classes = {'Innocent': 0, 'Whitelisted': 0}
     recipient_delimiter = '+'
+    recipient_map = None
+    streaming = False
+    spool_size = 1048576
+    spool_dir = None
+    max_body_size = 0
+    skip_size = 0
+    fanout = 0
+    fanout_workers = 8
+
+    # The process-wide pool of DSPAM connections, set up by DspamMilterDaemon
+    pool = None
+    # The process-wide worker threads for fan-out, set up by DspamMilterDaemon
+    workers = None
+    # The RecipientMap loaded from recipient_map, set up by DspamMilterDaemon
+    rcptmap = None
+    # The process-wide VerdictCache, set up by DspamMilterDaemon
+    cache = None
+    # The BypassRules from the bypass section, set up by DspamMilterDaemon
+    bypass = None
+    # The CircuitBreaker for DSPAM calls, set up by DspamMilterDaemon
+    breaker = None
+    # The AdmissionControl for DSPAM calls, set up by DspamMilterDaemon
+    admission = None
+    # Seconds DSPAM may take for a message at end-of-message, derived from
+    #   the milter timeout by DspamMilterDaemon
+    message_timeout = 0
+
+    # Number of messages that were classified in full, classified after
+    #   truncating the body, or not classified because of their size
+    size_stats = {'full': 0, 'truncated': 0, 'skipped': 0}
+    _stats_lock = threading.Lock()
 
     def __init__(self):
         """
@@ -61,42 +138,125 @@ class DspamMilter(Milter.Base):
 
         """
         self.id = Milter.uniqueID()
-        self.message = ''
+        self.message = MessageBuffer(self.spool_size, self.spool_dir)
         self.recipients = []
+        self.recipient_set = set()
         self.dspam = None
+        self.dspam_error = None
+        self.admitted = 0
         self.remove_headers = []
-        if self.recipient_delimiter:
-            self.recipient_delimiter_re = re.compile('[{}][^@]*'.format(
-                re.escape(self.recipient_delimiter)))
-        else:
-            self.recipient_delimiter_re = None
+        self.content_type = b''
+        self.body_size = 0
+        self.truncator = None
+        self.skipped = False
+        self.bypassed = False
+        self.fingerprint = hashlib.sha256()
+        self.client_ip = None
+        self.client_port = None
+        self.time_start = time.time()
+        self.time_message = None
+        self.time_eoh = None
+        self.record = None
+
+    def negotiate(self, opts):
+        """
+        Negotiate protocol steps and actions with the MTA.
+
+        The MTA skips the callbacks that are not implemented, and does not
+        wait for a reply to callbacks decorated with Milter.noreply. Only the
+        actions in ACTIONS are requested.
+
+        Bypass rules need a reply to connect when they match clients, and
+        envfrom is only called when they match senders.
 
+        """
+        offered = opts[1]
+        rc = Milter.Base.negotiate(self, opts)
+        if rc == Milter.CONTINUE:
+            opts[0] = self._actions = self._actions & self.ACTIONS
+            if self.bypass is not None and len(self.bypass.networks):
+                opts[1] &= ~Milter.P_NR_CONN
+            if self.bypass is None or not (
+                    self.bypass.authenticated or len(self.bypass.sender_map)):
+                opts[1] |= offered & Milter.P_NOMAIL
+            self._protocol = opts[1]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    '<{}> Negotiated actions {:#x} and protocol {:#x}'.format(
+                        self.id, opts[0], opts[1]))
+        return rc
+
+    @Milter.noreply
     def connect(self, hostname, family, hostaddr):
         """
-        Log new connections.
+        Log new connections, and accept bypassed clients.
 
         """
         self.client_ip = hostaddr[0]
         self.client_port = hostaddr[1]
         self.time_start = time.time()
-        logger.debug('<{}> Connect from {}[{}]:{}'.format(
-            self.id, hostname, self.client_ip, self.client_port))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('<{}> Connect from {}[{}]:{}'.format(
+                self.id, hostname, self.client_ip, self.client_port))
+        if self.bypass is not None and self.bypass.match_client(
+                self.client_ip):
+            logger.info(
+                '<{}> Accepting connection from {} without '
+                'classification'.format(self.id, self.client_ip))
+            return Milter.ACCEPT
         return Milter.CONTINUE
 
+    def envfrom(self, mailfrom, *params):
+        """
+        Accept messages from bypassed senders and authenticated clients.
+
+        """
+        if self.bypass is None:
+            return Milter.CONTINUE
+        sender = mailfrom
+        if sender.startswith('<'):
+            sender = sender[1:]
+        if sender.endswith('>'):
+            sender = sender[:-1]
+        if self.bypass.match_sender(sender, self.getsymval('{auth_authen}')):
+            logger.info(
+                '<{}> Accepting message from {} without '
+                'classification'.format(self.id, sender or '<>'))
+            return Milter.ACCEPT
+        return Milter.CONTINUE
+
+    @Milter.noreply
     def envrcpt(self, rcpt, *params):
         """
         Send all recipients to DSPAM.
 
+        Recipients are mapped to DSPAM users with the recipient map, and
+        recipients that map to the same DSPAM user are classified once.
+
         """
         if rcpt.startswith('<'):
             rcpt = rcpt[1:]
         if rcpt.endswith('>'):
             rcpt = rcpt[:-1]
-        if self.recipient_delimiter_re:
-            rcpt = self.recipient_delimiter_re.sub('', rcpt)
-        if rcpt not in self.recipients:
-            self.recipients.append(rcpt)
-            logger.debug('<{}> Received RCPT {}'.format(self.id, rcpt))
+        if self.recipient_delimiter:
+            rcpt = strip_extension(rcpt, self.recipient_delimiter)
+        if self.time_message is None:
+            self.time_message = utils.monotonic()
+        if self.bypass is not None and self.bypass.match_recipient(rcpt):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('<{}> Received RCPT {}, not classified'.format(
+                    self.id, rcpt))
+            return Milter.CONTINUE
+        if self.rcptmap is not None:
+            user = self.rcptmap.lookup(rcpt)
+        else:
+            user = rcpt
+        if user not in self.recipient_set:
+            self.recipient_set.add(user)
+            self.recipients.append(user)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('<{}> Received RCPT {}, DSPAM user {}'.format(
+                    self.id, rcpt, user))
         return Milter.CONTINUE
 
     @Milter.noreply
@@ -109,12 +269,19 @@ class DspamMilter(Milter.Base):
         about to add are deleted.
 
         """
-        self.message += "{}: {}\r\n".format(name, value)
-        logger.debug('<{}> Received {} header'.format(self.id, name))
+        line = _bytes('{}: {}\r\n'.format(name, value))
+        self.message.write(line)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('<{}> Received {} header'.format(self.id, name))
+        if self.cache is not None and name.lower() in self.FINGERPRINT_HEADERS:
+            self.fingerprint.update(line)
+        if name.lower() == 'content-type':
+            self.content_type = _bytes(value)
         if name.lower().startswith(self.header_prefix.lower()):
             self.remove_headers.append(name)
-            logger.debug('<{}> Going to remove {} header'.format(
-                self.id, name))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('<{}> Going to remove {} header'.format(
+                    self.id, name))
         return Milter.CONTINUE
 
     @Milter.noreply
@@ -122,19 +289,87 @@ class DspamMilter(Milter.Base):
         """
         Store end of message headers.
 
+        In streaming mode, the DSPAM transaction is started here, and the
+        message headers are sent right away. When this fails, the message is
+        buffered, and sent to DSPAM at end-of-message.
+
+        When all recipients are bypassed, the message is not buffered at all.
+
         """
-        self.message += "\r\n"
+        self.time_eoh = utils.monotonic()
+        if self.bypass is not None and not self.recipients:
+            self.bypassed = True
+            self.message.close()
+            return Milter.CONTINUE
+        self.message.write(b'\r\n')
+        if self.max_body_size:
+            self.truncator = MimeTruncator(
+                self.max_body_size * 1024, self.content_type)
+        # Streaming holds a turn of admission control until end-of-message,
+        #   so only start it when that needs no wait.
+        # A single transaction is streamed, so recipients that are routed to
+        #   different DSPAM servers are classified at end-of-message.
+        if (self.streaming and (self.breaker is None or
+                                self.breaker.state == self.breaker.CLOSED) and
+                len(self.route()) == 1 and self.admit(0)):
+            try:
+                # Don't hold up the MTA when the pool has no connection
+                #   available
+                self.open_dspam_transaction(timeout=0)
+                self.dspam.data_start()
+                for chunk in self.message:
+                    self.dspam.data_write(chunk)
+            except (DspamClientError, socket.error) as err:
+                logger.warning(
+                    '<{}> Failed to start streaming message to DSPAM, '
+                    'buffering it instead: {}'.format(self.id, err))
+                self.release_dspam(discard=True,
+                                   failed=self.dspam_failed(err))
+            else:
+                self.message.close()
         return Milter.CONTINUE
 
     @Milter.noreply
     def body(self, block):
         """
-        Store message body.
+        Store message body, or send it to DSPAM in streaming mode.
+
+        Only the first max_body_size kilobytes of the body are sent to DSPAM.
+        When the body grows beyond skip_size kilobytes, the message is not
+        classified at all.
 
         """
-        self.message += block
-        logger.debug('<{}> Received {} bytes of message body'.format(
-            self.id, len(block)))
+        self.body_size += len(block)
+        if self.skipped or self.bypassed:
+            return Milter.CONTINUE
+        if self.skip_size and self.body_size > self.skip_size * 1024:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    '<{}> Message body exceeds {} KB, skipping '
+                    'classification'.format(self.id, self.skip_size))
+            self.skipped = True
+            self.release_dspam(discard=True)
+            self.message.close()
+            return Milter.CONTINUE
+
+        data = _bytes(block)
+        if self.truncator is not None:
+            data = self.truncator.feed(data)
+            if not data:
+                return Milter.CONTINUE
+        if self.cache is not None:
+            self.fingerprint.update(data)
+        if self.dspam is not None:
+            try:
+                self.dspam.data_write(data)
+            except (DspamClientError, socket.error) as err:
+                self.dspam_error = err
+                self.release_dspam(failed=True)
+        elif self.dspam_error is None:
+            self.message.write(data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('<{}> Received {} bytes of message body'.format(
+                self.id, len(block)))
         return Milter.CONTINUE
 
     def eom(self):
@@ -147,105 +382,453 @@ class DspamMilter(Milter.Base):
         recipients will be passed to DSPAM, and the final decision is based on
         the least invasive result in all their classification results.
 
+        When <DspamMilter>.fanout is set, the recipients are split over up to
+        that many DSPAM transactions, which are processed in parallel. When
+        recipients are routed to different DSPAM servers, each server gets
+        its own transactions, which are also processed in parallel.
+
+        With admission control, the message waits for a turn per DSPAM
+        transaction before it is sent to DSPAM.
+
+        A single transaction record is logged for each message.
+
         """
         for header in self.remove_headers:
             self.chgheader(header, 1, '')
-            logger.info('<{}> Removing existing {} header'.format(
-                self.id, header))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('<{}> Removing existing {} header'.format(
+                    self.id, header))
 
         queue_id = self.getsymval('i')
-        logger.debug(
-            '<{}> Sending message with MTA queue id {} to DSPAM'.format(
-                self.id, queue_id))
-
+        self.start_record(queue_id)
         try:
-            if not self.dspam:
-                self.dspam = DspamClient()
-                self.dspam.connect()
-                self.dspam.lhlo()
-                if not self.dspam.dlmtp:
-                    logger.warning(
-                        '<{}> Connection to DSPAM is established, but DLMTP '
-                        'seems unavailable'.format(self.id))
-            else:
-                self.dspam.rset()
-        except DspamClientError as err:
+            rc = self.classify_message(queue_id)
+        finally:
+            # Make sure the turn of admission control ends, and the next
+            #   message in the session starts afresh, on all paths. A DSPAM
+            #   connection that is still checked out here is in an unknown
+            #   state.
+            self.release_dspam(discard=True)
+            self.dspam_error = None
+            self.reset_message()
+            self.recipients = []
+            self.recipient_set = set()
+            self.remove_headers = []
+        self.log_record(rc)
+        return rc
+
+    def classify_message(self, queue_id):
+        """
+        Classify the message, and return the milter response for it.
+
+        The outcome is added to the transaction record.
+
+        Args:
+        queue_id -- The MTA queue id of the message.
+
+        """
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(
+                '<{}> Sending message with MTA queue id {} to DSPAM'.format(
+                    self.id, queue_id))
+
+        if self.bypassed:
+            if debug:
+                logger.debug(
+                    '<{}> Accepting message with queue id {} without '
+                    'classification: all recipients are bypassed'.format(
+                        self.id, queue_id))
+            return Milter.ACCEPT
+
+        if self.skipped:
+            hname = self.header_prefix + 'Skipped'
+            hvalue = 'Message size exceeds {} KB'.format(self.skip_size)
+            if debug:
+                logger.debug(
+                    '<{}> Accepting message with queue id {} without '
+                    'classification: {}'.format(self.id, queue_id, hvalue))
+            self.addheader(hname, hvalue)
+            self.count_size_path('skipped')
+            return Milter.ACCEPT
+
+        if self.dspam_error is not None:
+            # Streaming the message to DSPAM failed halfway
             logger.error(
-                '<{}> An error ocurred while connecting to DSPAM: {}'.format(
-                    self.id, err))
+                '<{}> An error ocurred while talking to DSPAM: {}'.format(
+                    self.id, self.dspam_error))
+            self.record['error'] = str(self.dspam_error)
+            if self.breaker is not None and self.dspam_failed(
+                    self.dspam_error):
+                self.breaker.failure()
             return Milter.TEMPFAIL
 
+        # Messages that were seen before are answered from the cache. In
+        #   streaming mode, the message was already sent to DSPAM.
+        cached = None
+        if self.cache is not None:
+            fingerprint = self.fingerprint.digest()
+            if self.dspam is None:
+                users = [self.static_user] if self.static_user else (
+                    self.recipients)
+                cached = self.cache.get(fingerprint, users)
+        self.record['cached'] = cached is not None
+
+        deadline = None
+        if self.message_timeout:
+            deadline = utils.monotonic() + self.message_timeout
+
+        groups = []
+        if cached is None and self.dspam is None:
+            groups = self.route()
+            if self.fanout > 1 and not self.static_user:
+                groups = [part for group in groups
+                          for part in split_recipients(group, self.fanout)]
+
+        if (cached is None and self.admission is not None and
+                not self.admitted):
+            # Wait for a turn, the wait counts against the deadline
+            time_queue = utils.monotonic()
+            timeout = self.admission.max_wait
+            if self.message_timeout:
+                timeout = min(timeout, self.message_timeout)
+            admitted = self.admit(timeout, max(len(groups), 1))
+            self.record['timings']['queue'] = utils.monotonic() - time_queue
+            if not admitted:
+                logger.warning(
+                    '<{}> Message with queue id {} was not admitted for '
+                    'classification within {} seconds'.format(
+                        self.id, queue_id, timeout))
+                self.record['admission'] = 'timeout'
+                if not self.admission.fail_open:
+                    return Milter.TEMPFAIL
+                self.addheader(self.header_prefix + 'Skipped',
+                               'DSPAM is busy')
+                return Milter.ACCEPT
+
+        if (cached is None and self.breaker is not None and
+                not self.breaker.allow()):
+            # DSPAM failed too often, don't wait for it to fail again
+            self.release_dspam(discard=True)
+            self.record['breaker'] = self.breaker.state
+            if not self.breaker.fail_open:
+                return Milter.TEMPFAIL
+            self.addheader(self.header_prefix + 'Skipped',
+                           'DSPAM is unavailable')
+            return Milter.ACCEPT
+
+        fanout = len(groups) > 1
+        # Whether the call succeeded, None when it ended unexpectedly or when
+        #   the error was no failure of DSPAM
+        succeeded = None
+        time_dspam = utils.monotonic()
         try:
-            self.dspam.mailfrom(client_args='--process --deliver=summary')
-            if self.static_user:
-                self.dspam.rcptto((self.static_user,))
+            if cached is not None:
+                if debug:
+                    logger.debug(
+                        '<{}> Using cached DSPAM results for message with '
+                        'queue id {}'.format(self.id, queue_id))
+                dspam_results = cached
+            elif fanout:
+                dspam_results = classify_groups(
+                    self.pool, self.workers, self.message, groups,
+                    '--process --deliver=summary', deadline)
+            elif self.dspam is None:
+                self.open_dspam_transaction(deadline)
+                self.dspam.data(self.message)
             else:
-                self.dspam.rcptto(self.recipients)
-            self.dspam.data(self.message)
-        except DspamClientError as err:
+                self.dspam.set_deadline(deadline)
+                self.dspam.data_end()
+            succeeded = True
+        except (DspamClientError, socket.error) as err:
             logger.error(
                 '<{}> An error ocurred while talking to DSPAM: {}'.format(
                     self.id, err))
+            self.record['error'] = str(err)
+            failed = self.dspam_failed(err)
+            self.release_dspam(discard=True, failed=failed)
+            if failed:
+                succeeded = False
             return Milter.TEMPFAIL
+        finally:
+            self.record['timings']['dspam'] = utils.monotonic() - time_dspam
+            # Always report back, a half-open breaker waits for its probe
+            if cached is None and self.breaker is not None:
+                if succeeded is None:
+                    self.breaker.release()
+                elif succeeded:
+                    self.breaker.success(self.record['timings']['dspam'])
+                else:
+                    self.breaker.failure()
 
-        # Clear caches
-        self.message = ''
-        self.recipients = []
+        if self.truncator is not None and self.truncator.truncated:
+            self.count_size_path('truncated')
+        else:
+            self.count_size_path('full')
+
+        # Return the connection to the pool
+        if cached is None and not fanout:
+            dspam_results = self.dspam.results
+            self.release_dspam()
+        if cached is None and self.cache is not None:
+            self.cache.put(fingerprint, dict(
+                (user, result) for user, result in dspam_results.items()
+                if isinstance(result, DspamResult)))
 
         # With multiple recipients, if different verdicts were returned, always
         #   use the 'lowest' verdict as final, so mail is not lost unexpected.
         final_verdict = None
-        for rcpt in self.dspam.results:
-            results = self.dspam.results[rcpt]
-            logger.info(
-                '<{0}> DSPAM returned results for message with queue id {1} '
-                'and RCPT {2}: {3}'.format(
-                    self.id, queue_id, rcpt,
-                    ' '.join('{}={}'.format(k, v) for k, v in results.iteritems())))
+        record_results = self.record['results']
+        for rcpt in dspam_results:
+            results = dspam_results[rcpt]
+            if debug:
+                logger.debug(
+                    '<{0}> DSPAM returned results for message with queue id '
+                    '{1} and RCPT {2}: {3}'.format(
+                        self.id, queue_id, rcpt, results))
+            if isinstance(results, DspamResult):
+                record_results[rcpt] = {
+                    'class': results.class_,
+                    'probability': results.probability,
+                    'confidence': results.confidence,
+                }
             verdict = self.compute_verdict(results)
             if final_verdict is None or verdict < final_verdict:
                 final_verdict = verdict
                 final_results = results
 
+        time_modify = utils.monotonic()
         if final_verdict == self.VERDICT_REJECT:
-            logger.info(
-                '<{0}> Rejecting message with queue id {1} based on DSPAM '
-                'results: user={2[user]} class={2[class]} '
-                'confidence={2[confidence]}'.format(
-                    self.id, queue_id, final_results))
-            self.setreply('550', '5.7.1', 'Message is {0[class]}'.format(
+            self.record['verdict'] = 'reject'
+            self.setreply('550', '5.7.1', 'Message is {0.class_}'.format(
                 final_results))
-            return Milter.REJECT
+            rc = Milter.REJECT
         elif final_verdict == self.VERDICT_QUARANTINE:
-            logger.info(
-                '<{0}> Quarantining message with queue id {1} based on DSPAM '
-                'results: user={2[user]} class={2[class]} '
-                'confidence={2[confidence]}'.format(
-                    self.id, queue_id, final_results))
+            self.record['verdict'] = 'quarantine'
             self.add_dspam_headers(final_results)
-            self.quarantine('Message is {0[class]} according to DSPAM'.format(
+            self.quarantine('Message is {0.class_} according to DSPAM'.format(
                 final_results))
-            return Milter.ACCEPT
+            rc = Milter.ACCEPT
         else:
-            logger.info(
-                '<{0}> Accepting message with queue id {1} based on DSPAM '
-                'results: user={2[user]} class={2[class]} '
-                'confidence={2[confidence]}'.format(
-                    self.id, queue_id, final_results))
+            self.record['verdict'] = 'accept'
             self.add_dspam_headers(final_results)
-            return Milter.ACCEPT
+            rc = Milter.ACCEPT
+        self.record['timings']['modify'] = utils.monotonic() - time_modify
+        return rc
+
+    def abort(self):
+        """
+        Clean up after the MTA aborted the current message.
+
+        """
+        if self.time_message is not None:
+            self.start_record(None)
+            self.log_record(None)
+        self.release_dspam(discard=True)
+        self.dspam_error = None
+        self.reset_message()
+        self.recipients = []
+        self.recipient_set = set()
+        self.remove_headers = []
+        return Milter.CONTINUE
+
+    def start_record(self, queue_id):
+        """
+        Create the transaction record of the current message.
+
+        The record holds the state of the message when it ends, and the
+        outcome of the classification is added to it before it is logged.
+
+        Args:
+        queue_id -- The MTA queue id of the message.
+
+        """
+        now = utils.monotonic()
+        time_message = self.time_message
+        if time_message is None:
+            time_message = now
+        time_eoh = self.time_eoh
+        if time_eoh is None:
+            time_eoh = now
+        self.record = {
+            'id': self.id,
+            'queue_id': queue_id,
+            'client': self.client_ip,
+            'recipients': list(self.recipients),
+            'body_size': self.body_size,
+            'streaming': self.dspam is not None,
+            'truncated': (self.truncator is not None and
+                          self.truncator.truncated),
+            'skipped': self.skipped,
+            'bypassed': self.bypassed,
+            'results': {},
+            'timings': {
+                'start': time_message,
+                'headers': time_eoh - time_message,
+                'body': now - time_eoh,
+            },
+        }
+
+    def log_record(self, rc):
+        """
+        Log the transaction record of the current message as a JSON line,
+        and add it to the metrics.
+
+        Timings are logged in milliseconds.
+
+        Args:
+        rc -- The milter response for the message, or None when the message
+              was aborted.
+
+        """
+        record = self.record
+        timings = record['timings']
+        timings['total'] = utils.monotonic() - timings.pop('start')
+        record['action'] = self.RESPONSE_NAMES.get(rc, 'abort')
+
+        for phase in timings:
+            phase_histogram.observe(timings[phase], (phase,))
+            timings[phase] = round(timings[phase] * 1000, 1)
+        messages_counter.inc(labels=(record['action'],))
+        if 'verdict' in record:
+            verdicts_counter.inc(labels=(record['verdict'],))
+        if 'error' in record:
+            errors_counter.inc()
+        body_bytes_counter.inc(record['body_size'])
+        transaction_logger.info(json.dumps(record, sort_keys=True))
+        self.record = None
 
     def close(self):
         """
         Log disconnects.
 
         """
-        time_spent = time.time() - self.time_start
-        logger.debug(
-            '<{}> Disconnect from [{}]:{}, time spent {:.3f} seconds'.format(
-                self.id, self.client_ip, self.client_port, time_spent))
+        self.release_dspam(discard=True)
+        self.message.close()
+        if logger.isEnabledFor(logging.DEBUG):
+            time_spent = time.time() - self.time_start
+            logger.debug(
+                '<{}> Disconnect from [{}]:{}, time spent {:.3f} '
+                'seconds'.format(self.id, self.client_ip, self.client_port,
+                                 time_spent))
         return Milter.CONTINUE
 
+    def open_dspam_transaction(self, deadline=None, timeout=None):
+        """
+        Check out a DSPAM connection, and start a transaction for the
+        message on it.
+
+        Raises a DspamClientError or socket.error when this failed, the
+        connection must then be released with release_dspam().
+
+        Args:
+        deadline -- When the transaction must be finished, as a
+                    utils.monotonic() timestamp.
+        timeout  -- Seconds to wait for a connection from the pool, defaults
+                    to the checkout timeout of the pool.
+
+        """
+        users = self.route()[0]
+        key = users[0] if users else None
+        self.dspam = self.pool.get(timeout, key=key, deadline=deadline)
+        if deadline is not None:
+            self.dspam.set_deadline(deadline)
+        self.dspam.rset()
+        self.dspam.mailfrom(client_args='--process --deliver=summary')
+        self.dspam.rcptto(users)
+
+    @staticmethod
+    def dspam_failed(err):
+        """
+        Return whether an error means that DSPAM failed, as opposed to the
+        pool having no connection available, the deadline having passed, or
+        a recipient being rejected.
+
+        Args:
+        err -- The DspamClientError or socket.error.
+
+        """
+        return not isinstance(err, (PoolTimeoutError, DeadlineExceededError,
+                                    RecipientRejectedError))
+
+    def route(self):
+        """
+        Return the DSPAM users of the message, grouped by the DSPAM server
+        they are routed to.
+
+        """
+        users = [self.static_user] if self.static_user else self.recipients
+        if isinstance(self.pool, BackendPool):
+            return self.pool.partition(users)
+        return [users]
+
+    def reset_message(self):
+        """
+        Discard the data and size state of the current message.
+
+        """
+        self.message.close()
+        self.content_type = b''
+        self.body_size = 0
+        self.truncator = None
+        self.skipped = False
+        self.bypassed = False
+        self.fingerprint = hashlib.sha256()
+        self.time_message = None
+        self.time_eoh = None
+
+    @classmethod
+    def count_size_path(cls, path):
+        """
+        Count a message in the size statistics.
+
+        Args:
+        path -- One of 'full', 'truncated' or 'skipped'.
+
+        """
+        with cls._stats_lock:
+            cls.size_stats[path] += 1
+
+    def admit(self, timeout=None, turns=1):
+        """
+        Wait for the turns of admission control to classify the message.
+
+        Returns whether the message may be classified. The turns end when
+        the DSPAM connection is released.
+
+        Args:
+        timeout -- Seconds to wait, defaults to the maximum wait configured
+                   for admission control.
+        turns   -- The number of DSPAM transactions of the message.
+
+        """
+        if self.admission is None or self.admitted:
+            return True
+        if self.admission.acquire(timeout, turns):
+            self.admitted = turns
+        return bool(self.admitted)
+
+    def release_dspam(self, discard=False, failed=False):
+        """
+        Return the DSPAM connection of this milter instance to the pool, and
+        end its turn of admission control.
+
+        Args:
+        discard -- Disconnect instead of reusing the connection, for use when
+                   a DSPAM transaction might still be in progress.
+        failed  -- Disconnect, because DSPAM failed to handle the
+                   transaction.
+
+        """
+        if self.dspam is not None:
+            if not (discard or failed):
+                self.dspam.set_deadline(None)
+            self.pool.put(self.dspam, discard=discard, failed=failed)
+            self.dspam = None
+        if self.admitted:
+            self.admission.release(self.admitted)
+            self.admitted = 0
+
     def compute_verdict(self, results):
         """
         Match results to the configured reject, quarantine and accept classes,
@@ -261,40 +844,43 @@ class DspamMilter(Milter.Base):
                                         #   for FP and retraining)
 
         Args:
-        results -- A results dictionary from DspamClient.
+        results -- A DspamResult from DspamClient.
 
         """
-        if results['class'] in self.reject_classes:
-            threshold = self.reject_classes[results['class']]
-            if float(results['confidence']) >= threshold:
+        class_ = results.class_
+        confidence = results.confidence
+        if (class_ in self.reject_classes and
+                confidence >= self.reject_classes[class_]):
+            if logger.isEnabledFor(logging.DEBUG):
                 logger.debug(
                     '<{0}> Suggesting to reject the message based on DSPAM '
-                    'results: user={1[user]}, class={1[class]}, '
-                    'confidence={1[confidence]}'.format(self.id, results))
-                return self.VERDICT_REJECT
+                    'results: user={1.user}, class={1.class_}, '
+                    'confidence={1.confidence}'.format(self.id, results))
+            return self.VERDICT_REJECT
 
-        if results['class'] in self.quarantine_classes:
-            threshold = self.quarantine_classes[results['class']]
-            if float(results['confidence']) >= threshold:
+        if (class_ in self.quarantine_classes and
+                confidence >= self.quarantine_classes[class_]):
+            if logger.isEnabledFor(logging.DEBUG):
                 logger.debug(
                     '<{0}> Suggesting to quarantine the message based on '
-                    'DSPAM results: user={1[user]}, class={1[class]}, '
-                    'confidence={1[confidence]}'.format(self.id, results))
-                return self.VERDICT_QUARANTINE
+                    'DSPAM results: user={1.user}, class={1.class_}, '
+                    'confidence={1.confidence}'.format(self.id, results))
+            return self.VERDICT_QUARANTINE
 
-        if results['class'] in self.accept_classes:
-            threshold = self.accept_classes[results['class']]
-            if float(results['confidence']) >= threshold:
+        if (class_ in self.accept_classes and
+                confidence >= self.accept_classes[class_]):
+            if logger.isEnabledFor(logging.DEBUG):
                 logger.debug(
                     '<{0}> Suggesting to accept the message based on DSPAM '
-                    'results: user={1[user]}, class={1[class]}, '
-                    'confidence={1[confidence]}'.format(self.id, results))
-                return self.VERDICT_ACCEPT
-
-        logger.debug(
-            '<{0}> Suggesting to accept the message, no verdict class matched '
-            'DSPAM results: user={1[user]}, class={1[class]}, '
-            'confidence={1[confidence]}'.format(self.id, results))
+                    'results: user={1.user}, class={1.class_}, '
+                    'confidence={1.confidence}'.format(self.id, results))
+            return self.VERDICT_ACCEPT
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                '<{0}> Suggesting to accept the message, no verdict class '
+                'matched DSPAM results: user={1.user}, class={1.class_}, '
+                'confidence={1.confidence}'.format(self.id, results))
         return self.VERDICT_ACCEPT
 
     def add_dspam_headers(self, results):
@@ -302,21 +888,23 @@ class DspamMilter(Milter.Base):
         Format DSPAM headers with passed results, and add them to the message.
 
         Args:
-        results -- A results dictionary from DspamClient.
+        results -- A DspamResult from DspamClient.
         """
         for header in self.headers:
             hname = self.header_prefix + header
             if header.lower() in results:
-                hvalue = results[header.lower()]
-                logger.debug(
-                    '<{}> Adding header {}: {}'.format(self.id, hname, hvalue))
+                hvalue = results.format(header.lower())
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('<{}> Adding header {}: {}'.format(
+                        self.id, hname, hvalue))
                 self.addheader(hname, hvalue)
             elif header == 'Processed':
                 # X-DSPAM-Processed: Wed Dec 12 02:19:23 2012
                 hvalue = datetime.datetime.now().strftime(
                     '%a %b %d %H:%M:%S %Y')
-                logger.debug(
-                    '<{}> Adding header {}: {}'.format(self.id, hname, hvalue))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('<{}> Adding header {}: {}'.format(
+                        self.id, hname, hvalue))
                 self.addheader(hname, hvalue)
             else:
                 logger.warning(
@@ -336,97 +924,358 @@ class DspamMilterDaemon(object):
     loglevel = 'INFO'
     pidfile = '/var/run/dspam/dspam-milter.pid'
     daemonize = True
+    metrics_socket = None
+    prefork = False
+    processes = 0
+
+    # The classes that hold the defaults for each config section, besides
+    #   the milter section, which configures the daemon itself
+    section_class_map = {
+        'dspam': DspamClient,
+        'pool': DspamClientPool,
+        'cache': VerdictCache,
+        'bypass': BypassRules,
+        'breaker': CircuitBreaker,
+        'admission': AdmissionControl,
+        'backends': BackendPool,
+        'classification': DspamMilter,
+    }
+
+    def __init__(self):
+        self.config_file = None
+        self.config = Config()
+        # Subclasses of the classes in section_class_map, configured by
+        #   self.config
+        self.classes = None
+        self.supervisor = None
+        self.metrics_server = None
 
     def run(self, config_file=None):
         utils.log_to_syslog()
         logger.info('DSPAM Milter startup (v{})'.format(VERSION))
         if config_file is not None:
             self.configure(config_file)
+        try:
+            self.classes = self.prepare(self.config)
+        except ValueError as err:
+            logger.critical(str(err))
+            sys.exit(1)
         if self.daemonize:
             utils.daemonize(self.pidfile)
-        Milter.factory = DspamMilter
-        Milter.runmilter('DspamMilter', self.socket, self.timeout)
+        # For MTAs that do not negotiate, declare the actions up front
+        Milter.set_flags(DspamMilter.ACTIONS)
+        if not self.prefork:
+            self.start_worker()
+            Milter.runmilter('DspamMilter', self.socket, self.timeout)
+            self.stop_worker()
+        else:
+            processes = self.processes or utils.available_cpus()
+            logger.info('Starting {} worker processes'.format(processes))
+            main = Milter.milter.main
+
+            def run_worker(index):
+                self.start_worker(index)
+                self.supervisor.listen(self.reload_worker)
+                main()
+                self.stop_worker()
+
+            # runmilter() opens the socket and then calls main(), start the
+            #   workers at that point so they all inherit the socket.
+            self.supervisor = Supervisor(processes, run_worker,
+                                         reload=self.reload)
+            Milter.milter.main = self.supervisor.run
+            try:
+                Milter.runmilter('DspamMilter', self.socket, self.timeout)
+            finally:
+                Milter.milter.main = main
         logger.info('DSPAM Milter shutdown (v{})'.format(VERSION))
         logging.shutdown()
 
+    def start_worker(self, index=None):
+        """
+        Create the resources of a process that handles connections.
+
+        Args:
+        index -- The number of the worker process in prefork mode.
+
+        """
+        # libmilter waits for these signals in its own thread to stop
+        #   gracefully. Block them before starting any threads, which inherit
+        #   the mask, so they can not take a signal and kill the process.
+        if hasattr(signal, 'pthread_sigmask'):
+            signal.pthread_sigmask(signal.SIG_BLOCK, Supervisor.SIGNALS)
+        if self.metrics_socket:
+            address = self.metrics_socket
+            try:
+                if index is not None:
+                    address = worker_address(address, index)
+                self.metrics_server = metrics.MetricsServer(address)
+            except (ValueError, socket.error) as err:
+                logger.critical(
+                    'Failed to serve metrics on {}: {}'.format(address, err))
+                sys.exit(1)
+        self.create_resources(self.classes)
+        Milter.factory = self.classes['classification']
+
+    def stop_worker(self):
+        """
+        Release the resources of a process, and log its statistics.
+
+        """
+        milter_class = self.classes['classification']
+        if milter_class.workers is not None:
+            milter_class.workers.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        milter_class.pool.close()
+        logger.info('DSPAM connection pool statistics: {}'.format(
+            ' '.join('{}={}'.format(k, v) for k, v in sorted(
+                milter_class.pool.stats().items()))))
+        if isinstance(milter_class.pool, BackendPool):
+            for address, stats in sorted(
+                    milter_class.pool.backend_stats().items()):
+                logger.info('DSPAM server {} statistics: {}'.format(
+                    address, ' '.join('{}={}'.format(k, v) for k, v in sorted(
+                        stats.items()))))
+        logger.info('Message size statistics: {}'.format(
+            ' '.join('{}={}'.format(k, v) for k, v in sorted(
+                milter_class.size_stats.items()))))
+        if milter_class.cache is not None:
+            logger.info('Verdict cache statistics: {}'.format(
+                ' '.join('{}={}'.format(k, v) for k, v in sorted(
+                    milter_class.cache.stats().items()))))
+        if milter_class.admission is not None:
+            logger.info('Admission control statistics: {}'.format(
+                ' '.join('{}={}'.format(k, v) for k, v in sorted(
+                    milter_class.admission.stats().items()))))
+
+    def create_resources(self, classes, previous=None, changed=()):
+        """
+        Create the DSPAM connection pool and the other objects that are
+        shared by all milter instances, on the configured milter class.
+
+        Objects of a previous milter class are reused when their
+        configuration did not change. Returns the previous objects that were
+        replaced, which can be closed when the new milter class is in use.
+
+        Args:
+        classes  -- The configured classes, from prepare().
+        previous -- The milter class that was in use before.
+        changed  -- The names of the config sections that changed since.
+
+        """
+        milter_class = classes['classification']
+        replaced = []
+
+        if (previous is not None and
+                not {'dspam', 'pool', 'backends'} & set(changed)):
+            milter_class.pool = previous.pool
+        else:
+            addresses = split_addresses(classes['dspam'].socket)
+            if len(addresses) > 1:
+                milter_class.pool = classes['backends'](
+                    addresses, lambda address: classes['pool'](
+                        factory=functools.partial(classes['dspam'], address)))
+            else:
+                milter_class.pool = classes['pool'](factory=classes['dspam'])
+            try:
+                milter_class.pool.fill()
+            except (DspamClientError, socket.error) as err:
+                logger.warning(
+                    'Failed to pre-warm DSPAM connection pool: {}'.format(err))
+            if previous is not None:
+                replaced.append(previous.pool)
+
+        # Transactions run in parallel with fanout, and for recipients that
+        #   are routed to different DSPAM servers
+        parallel = (milter_class.fanout > 1 or (
+            isinstance(milter_class.pool, BackendPool) and
+            milter_class.pool.strategy == 'consistent-hash'))
+        if previous is not None and (
+                (previous.workers is not None, previous.fanout_workers) ==
+                (parallel, milter_class.fanout_workers)):
+            milter_class.workers = previous.workers
+        else:
+            if parallel:
+                milter_class.workers = WorkerPool(milter_class.fanout_workers)
+            if previous is not None and previous.workers is not None:
+                replaced.append(previous.workers)
+
+        for section, enabled in (
+                ('cache', classes['cache'].max_size > 0),
+                ('breaker', classes['breaker'].failure_threshold > 0),
+                ('admission', classes['admission'].max_concurrent > 0)):
+            if previous is not None and section not in changed:
+                setattr(milter_class, section, getattr(previous, section))
+            elif enabled:
+                setattr(milter_class, section, classes[section]())
+        return replaced
+
+    def read_config(self, config_file):
+        """
+        Read a config file into a Config snapshot.
+
+        Raises an IOError when the file can not be read, and a ValueError
+        when it contains invalid values.
+
+        Args:
+        config_file -- The path of the config file.
+
+        """
+        section_class_map = dict(self.section_class_map)
+        section_class_map['milter'] = type(self)
+        config = Config.from_file(config_file, section_class_map)
+        logger.info('Parsed config file ' + config_file)
+        return config
+
     def configure(self, config_file):
         """
-        Parse configuration, and setup objects to use it.
+        Parse configuration, and apply the options of the milter section.
+
+        The other sections are applied by prepare().
 
         """
-        cfg = configparser.RawConfigParser()
         try:
-            cfg.readfp(open(config_file))
+            config = self.read_config(config_file)
         except IOError as err:
             logger.critical(
                 'Error while reading config file {}: {}'.format(
                     config_file, err.strerror))
             sys.exit(1)
-        logger.info('Parsed config file ' + config_file)
+        except ValueError as err:
+            logger.critical(str(err))
+            sys.exit(1)
+        self.config_file = config_file
+        self.config = config
+        for option, value in config.options('milter').items():
+            setattr(self, option, value)
+            logger.debug('Config option applied: milter->{}: {}'.format(
+                option, value))
+        self.set_loglevel(self.loglevel)
+        logger.debug('Configuration completed')
 
-        # Extract user-defined log level from configuration
-        if cfg.has_option('milter', 'loglevel'):
-            loglevel = cfg.get('milter', 'loglevel')
-            loglevel_numeric = getattr(logging, loglevel.upper(), None)
-            if not isinstance(loglevel_numeric, int):
-                logger.critical(
-                    'Config contains unsupported loglevel: ' + loglevel)
-                exit(1)
-            rl = logging.getLogger()
-            rl.setLevel(loglevel_numeric)
-            logger.debug(
-                'Config option applied: milter->loglevel: {}'.format(loglevel))
+    @staticmethod
+    def set_loglevel(loglevel):
+        """
+        Set the level of the root logger.
 
-        # Apply all config options to their respective classes
-        section_class_map = {
-            'milter': self,
-            'dspam': DspamClient,
-            'classification': DspamMilter,
-        }
-        for section in cfg.sections():
+        Args:
+        loglevel -- The name of the level, validated by Config.
+
+        """
+        logging.getLogger().setLevel(getattr(logging, loglevel.upper()))
+
+    def prepare(self, config):
+        """
+        Create subclasses of the classes in section_class_map that are
+        configured by a snapshot, and check that the configuration can be
+        used.
+
+        Returns a dictionary of the classes, keyed on section name. Raises a
+        ValueError when the configuration can not be used.
+
+        Args:
+        config -- The Config snapshot.
+
+        """
+        classes = dict((section, config.configure(class_, section))
+                       for section, class_ in self.section_class_map.items())
+        milter_class = classes['classification']
+        # Leave time to send the reply before the MTA gives up on the milter
+        milter_class.message_timeout = self.timeout * 0.8
+        if milter_class.recipient_map:
             try:
-                class_ = section_class_map[section]
-            except KeyError:
-                logger.warning('Config contains unknown section: ' + section)
-                continue
-            logger.debug('Handling config section: ' + section)
-
-            dict_options = [
-                'headers',
-                'reject_classes',
-                'quarantine_classes',
-                'accept_classes'
-            ]
-            for option in cfg.options(section):
-                # Kludge: static_user needs to be set on the milter,
-                #   not on the client
-                if section == 'dspam' and option == 'static_user':
-                    value = cfg.get('dspam', 'static_user')
-                    DspamMilter.static_user = value
-                    logger.debug(
-                        'Config option applied: dspam->static_user: {}'.format(
-                            value))
-                    continue
-
-                if not hasattr(class_, option):
-                    logger.warning(
-                        'Config contains unknown option: {}->{}'.format(
-                            section, option))
-                    continue
-
-                value = cfg.get(section, option)
-                if option in dict_options:
-                    value = utils.config_str2dict(value)
-                elif value.lower() in ['false', 'no']:
-                    value = False
-                elif value.lower() in ['true', 'yes']:
-                    value = True
-
-                setattr(class_, option, value)
-                logger.debug(
-                    'Config option applied: {}->{}: {}'.format(
-                        section, option, value))
-        logger.debug('Configuration completed')
+                milter_class.rcptmap = RecipientMap.from_file(
+                    milter_class.recipient_map)
+            except (IOError, ValueError) as err:
+                raise ValueError(
+                    'Error while reading recipient map: {}'.format(err))
+        try:
+            rules = classes['bypass']()
+        except ValueError as err:
+            raise ValueError('Error in bypass rules: {}'.format(err))
+        if rules:
+            milter_class.bypass = rules
+        pool_class = classes['pool']
+        if pool_class.min_size > pool_class.max_size:
+            raise ValueError(
+                'Pool min_size {} is larger than max_size {}'.format(
+                    pool_class.min_size, pool_class.max_size))
+        if classes['backends'].strategy not in BackendPool.STRATEGIES:
+            raise ValueError('Unknown backend strategy: {}'.format(
+                classes['backends'].strategy))
+        return classes
+
+    def reload(self):
+        """
+        Read the config file again, and pass it on to the worker processes.
+
+        The configuration is only used when it is valid. Options of the
+        milter section, other than loglevel, need a restart to change.
+
+        """
+        if self.config_file is None:
+            logger.warning('No config file to reload')
+            return
+        try:
+            config = self.read_config(self.config_file)
+            classes = self.prepare(config)
+        except IOError as err:
+            logger.error('Error while reading config file {}: {}'.format(
+                self.config_file, err.strerror))
+            return
+        except ValueError as err:
+            logger.error('Not reloading configuration: {}'.format(err))
+            return
+
+        options = config.options('milter')
+        for option, value in sorted(options.items()):
+            if option != 'loglevel' and value != getattr(self, option):
+                logger.warning(
+                    'Config option milter->{} changes after a restart'.format(
+                        option))
+        self.loglevel = options.get('loglevel', type(self).loglevel)
+        self.set_loglevel(self.loglevel)
+
+        # Workers that are restarted later use the new configuration
+        self.config = config
+        self.classes = classes
+        if self.supervisor is not None:
+            self.supervisor.broadcast(config.to_json().encode('utf-8'))
+
+    def reload_worker(self, message):
+        """
+        Start using a new configuration in a worker process.
+
+        Milter instances are created from a new milter class, so SMTP
+        sessions that are in progress finish with the configuration they
+        started with. The DSPAM connection pool is only replaced when the
+        connection settings changed.
+
+        Args:
+        message -- The Config snapshot as JSON, sent by the supervisor.
+
+        """
+        config = Config.from_json(message.decode('utf-8'))
+        try:
+            classes = self.prepare(config)
+        except ValueError as err:
+            logger.error('Not reloading configuration: {}'.format(err))
+            return
+        self.set_loglevel(
+            config.options('milter').get('loglevel', type(self).loglevel))
+        previous = self.classes['classification']
+        changed = [section for section in self.section_class_map
+                   if config.changed(self.config, section)]
+        replaced = self.create_resources(classes, previous, changed)
+        # New SMTP sessions get the new configuration from here on
+        Milter.factory = classes['classification']
+        self.config = config
+        self.classes = classes
+        for resource in replaced:
+            resource.close()
+        logger.info('Configuration reloaded, changed sections: {}'.format(
+            ', '.join(sorted(changed)) or 'none'))
 
 
 def main():
@@ -0,0 +1,529 @@
+import json
+import time
+
+import pytest
+from flexmock import flexmock
+
+import Milter
+
+from . import utils
+from .admission import AdmissionControl
+from .breaker import CircuitBreaker
+from .bypass import BypassRules
+from .cache import VerdictCache
+from .client import (DeadlineExceededError, DspamClientError,
+                     RecipientRejectedError)
+from .fanout import WorkerPool
+from .milter import DspamMilter, transaction_logger
+from .pool import PoolTimeoutError
+from .rcptmap import RecipientMap
+
+
+class RecordingMilter(DspamMilter):
+    """
+    A milter that records the actions it takes, instead of passing them to
+    the MTA.
+
+    """
+
+    def __init__(self):
+        DspamMilter.__init__(self)
+        self.macros = {'i': 'QUEUEID'}
+        self.added = []
+        self.changed = []
+        self.replies = []
+        self.quarantined = []
+
+    def getsymval(self, name):
+        return self.macros.get(name)
+
+    def addheader(self, name, value, idx=-1):
+        self.added.append((name, value))
+
+    def chgheader(self, name, idx, value):
+        self.changed.append((name, value))
+
+    def setreply(self, rcode, xcode, msg):
+        self.replies.append((rcode, xcode, msg))
+
+    def quarantine(self, reason):
+        self.quarantined.append(reason)
+
+
+@pytest.fixture
+def milter_class(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, max_size=2, checkout_timeout=1)
+    return type('TestMilter', (RecordingMilter,), {'pool': pool})
+
+
+@pytest.fixture
+def workers():
+    workers = WorkerPool(2)
+    yield workers
+    workers.close()
+
+
+def negotiate(milter):
+    # The MTA offers all actions and protocol options
+    opts = [Milter.CURR_ACTS, 0x1fffff, 0, 0]
+    assert milter.negotiate(opts) == Milter.CONTINUE
+    return opts
+
+
+def send_message(milter, recipients, body=b'test\r\n',
+                 headers=(('Subject', 'test'),)):
+    for rcpt in recipients:
+        milter.envrcpt('<{}>'.format(rcpt))
+    for name, value in headers:
+        milter.header(name, value)
+    milter.eoh()
+    milter.body(body)
+    return milter.eom()
+
+
+def test_tempfail_resets_message(milter_class, dspam_server, make_pool,
+                                 tmpdir):
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    milter.pool = make_pool('unix:' + str(tmpdir.join('nonexistent')),
+                            max_size=2, checkout_timeout=1)
+    assert send_message(milter, ['a@example.org'],
+                        b'x' * 800) == Milter.TEMPFAIL
+    assert milter.recipients == []
+    assert milter.body_size == 0
+
+    # The next message in the session only has its own state
+    del milter.pool
+    milter.envrcpt('<b@example.org>')
+    milter.header('Subject', 'test')
+    milter.eoh()
+    milter.body(b'x' * 14)
+    assert milter.body_size == 14
+    assert milter.recipients == ['b@example.org']
+    assert milter.eom() == Milter.ACCEPT
+    assert dspam_server.messages[-1] == b'Subject: test\r\n\r\n' + b'x' * 14
+    assert ('X-DSPAM-Result', 'Innocent') in milter.added
+
+
+def test_streaming_does_not_wait_for_pool(milter_class, dspam_server):
+    milter_class.streaming = True
+    milter_class.pool.checkout_timeout = 5
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    busy = [milter_class.pool.get(), milter_class.pool.get()]
+    milter.envrcpt('<a@example.org>')
+    milter.header('Subject', 'test')
+    start = time.time()
+    milter.eoh()
+    elapsed = time.time() - start
+    for client in busy:
+        milter_class.pool.put(client)
+    assert elapsed < 1
+    # The message is buffered instead
+    assert milter.dspam is None
+    milter.body(b'test\r\n')
+    assert milter.eom() == Milter.ACCEPT
+    assert dspam_server.messages[-1] == b'Subject: test\r\n\r\ntest'
+
+
+def test_breaker_probe_released(milter_class):
+    milter_class.breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+    flexmock(utils).should_receive('monotonic').and_return(100)
+    milter_class.breaker.failure()
+    flexmock(utils).should_receive('monotonic').and_return(130)
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    flexmock(milter).should_receive('open_dspam_transaction').and_raise(
+        RuntimeError('unexpected'))
+    with pytest.raises(RuntimeError):
+        send_message(milter, ['a@example.org'])
+    # The probe is not left pending
+    assert milter_class.breaker.state == CircuitBreaker.HALF_OPEN
+    assert milter_class.breaker.allow()
+
+
+def test_negotiate(milter_class):
+    milter = milter_class()
+    actions, protocol = negotiate(milter)[:2]
+    assert actions == DspamMilter.ACTIONS
+    # Unused callbacks are skipped, and the MTA does not wait for replies
+    #   to the callbacks that always continue
+    for flag in (Milter.P_NOHELO, Milter.P_NOMAIL, Milter.P_NODATA,
+                 Milter.P_NOUNKNOWN, Milter.P_NR_CONN, Milter.P_NR_RCPT,
+                 Milter.P_NR_HDR, Milter.P_NR_EOH, Milter.P_NR_BODY):
+        assert protocol & flag
+    for flag in (Milter.P_NOCONNECT, Milter.P_NORCPT, Milter.P_NOHDRS,
+                 Milter.P_NOEOH, Milter.P_NOBODY, Milter.P_NR_MAIL,
+                 Milter.P_RCPT_REJ):
+        assert not protocol & flag
+
+    assert milter.connect(
+        'mx.example.org', 4, ('192.0.2.1', 25)) == Milter.NOREPLY
+    assert milter.envrcpt('<a@example.org>') == Milter.NOREPLY
+    assert milter.header('Subject', 'test') == Milter.NOREPLY
+    assert milter.eoh() == Milter.NOREPLY
+    assert milter.body(b'test\r\n') == Milter.NOREPLY
+    assert milter.eom() == Milter.ACCEPT
+
+
+def test_negotiate_bypass(milter_class):
+    milter_class.bypass = BypassRules(client_networks='192.0.2.0/24',
+                                      senders='@example.com')
+    milter = milter_class()
+    protocol = negotiate(milter)[1]
+    # Bypassed clients and senders need a reply
+    assert not protocol & Milter.P_NR_CONN
+    assert not protocol & Milter.P_NOMAIL
+    assert protocol & Milter.P_NR_RCPT
+    assert milter.connect(
+        'mx.example.org', 4, ('198.51.100.1', 25)) == Milter.CONTINUE
+    assert milter.envfrom('<a@example.org>') == Milter.CONTINUE
+
+
+def test_bypass_client(milter_class, dspam_server):
+    milter_class.bypass = BypassRules(client_networks='192.0.2.0/24')
+    milter = milter_class()
+    negotiate(milter)
+    assert milter.connect(
+        'mx.example.org', 4, ('192.0.2.1', 25)) == Milter.ACCEPT
+    assert dspam_server.messages == []
+
+
+def test_bypass_sender(milter_class):
+    milter_class.bypass = BypassRules(authenticated=True,
+                                      senders='@example.com')
+    milter = milter_class()
+    negotiate(milter)
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    assert milter.envfrom('<news@example.com>') == Milter.ACCEPT
+    assert milter.envfrom('<a@example.org>') == Milter.CONTINUE
+    assert milter.envfrom('<>') == Milter.CONTINUE
+    milter.macros['{auth_authen}'] = 'a'
+    assert milter.envfrom('<a@example.org>') == Milter.ACCEPT
+
+
+def test_bypass_recipients(milter_class, dspam_server):
+    milter_class.bypass = BypassRules(recipients='postmaster@example.org')
+    dspam_server.spam_users.add('postmaster@example.org')
+    milter = milter_class()
+    negotiate(milter)
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    for rcpt in ('postmaster@example.org', 'a@example.org'):
+        assert milter.envrcpt('<{}>'.format(rcpt)) == Milter.NOREPLY
+    # Only the other recipient is classified
+    assert milter.recipients == ['a@example.org']
+    assert send_message(milter, []) == Milter.ACCEPT
+    assert ('X-DSPAM-Result', 'Innocent') in milter.added
+    assert len(dspam_server.messages) == 1
+
+    # When all recipients are bypassed, the message is accepted as is
+    milter.added = []
+    milter.envrcpt('<postmaster@example.org>')
+    milter.header('Subject', 'test')
+    milter.eoh()
+    assert milter.bypassed
+    milter.body(b'test\r\n')
+    assert milter.eom() == Milter.ACCEPT
+    assert milter.added == []
+    assert len(dspam_server.messages) == 1
+
+
+def logged_records():
+    records = []
+    flexmock(transaction_logger).should_receive('info').replace_with(
+        lambda line: records.append(json.loads(line)))
+    return records
+
+
+def test_transaction_record(milter_class, dspam_server):
+    records = logged_records()
+    dspam_server.spam_users.add('b@example.org')
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    assert send_message(milter, ['a@example.org', 'b@example.org'],
+                        b'x' * 100) == Milter.ACCEPT
+    assert len(records) == 1
+    record = records[0]
+    assert record['id'] == milter.id
+    assert record['queue_id'] == 'QUEUEID'
+    assert record['client'] == '192.0.2.1'
+    assert record['recipients'] == ['a@example.org', 'b@example.org']
+    assert record['body_size'] == 100
+    assert record['action'] == 'accept'
+    assert record['verdict'] == 'accept'
+    assert record['results']['b@example.org']['class'] == 'Spam'
+    assert not record['streaming']
+    assert not record['bypassed']
+    assert 'error' not in record
+    assert set(record['timings']) >= set(
+        ['headers', 'body', 'dspam', 'total'])
+    assert milter.record is None
+
+
+def test_transaction_record_abort(milter_class):
+    records = logged_records()
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    # Aborts before the first recipient are not logged
+    assert milter.abort() == Milter.CONTINUE
+    assert records == []
+
+    milter.envrcpt('<a@example.org>')
+    milter.header('Subject', 'test')
+    milter.eoh()
+    milter.body(b'test\r\n')
+    assert milter.abort() == Milter.CONTINUE
+    assert len(records) == 1
+    assert records[0]['action'] == 'abort'
+    assert records[0]['queue_id'] is None
+    assert records[0]['recipients'] == ['a@example.org']
+    assert records[0]['body_size'] == 6
+    assert 'verdict' not in records[0]
+    assert milter.recipients == []
+    assert milter.body_size == 0
+
+
+def test_deadline_limits_connecting(milter_class, silent_server, make_pool):
+    milter_class.message_timeout = 0.3
+    milter_class.pool = make_pool(silent_server, max_size=2)
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    start = time.time()
+    assert send_message(milter, ['a@example.org']) == Milter.TEMPFAIL
+    assert time.time() - start < 1
+
+
+@pytest.mark.parametrize('error,failure', [
+    (DspamClientError('Connection refused'), True),
+    (PoolTimeoutError('Pool exhausted'), False),
+    (DeadlineExceededError('Deadline exceeded'), False),
+    (RecipientRejectedError('Unknown recipient'), False),
+])
+def test_breaker_counts_failures(milter_class, error, failure):
+    milter_class.breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    flexmock(milter).should_receive('open_dspam_transaction').and_raise(error)
+    assert send_message(milter, ['a@example.org']) == Milter.TEMPFAIL
+    expected = CircuitBreaker.OPEN if failure else CircuitBreaker.CLOSED
+    assert milter_class.breaker.state == expected
+
+
+def test_busy_pool_is_no_failure(milter_class):
+    milter_class.breaker = CircuitBreaker(failure_threshold=1, cooldown=30)
+    milter_class.pool.checkout_timeout = 0.05
+    busy = [milter_class.pool.get(), milter_class.pool.get()]
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    assert send_message(milter, ['a@example.org']) == Milter.TEMPFAIL
+    for client in busy:
+        milter_class.pool.put(client)
+    assert milter_class.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_admission_turn_per_transaction(milter_class, dspam_server, workers):
+    milter_class.fanout = 2
+    milter_class.workers = workers
+    milter_class.admission = AdmissionControl(max_concurrent=2, max_wait=0.05)
+    recipients = ['a@example.org', 'b@example.org']
+    assert milter_class.admission.acquire()
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    # The two transactions of the message don't fit in the one turn left
+    assert send_message(milter, recipients) == Milter.TEMPFAIL
+    assert dspam_server.messages == []
+    milter_class.admission.release()
+    assert send_message(milter, recipients) == Milter.ACCEPT
+    assert len(dspam_server.messages) == 2
+    stats = milter_class.admission.stats()
+    assert stats['in_flight'] == 0
+    assert stats['timeouts'] == 1
+
+
+def test_cache_hit_skips_dspam(milter_class, dspam_server):
+    milter_class.cache = VerdictCache(max_size=65536)
+    records = logged_records()
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    assert send_message(milter, ['a@example.org']) == Milter.ACCEPT
+    # DSPAM would now answer differently, but is not asked
+    dspam_server.spam_users.add('a@example.org')
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.2', 25))
+    assert send_message(milter, ['a@example.org']) == Milter.ACCEPT
+    assert len(dspam_server.messages) == 1
+    assert ('X-DSPAM-Result', 'Innocent') in milter.added
+    assert [record['cached'] for record in records] == [False, True]
+    assert records[1]['results']['a@example.org']['class'] == 'Innocent'
+
+
+def test_cache_keyed_by_recipients(milter_class, dspam_server):
+    milter_class.cache = VerdictCache(max_size=65536)
+    records = logged_records()
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    assert send_message(
+        milter, ['a@example.org', 'b@example.org']) == Milter.ACCEPT
+    # Each recipient of the first message has its own entry
+    assert send_message(milter, ['b@example.org']) == Milter.ACCEPT
+    assert len(dspam_server.messages) == 1
+    # A new recipient is a miss for the whole message
+    assert send_message(
+        milter, ['b@example.org', 'c@example.org']) == Milter.ACCEPT
+    assert len(dspam_server.messages) == 2
+    # So is another message for a known recipient
+    assert send_message(milter, ['a@example.org'],
+                        body=b'other\r\n') == Milter.ACCEPT
+    assert len(dspam_server.messages) == 3
+    assert [record['cached'] for record in records] == [
+        False, True, False, False]
+    assert list(records[1]['results']) == ['b@example.org']
+
+
+def test_fanout(milter_class, dspam_server, workers):
+    milter_class.fanout = 2
+    milter_class.workers = workers
+    records = logged_records()
+    dspam_server.delay = 0.1
+    recipients = ['a@example.org', 'b@example.org', 'c@example.org',
+                  'd@example.org']
+    dspam_server.spam_users.update(recipients[2:])
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    start = time.time()
+    assert send_message(milter, recipients) == Milter.ACCEPT
+    # Two transactions of two recipients each, side by side
+    assert time.time() - start < 0.35
+    assert len(dspam_server.messages) == 2
+    assert ('X-DSPAM-Result', 'Innocent') in milter.added
+    results = records[0]['results']
+    assert sorted(results) == recipients
+    assert [results[rcpt]['class'] for rcpt in recipients] == [
+        'Innocent', 'Innocent', 'Spam', 'Spam']
+
+    # The merged verdict only rejects when all parts agree
+    dspam_server.spam_users.update(recipients[:2])
+    assert send_message(milter, recipients) == Milter.REJECT
+    assert milter.replies == [('550', '5.7.1', 'Message is Spam')]
+
+
+def test_recipient_map(milter_class, dspam_server):
+    rcptmap = RecipientMap()
+    rcptmap.add('@example.org', 'shared')
+    rcptmap.add('boss@example.org', 'boss')
+    milter_class.rcptmap = rcptmap
+    records = logged_records()
+    dspam_server.spam_users.add('shared')
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    # Recipients that map to one DSPAM user are classified once, with the
+    #   extension removed before the lookup
+    assert send_message(milter, [
+        'a@example.org', 'b+lists@example.org', 'A@EXAMPLE.ORG',
+        'boss+x@example.org', 'c@example.net']) == Milter.ACCEPT
+    assert records[0]['recipients'] == ['shared', 'boss', 'c@example.net']
+    assert sorted(records[0]['results']) == [
+        'boss', 'c@example.net', 'shared']
+    assert records[0]['results']['shared']['class'] == 'Spam'
+    assert len(dspam_server.messages) == 1
+
+    assert send_message(
+        milter, ['a@example.org', 'b@example.org']) == Milter.REJECT
+    assert records[1]['recipients'] == ['shared']
+
+
+def test_consistent_hash(milter_class, dspam_servers, make_backend_pool,
+                         workers):
+    milter_class.pool = make_backend_pool(
+        [server.socket for server in dspam_servers],
+        strategy='consistent-hash')
+    milter_class.workers = workers
+    records = logged_records()
+    recipients = ['user{}@example.org'.format(i) for i in range(40)]
+    groups = milter_class.pool.partition(recipients)
+    assert len(groups) == 2
+    # Tell the servers apart by their answers
+    dspam_servers[0].spam_users.update(recipients)
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    assert send_message(milter, recipients) == Milter.ACCEPT
+    assert [len(server.messages) for server in dspam_servers] == [1, 1]
+    results = records[0]['results']
+    assert sorted(results) == sorted(recipients)
+    spam = sorted(rcpt for rcpt in results
+                  if results[rcpt]['class'] == 'Spam')
+    assert spam in [sorted(group) for group in groups]
+    assert ('X-DSPAM-Result', 'Innocent') in milter.added
+
+    dspam_servers[1].spam_users.update(recipients)
+    assert send_message(milter, recipients) == Milter.REJECT
+
+
+def test_skip_size(milter_class, dspam_server):
+    milter_class.skip_size = 1
+    records = logged_records()
+    skipped = milter_class.size_stats['skipped']
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    assert send_message(milter, ['a@example.org'],
+                        b'x' * 1025) == Milter.ACCEPT
+    assert dspam_server.messages == []
+    assert milter.added == [('X-DSPAM-Skipped', 'Message size exceeds 1 KB')]
+    assert records[0]['skipped']
+    assert milter_class.size_stats['skipped'] == skipped + 1
+
+    # A message of the limit is classified
+    assert send_message(milter, ['a@example.org'],
+                        b'x' * 1024) == Milter.ACCEPT
+    assert len(dspam_server.messages) == 1
+
+
+def test_max_body_size(milter_class, dspam_server):
+    milter_class.max_body_size = 1
+    records = logged_records()
+    truncated = milter_class.size_stats['truncated']
+    part = b'--b\r\nContent-Type: text/plain\r\n\r\n'
+    line = b'x' * 98 + b'\r\n'
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    headers = [('Content-Type', 'multipart/mixed; boundary="b"')]
+    assert send_message(milter, ['a@example.org'],
+                        part + line * 20 + b'--b--\r\n',
+                        headers) == Milter.ACCEPT
+    # The body is cut at the last line that fits in 1 KB, and the open
+    #   multipart entity is closed
+    assert dspam_server.messages == [
+        b'Content-Type: multipart/mixed; boundary="b"\r\n\r\n' + part +
+        line * 9 + b'\r\n--b--']
+    assert ('X-DSPAM-Result', 'Innocent') in milter.added
+    assert records[0]['truncated']
+    assert records[0]['body_size'] == len(part) + 20 * len(line) + 7
+    assert milter_class.size_stats['truncated'] == truncated + 1
+
+
+def test_streaming(milter_class, dspam_server):
+    milter_class.streaming = True
+    milter_class.admission = AdmissionControl(max_concurrent=2)
+    records = logged_records()
+    milter = milter_class()
+    milter.connect('mx.example.org', 4, ('192.0.2.1', 25))
+    milter.envrcpt('<a@example.org>')
+    milter.header('Subject', 'test')
+    milter.eoh()
+    # The transaction is open, and holds a turn until end-of-message
+    assert milter.dspam is not None
+    assert milter_class.admission.stats()['in_flight'] == 1
+    chunks = [b'first\r\n', b'second\r\n']
+    for chunk in chunks:
+        flexmock(milter.dspam).should_call('data_write').with_args(
+            chunk).once()
+    flexmock(milter.message).should_receive('write').never()
+    for chunk in chunks:
+        milter.body(chunk)
+    assert milter.eom() == Milter.ACCEPT
+    assert dspam_server.messages == [
+        b'Subject: test\r\n\r\nfirst\r\nsecond']
+    assert ('X-DSPAM-Result', 'Innocent') in milter.added
+    assert records[0]['streaming']
+    assert milter.dspam is None
+    assert milter_class.admission.stats()['in_flight'] == 0
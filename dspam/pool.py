@@ -0,0 +1,267 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import collections
+import logging
+import socket
+import threading
+
+from dspam import utils
+from dspam.client import DspamClient, DspamClientError
+
+logger = logging.getLogger(__name__)
+
+
+# No client became available in the pool within the checkout timeout
+class PoolTimeoutError(DspamClientError):
+    pass
+
+
+class DspamClientPool(object):
+    """
+    A thread-safe pool of connected DSPAM clients.
+
+    Clients in the pool are connected to the DSPAM server and have already
+    processed the LHLO greeting, so they can be used for a new transaction
+    right away. Threads that need a client check one out with get(), and
+    return it with put() when they are done.
+
+    The pool never holds more than max_size clients, idle or in use. When all
+    clients are in use, get() waits until one is returned. Idle clients are
+    health-checked before they are handed out, and reconnected when the
+    server closed the connection.
+
+    """
+
+    # Default configuration
+    min_size = 1
+    max_size = 10
+    checkout_timeout = 30.0
+
+    def __init__(self, min_size=None, max_size=None, checkout_timeout=None,
+                 factory=DspamClient):
+        """
+        Create a new pool.
+
+        Args:
+        min_size         -- The number of clients to keep connected.
+        max_size         -- The maximum number of clients.
+        checkout_timeout -- Seconds to wait for a client to become available.
+        factory          -- Callable that creates a new (unconnected) client.
+
+        """
+        if min_size is not None:
+            self.min_size = min_size
+        if max_size is not None:
+            self.max_size = max_size
+        if checkout_timeout is not None:
+            self.checkout_timeout = checkout_timeout
+        if self.min_size > self.max_size:
+            raise DspamClientError(
+                'Pool min_size {} is larger than max_size {}'.format(
+                    self.min_size, self.max_size))
+        self.factory = factory
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = collections.deque()
+        # Number of clients that exist, idle or checked out
+        self._size = 0
+        self._waiters = 0
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'discards': 0,
+            'timeouts': 0,
+            'checkout_time_total': 0.0,
+            'checkout_time_max': 0.0,
+        }
+
+    def _connect(self, deadline=None):
+        """
+        Create a new client, connect it and process the LHLO greeting.
+
+        Args:
+        deadline -- When to give up, as a utils.monotonic() timestamp.
+
+        """
+        client = self.factory()
+        try:
+            client.connect(deadline)
+            client.lhlo(deadline)
+        except (DspamClientError, socket.error):
+            client.close()
+            raise
+        with self._lock:
+            self._stats['connects'] += 1
+        if not client.dlmtp:
+            logger.warning(
+                'Connection to DSPAM is established, but DLMTP '
+                'seems unavailable')
+        return client
+
+    def _disconnect(self, client):
+        """
+        Disconnect a client that left the pool.
+
+        """
+        if client._socket is None:
+            return
+        try:
+            if client.is_alive():
+                client.quit()
+            else:
+                client.close()
+        except (DspamClientError, socket.error) as err:
+            logger.debug('Error while disconnecting from DSPAM: {}'.format(err))
+            client.close()
+
+    def fill(self):
+        """
+        Pre-warm the pool by connecting clients up to min_size.
+
+        """
+        while True:
+            with self._lock:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                client = self._connect()
+            except (DspamClientError, socket.error):
+                with self._lock:
+                    self._size -= 1
+                    self._available.notify()
+                raise
+            self.put(client)
+
+    def get(self, timeout=None, key=None, deadline=None):
+        """
+        Check out a connected client from the pool.
+
+        Raises a PoolTimeoutError when no client becomes available within the
+        timeout, and a DspamClientError when connecting a new client failed.
+
+        Args:
+        timeout  -- Seconds to wait for a client, defaults to checkout_timeout.
+        key      -- The DSPAM user the client is for, this is only used by a
+                    BackendPool.
+        deadline -- When the client must be checked out, as a
+                    utils.monotonic() timestamp. This also limits connecting
+                    a new client, and reconnecting a stale one.
+
+        """
+        if timeout is None:
+            timeout = self.checkout_timeout
+        start = utils.monotonic()
+        wait_until = start + timeout
+        if deadline is not None:
+            wait_until = min(wait_until, deadline)
+        client = None
+        with self._lock:
+            while not self._idle and self._size >= self.max_size:
+                remaining = wait_until - utils.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        'Timeout waiting for a DSPAM connection from the pool')
+                self._waiters += 1
+                try:
+                    self._available.wait(remaining)
+                finally:
+                    self._waiters -= 1
+            if self._idle:
+                # Most recently used client first, to keep it warm
+                client = self._idle.pop()
+            else:
+                self._size += 1
+
+        if client is None:
+            try:
+                client = self._connect(deadline)
+            except (DspamClientError, socket.error):
+                with self._lock:
+                    self._size -= 1
+                    self._available.notify()
+                raise
+        elif not client.is_alive():
+            logger.debug('Reconnecting stale DSPAM connection from pool')
+            try:
+                client.reconnect(deadline)
+            except (DspamClientError, socket.error):
+                self.put(client, discard=True)
+                raise
+            with self._lock:
+                self._stats['reconnects'] += 1
+
+        elapsed = utils.monotonic() - start
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['checkout_time_total'] += elapsed
+            if elapsed > self._stats['checkout_time_max']:
+                self._stats['checkout_time_max'] = elapsed
+        return client
+
+    def put(self, client, discard=False, failed=False):
+        """
+        Return a client to the pool.
+
+        Clients that are no longer connected are discarded. Pass discard=True
+        when the client is in an unknown protocol state, for instance after
+        an error.
+
+        Args:
+        client  -- The client to return.
+        discard -- Disconnect the client instead of keeping it.
+        failed  -- The client is returned after an error of the server, this
+                   implies discard.
+
+        """
+        if discard or failed or client._socket is None or self._closed:
+            self._disconnect(client)
+            with self._lock:
+                self._size -= 1
+                self._stats['discards'] += 1
+                self._available.notify()
+            return
+        with self._lock:
+            self._idle.append(client)
+            self._available.notify()
+
+    def close(self):
+        """
+        Disconnect all idle clients.
+
+        Clients that are in use are disconnected when they are returned, so
+        a pool that is replaced can be closed while it is still in use.
+
+        """
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for client in idle:
+            self._disconnect(client)
+
+    def stats(self):
+        """
+        Return a dictionary with pool statistics.
+
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['waiters'] = self._waiters
+        if stats['checkouts']:
+            stats['checkout_time_avg'] = (
+                stats['checkout_time_total'] / stats['checkouts'])
+        else:
+            stats['checkout_time_avg'] = 0.0
+        return stats
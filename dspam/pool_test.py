@@ -0,0 +1,156 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from . import utils
+from .client import DeadlineExceededError, DspamClientError
+from .pool import DspamClientPool, PoolTimeoutError
+
+
+def test_init_invalid_sizes():
+    with pytest.raises(DspamClientError):
+        DspamClientPool(min_size=5, max_size=2)
+
+
+def test_fill(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, min_size=2, max_size=4)
+    pool.fill()
+    stats = pool.stats()
+    assert stats['size'] == 2
+    assert stats['idle'] == 2
+    assert dspam_server.connections == 2
+    client = pool.get()
+    assert client.dlmtp is True
+    pool.put(client)
+    pool.close()
+    assert pool.stats()['size'] == 0
+
+
+def test_get_reuses_connection(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, min_size=0, max_size=2)
+    for i in range(3):
+        client = pool.get()
+        results = client.process('Subject: test\r\n\r\ntest', 'bar')
+        assert results['class'] == 'Innocent'
+        pool.put(client)
+    assert dspam_server.connections == 1
+    stats = pool.stats()
+    assert stats['checkouts'] == 3
+    assert stats['connects'] == 1
+    assert stats['in_use'] == 0
+    pool.close()
+
+
+def test_put_after_close(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, min_size=0, max_size=2)
+    client = pool.get()
+    pool.close()
+    pool.put(client)
+    assert client._socket is None
+    stats = pool.stats()
+    assert stats['size'] == 0
+    assert stats['discards'] == 1
+
+
+def test_get_timeout(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, min_size=0, max_size=1)
+    client = pool.get()
+    with pytest.raises(PoolTimeoutError):
+        pool.get(timeout=0.05)
+    assert pool.stats()['timeouts'] == 1
+    pool.put(client)
+    pool.close()
+
+
+def test_get_waits_for_put(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, min_size=0, max_size=1)
+    client = pool.get()
+
+    def give_back():
+        while pool.stats()['waiters'] == 0:
+            time.sleep(0.01)
+        pool.put(client)
+    threading.Thread(target=give_back).start()
+
+    assert pool.get(timeout=5) is client
+    assert pool.stats()['checkout_time_max'] > 0
+    pool.put(client)
+    pool.close()
+
+
+def test_stale_connection_is_reconnected(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, min_size=1, max_size=1)
+    pool.fill()
+    dspam_server.drop_connections()
+    time.sleep(0.05)
+    client = pool.get()
+    assert client.process('Subject: test\r\n\r\ntest', 'bar')['class'] == 'Innocent'
+    assert dspam_server.connections == 2
+    assert client.reconnects == 1
+    assert pool.stats()['reconnects'] == 1
+    assert pool.stats()['discards'] == 0
+    pool.put(client)
+    pool.close()
+
+
+def test_discard(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, min_size=0, max_size=1)
+    client = pool.get()
+    pool.put(client, discard=True)
+    assert client._socket is None
+    assert pool.stats()['size'] == 0
+    pool.close()
+
+
+def test_put_failed(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, min_size=0, max_size=1)
+    client = pool.get()
+    pool.put(client, failed=True)
+    assert client._socket is None
+    assert pool.stats()['discards'] == 1
+    pool.close()
+
+
+def test_connect_failure_releases_slot(tmpdir, make_pool):
+    pool = make_pool('unix:' + str(tmpdir.join('nonexistent')), max_size=1)
+    for i in range(2):
+        with pytest.raises(DspamClientError):
+            pool.get(timeout=0.05)
+    assert pool.stats()['size'] == 0
+
+
+def test_concurrent_checkouts(dspam_server, make_pool):
+    pool = make_pool(dspam_server.socket, min_size=0, max_size=3)
+    errors = []
+
+    def worker():
+        try:
+            for i in range(5):
+                client = pool.get()
+                client.process('Subject: test\r\n\r\ntest', 'bar')
+                pool.put(client)
+        except Exception as err:
+            errors.append(err)
+    threads = [threading.Thread(target=worker) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert dspam_server.connections <= 3
+    assert pool.stats()['checkouts'] == 40
+    pool.close()
+
+
+def test_get_deadline(silent_server, make_pool):
+    pool = make_pool(silent_server, max_size=1)
+    start = time.time()
+    # Connecting to a server that never greets is cut short
+    with pytest.raises(socket.timeout):
+        pool.get(deadline=utils.monotonic() + 0.1)
+    assert time.time() - start < 1
+    with pytest.raises(DeadlineExceededError):
+        pool.get(deadline=utils.monotonic() - 1)
+    assert pool.stats()['size'] == 0
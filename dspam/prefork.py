@@ -0,0 +1,260 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+"""
+Run the milter in several worker processes.
+
+The supervisor forks the workers after the listening socket was opened, so
+all workers inherit the socket and accept connections from it. The kernel
+hands each connection to one of the workers, which spreads the work over
+the CPUs without the global interpreter lock of a single process getting in
+the way.
+
+"""
+
+import errno
+import logging
+import os
+import signal
+import threading
+import time
+
+from dspam import utils
+
+logger = logging.getLogger(__name__)
+
+
+def worker_address(address, index):
+    """
+    Return the address a worker process serves on.
+
+    Each worker gets its own address, derived from the configured one:
+    unix:PATH becomes unix:PATH.INDEX, and inet:PORT@HOST becomes
+    inet:PORT+INDEX@HOST.
+    Raises a ValueError for invalid addresses.
+
+    Args:
+    address -- The configured address.
+    index   -- The number of the worker, starting at 0.
+
+    """
+    proto, sep, spec = address.partition(':')
+    if proto == 'unix' and spec:
+        return '{}:{}.{}'.format(proto, spec, index)
+    if proto in ('inet', 'inet6') and spec:
+        port, sep, host = spec.partition('@')
+        try:
+            port = int(port)
+        except ValueError:
+            raise ValueError('Invalid address: ' + address)
+        return '{}:{}{}{}'.format(proto, port + index, sep, host)
+    raise ValueError('Invalid address: ' + address)
+
+
+class Supervisor(object):
+    """
+    Fork worker processes, and keep them running.
+
+    Workers that exit while the supervisor is running are restarted. When
+    the supervisor receives SIGTERM, SIGINT or SIGHUP, the signal is
+    forwarded to all workers, which stop accepting connections and finish
+    the ones in progress, and the supervisor returns when all workers
+    exited.
+
+    When a reload function is given, SIGHUP calls it instead. The supervisor
+    can pass messages to the workers with broadcast(), which workers receive
+    in a thread started by listen().
+
+    """
+
+    # Default configuration
+    restart_delay = 1
+
+    # Signals that are forwarded to the workers, and stop the supervisor
+    SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+
+    def __init__(self, size, target, restart_delay=None, reload=None):
+        """
+        Create a new supervisor.
+
+        Args:
+        size          -- The number of worker processes.
+        target        -- The function to run in a worker, it gets the number
+                         of the worker as its argument.
+        restart_delay -- Seconds to wait before restarting a worker that
+                         exited within that time after it was started.
+        reload        -- The function to call on SIGHUP.
+
+        """
+        if size < 1:
+            raise ValueError('A supervisor needs at least one worker')
+        self.size = size
+        self.target = target
+        if restart_delay is not None:
+            self.restart_delay = restart_delay
+        self.reload = reload
+
+        # Maps pid to (worker number, start time, channel to the worker)
+        self.children = {}
+        # In a worker, the channel from the supervisor
+        self.channel = None
+        # The signal that stopped the supervisor
+        self.stopping = None
+        self.restarts = 0
+
+    def _block_signals(self, block):
+        # Python 2 has no pthread_sigmask(), the check for self.stopping in
+        #   _spawn() covers most of the window there.
+        if hasattr(signal, 'pthread_sigmask'):
+            signal.pthread_sigmask(
+                signal.SIG_BLOCK if block else signal.SIG_UNBLOCK,
+                self.SIGNALS)
+
+    def _spawn(self, index):
+        # Hold back signals until the new worker is known to the supervisor,
+        #   and has left the signal handlers of the supervisor behind.
+        self._block_signals(True)
+        channel, channel_in = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(channel)
+            self.children[pid] = (index, utils.monotonic(), channel_in)
+            self._block_signals(False)
+            logger.debug('Started worker {} with pid {}'.format(index, pid))
+            if self.stopping:
+                os.kill(pid, self.stopping)
+            return pid
+
+        code = 1
+        try:
+            os.close(channel_in)
+            for other in self.children.values():
+                os.close(other[2])
+            self.children = {}
+            self.channel = channel
+            for signum in self.SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            self._block_signals(False)
+            self.target(index)
+            code = 0
+        except SystemExit as err:
+            code = err.code if isinstance(err.code, int) else 1
+        except Exception:
+            logger.exception('Worker {} failed'.format(index))
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _hangup(self, signum, stack_frame):
+        if self.stopping:
+            return
+        logger.info('Reloading on signal {}'.format(signum))
+        try:
+            self.reload()
+        except Exception:
+            logger.exception('Reloading failed')
+
+    def broadcast(self, message):
+        """
+        Send a message to all workers.
+
+        Args:
+        message -- The message, as bytes without newlines.
+
+        """
+        data = message + b'\n'
+        for pid, (index, started, channel) in list(self.children.items()):
+            try:
+                written = 0
+                while written < len(data):
+                    written += os.write(channel, data[written:])
+            except OSError as err:
+                # The worker exited, it gets restarted later
+                logger.warning('Failed to send message to worker {}: '
+                               '{}'.format(index, err))
+
+    def listen(self, callback):
+        """
+        Receive the messages of the supervisor, in a worker.
+
+        Messages are passed to the callback in a background thread, one at a
+        time.
+
+        Args:
+        callback -- The function to call with each message, as bytes.
+
+        """
+        def receive():
+            channel = os.fdopen(self.channel, 'rb')
+            for line in iter(channel.readline, b''):
+                try:
+                    callback(line.rstrip(b'\n'))
+                except Exception:
+                    logger.exception('Failed to handle message from '
+                                     'supervisor')
+
+        thread = threading.Thread(target=receive, name='dspam-supervisor')
+        thread.daemon = True
+        thread.start()
+
+    def _forward(self, signum, stack_frame):
+        if not self.stopping:
+            logger.info('Stopping {} workers on signal {}'.format(
+                len(self.children), signum))
+        self.stopping = signum
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    raise
+
+    def _wait(self):
+        while True:
+            try:
+                return os.wait()
+            except OSError as err:
+                # Python 2 does not retry after a signal handler ran
+                if err.errno != errno.EINTR:
+                    raise
+
+    def run(self):
+        """
+        Start the workers, and supervise them until they are stopped.
+
+        """
+        handlers = dict((signum, signal.signal(signum, self._forward))
+                        for signum in self.SIGNALS)
+        if self.reload is not None:
+            signal.signal(signal.SIGHUP, self._hangup)
+        try:
+            for index in range(self.size):
+                self._spawn(index)
+            while self.children:
+                pid, status = self._wait()
+                if pid not in self.children:
+                    continue
+                index, started, channel = self.children.pop(pid)
+                os.close(channel)
+                if self.stopping:
+                    continue
+                if os.WIFSIGNALED(status):
+                    reason = 'was killed by signal {}'.format(
+                        os.WTERMSIG(status))
+                else:
+                    reason = 'exited with status {}'.format(
+                        os.WEXITSTATUS(status))
+                logger.error('Worker {} (pid {}) {}, restarting'.format(
+                    index, pid, reason))
+                # Do not keep forking a worker that fails right away
+                delay = started + self.restart_delay - utils.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                if not self.stopping:
+                    self.restarts += 1
+                    self._spawn(index)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
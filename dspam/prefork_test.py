@@ -0,0 +1,118 @@
+import os
+import signal
+import sys
+import time
+
+import pytest
+
+from . import utils
+from .prefork import Supervisor, worker_address
+
+
+def test_worker_address():
+    assert worker_address('unix:/run/metrics', 2) == 'unix:/run/metrics.2'
+    assert worker_address('inet:9125@localhost', 0) == 'inet:9125@localhost'
+    assert worker_address('inet:9125@localhost', 3) == 'inet:9128@localhost'
+    assert worker_address('inet6:9125', 1) == 'inet6:9126'
+    with pytest.raises(ValueError):
+        worker_address('inet:http', 1)
+    with pytest.raises(ValueError):
+        worker_address('/run/metrics', 1)
+
+
+def test_supervisor_restarts_and_stops(tmpdir):
+    crashed = tmpdir.join('crashed')
+    r, w = os.pipe()
+
+    def target(index):
+        os.write(w, str(index).encode('ascii'))
+        if index == 0 and not crashed.check():
+            crashed.write('')
+            sys.exit(3)
+        time.sleep(30)
+
+    # Stop from another process, a signal sent from a thread might not
+    #   interrupt the wait of the supervisor.
+    parent = os.getpid()
+    if os.fork() == 0:
+        started = b''
+        while len(started) < 3:
+            started += os.read(r, 3)
+        os.kill(parent, signal.SIGTERM)
+        os._exit(0)
+    supervisor = Supervisor(2, target, restart_delay=0)
+    supervisor.run()
+    os.close(r)
+    os.close(w)
+    assert supervisor.restarts == 1
+    assert supervisor.children == {}
+    assert signal.getsignal(signal.SIGTERM) is not supervisor._forward
+
+
+def test_supervisor_size():
+    with pytest.raises(ValueError):
+        Supervisor(0, lambda index: None)
+
+
+def test_available_cpus_cgroup_v2(tmpdir):
+    tmpdir.join('cpu.max').write('150000 100000\n')
+    assert utils.available_cpus(str(tmpdir)) == min(2, _cpus())
+    tmpdir.join('cpu.max').write('max 100000\n')
+    assert utils.available_cpus(str(tmpdir)) == _cpus()
+
+
+def test_available_cpus_cgroup_v1(tmpdir):
+    tmpdir.mkdir('cpu')
+    tmpdir.join('cpu', 'cpu.cfs_quota_us').write('50000\n')
+    tmpdir.join('cpu', 'cpu.cfs_period_us').write('100000\n')
+    assert utils.available_cpus(str(tmpdir)) == 1
+    tmpdir.join('cpu', 'cpu.cfs_quota_us').write('-1\n')
+    assert utils.available_cpus(str(tmpdir)) == _cpus()
+
+
+def test_available_cpus_without_cgroup(tmpdir):
+    assert utils.available_cpus(str(tmpdir.join('missing'))) == _cpus()
+
+
+def _cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+def test_broadcast():
+    r, w = os.pipe()
+
+    def target(index):
+        supervisor.listen(lambda message: os.write(w, message + b'\n'))
+        os.write(w, b'started\n')
+        time.sleep(30)
+
+    # Signals are sent one at a time, pending signals are not queued
+    parent = os.getpid()
+    if os.fork() == 0:
+        try:
+            reader = os.fdopen(r, 'rb')
+            for expected in (b'started\n', b'reload 1\n'):
+                if reader.readline() != expected:
+                    break
+                os.kill(parent, signal.SIGHUP)
+            reader.readline()
+        finally:
+            os.kill(parent, signal.SIGTERM)
+            os._exit(0)
+
+    reloads = []
+
+    def reload():
+        reloads.append(len(reloads) + 1)
+        supervisor.broadcast('reload {}'.format(reloads[-1]).encode('ascii'))
+
+    supervisor = Supervisor(1, target, reload=reload)
+    supervisor.run()
+    os.close(r)
+    os.close(w)
+    assert reloads == [1, 2]
+    assert supervisor.restarts == 0
@@ -0,0 +1,161 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def strip_extension(address, delimiters):
+    """
+    Remove the address extension from the local part of an address.
+
+    For example, with delimiters '+', user+ext@example.org becomes
+    user@example.org.
+
+    Args:
+    address    -- The address to strip.
+    delimiters -- The characters that separate the user from the extension.
+
+    """
+    local, at, domain = address.rpartition('@')
+    if not at:
+        local = domain
+        domain = ''
+    for delimiter in delimiters:
+        index = local.find(delimiter)
+        if index != -1:
+            local = local[:index]
+    return local + at + domain
+
+
+class RecipientMap(object):
+    """
+    Map envelope recipients to DSPAM users.
+
+    Rules map a recipient pattern to a DSPAM user. Three kinds of patterns
+    are supported, and are matched in this order:
+    * user@example.org   -- The exact address.
+    * @example.org       -- All addresses in the domain.
+    * @*.example.org     -- All addresses in subdomains of example.org. When
+                            several of these match, the longest domain wins.
+
+    A single * maps all recipients that did not match another rule. Exact
+    addresses and domains are stored in dictionaries, and subdomain rules
+    are looked up by walking up the parent domains of the recipient, so a
+    lookup does not depend on the number of rules. Patterns are matched
+    case-insensitive.
+
+    """
+
+    def __init__(self):
+        self._addresses = {}
+        self._domains = {}
+        self._subdomains = {}
+        self._default = None
+
+    def __len__(self):
+        return (len(self._addresses) + len(self._domains) +
+                len(self._subdomains) + (self._default is not None))
+
+    def add(self, pattern, user):
+        """
+        Add a rule to the map.
+
+        Raises a ValueError when the pattern is invalid.
+
+        Args:
+        pattern -- The recipient pattern.
+        user    -- The DSPAM user for recipients matching the pattern.
+
+        """
+        pattern = pattern.lower()
+        if pattern == '*':
+            self._default = user
+        elif (pattern.startswith('@*.') and '@' not in pattern[3:] and
+                '*' not in pattern[3:]):
+            self._subdomains[pattern[3:]] = user
+        elif (pattern.startswith('@') and '@' not in pattern[1:] and
+                '*' not in pattern):
+            self._domains[pattern[1:]] = user
+        elif pattern.count('@') == 1 and '*' not in pattern:
+            self._addresses[pattern] = user
+        else:
+            raise ValueError('Invalid recipient pattern: ' + pattern)
+
+    def match(self, address):
+        """
+        Return the DSPAM user of the rule matching an address.
+
+        Returns None when no rule matches.
+
+        Args:
+        address -- The recipient address.
+
+        """
+        key = address.lower()
+        user = self._addresses.get(key)
+        if user is not None:
+            return user
+        domain = key.rpartition('@')[2]
+        user = self._domains.get(domain)
+        if user is not None:
+            return user
+        if self._subdomains:
+            parts = domain.split('.')
+            for i in range(1, len(parts)):
+                user = self._subdomains.get('.'.join(parts[i:]))
+                if user is not None:
+                    return user
+        return self._default
+
+    def lookup(self, address):
+        """
+        Return the DSPAM user for a recipient address.
+
+        Recipients that match no rule are their own DSPAM user.
+
+        Args:
+        address -- The recipient address.
+
+        """
+        user = self.match(address)
+        if user is None:
+            return address
+        return user
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a recipient map from a file.
+
+        Each line contains a recipient pattern and a DSPAM user, separated
+        by whitespace. Everything after a # is a comment.
+        Raises an IOError when the file can not be read, and a ValueError
+        when it contains invalid lines.
+
+        Args:
+        path -- The path of the file.
+
+        """
+        rcptmap = cls()
+        with open(path) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                fields = line.split()
+                if len(fields) != 2:
+                    raise ValueError(
+                        '{}, line {}: expected a recipient pattern and a '
+                        'DSPAM user'.format(path, lineno))
+                try:
+                    rcptmap.add(*fields)
+                except ValueError as err:
+                    raise ValueError('{}, line {}: {}'.format(
+                        path, lineno, err))
+        logger.debug('Loaded {} recipient map rules from {}'.format(
+            len(rcptmap), path))
+        return rcptmap
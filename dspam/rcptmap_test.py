@@ -0,0 +1,69 @@
+import pytest
+
+from .rcptmap import RecipientMap, strip_extension
+
+
+@pytest.mark.parametrize('address,delimiters,expected', [
+    ('user+ext@example.org', '+', 'user@example.org'),
+    ('user+ext+more@example.org', '+', 'user@example.org'),
+    ('user-ext+more@example.org', '+-', 'user@example.org'),
+    ('user@example.org', '+', 'user@example.org'),
+    ('user+ext', '+', 'user'),
+    ('"a@b"+ext@example.org', '+', '"a@b"@example.org'),
+])
+def test_strip_extension(address, delimiters, expected):
+    assert strip_extension(address, delimiters) == expected
+
+
+def test_lookup():
+    rcptmap = RecipientMap()
+    rcptmap.add('boss@example.org', 'boss')
+    rcptmap.add('@example.org', 'staff')
+    rcptmap.add('@*.example.org', 'subsidiaries')
+    rcptmap.add('@*.eu.example.org', 'europe')
+    assert len(rcptmap) == 4
+    assert rcptmap.lookup('Boss@Example.org') == 'boss'
+    assert rcptmap.lookup('john@example.org') == 'staff'
+    assert rcptmap.lookup('john@us.example.org') == 'subsidiaries'
+    assert rcptmap.lookup('john@nl.eu.example.org') == 'europe'
+    assert rcptmap.lookup('john@eu.example.org') == 'subsidiaries'
+    assert rcptmap.lookup('John@example.net') == 'John@example.net'
+    rcptmap.add('*', 'everyone')
+    assert rcptmap.lookup('John@example.net') == 'everyone'
+
+
+@pytest.mark.parametrize('pattern', [
+    'foo', '@foo@bar', '*@example.org', 'a@b@c', '@*example.org'])
+def test_add_invalid(pattern):
+    with pytest.raises(ValueError):
+        RecipientMap().add(pattern, 'foo')
+
+
+def test_from_file(tmpdir):
+    path = tmpdir.join('rcptmap')
+    path.write(
+        '# Sales shares a single DSPAM user\n'
+        '\n'
+        'sales@example.org   sales    # Sales team\n'
+        '@*.example.org      example\n')
+    rcptmap = RecipientMap.from_file(str(path))
+    assert rcptmap.lookup('sales@example.org') == 'sales'
+    assert rcptmap.lookup('foo@mail.example.org') == 'example'
+
+
+@pytest.mark.parametrize('content', ['foo\n', 'foo@bar baz qux\n', 'a@b@c d\n'])
+def test_from_file_invalid(tmpdir, content):
+    path = tmpdir.join('rcptmap')
+    path.write(content)
+    with pytest.raises(ValueError) as excinfo:
+        RecipientMap.from_file(str(path))
+    assert 'line 1' in str(excinfo.value)
+
+
+def test_match():
+    rcptmap = RecipientMap()
+    rcptmap.add('@example.org', 'staff')
+    assert rcptmap.match('john@example.org') == 'staff'
+    assert rcptmap.match('john@example.net') is None
+    rcptmap.add('*', 'others')
+    assert rcptmap.match('john@example.net') == 'others'
@@ -0,0 +1,145 @@
+# Copyright (c) 2012, Tom Hendrikx
+# All rights reserved.
+#
+# See LICENSE for the license.
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+_multipart_re = re.compile(br'^\s*multipart/', re.IGNORECASE)
+_boundary_re = re.compile(
+    br'boundary\s*=\s*(?:"([^"]+)"|([^\s;]+))', re.IGNORECASE)
+
+
+def multipart_boundary(content_type):
+    """
+    Return the boundary of a multipart Content-Type header value, or None.
+
+    Args:
+    content_type -- The header value, as bytes.
+
+    """
+    if not _multipart_re.match(content_type):
+        return None
+    match = _boundary_re.search(content_type)
+    if match is None:
+        return None
+    return match.group(1) or match.group(2)
+
+
+class MimeTruncator(object):
+    """
+    Limit the size of a message body, without breaking its MIME structure.
+
+    The body is fed in blocks, and passed on unaltered until the limit is
+    reached. The body is then cut off at the last complete line, and closing
+    delimiters are added for all multipart entities that are still open, so
+    the truncated message is still valid MIME. Everything fed after that is
+    dropped.
+
+    To know which entities are open, the passed data is scanned for MIME
+    delimiter lines and for the Content-Type headers of body parts.
+
+    """
+
+    def __init__(self, limit, content_type=b''):
+        """
+        Create a new truncator.
+
+        Args:
+        limit        -- The maximum number of body bytes to pass on.
+        content_type -- The Content-Type header value of the message.
+
+        """
+        self.limit = limit
+        self.size = 0
+        self.truncated = False
+        # The boundaries of the open multipart entities, innermost last
+        self._boundaries = []
+        boundary = multipart_boundary(content_type)
+        if boundary is not None:
+            self._boundaries.append(boundary)
+        # Incomplete last line of the data passed so far
+        self._partial = b''
+        # Headers of the body part that is being scanned, or None when
+        #   scanning part contents
+        self._part_headers = None
+
+    def feed(self, data):
+        """
+        Feed a block of body data, and return the data to pass on.
+
+        Args:
+        data -- The next block of the message body, as bytes.
+
+        """
+        if self.truncated:
+            return b''
+        if self.size + len(data) <= self.limit:
+            self.size += len(data)
+            self._scan(data)
+            return data
+
+        # Cut the body at the end of the last line that fits
+        end = data.rfind(b'\n', 0, self.limit - self.size) + 1
+        if end == 0 and self._partial:
+            # The line that was already passed on must be finished
+            head = b'\r\n'
+        else:
+            head = data[:end]
+            self._scan(head)
+        self.size += len(head)
+        self.truncated = True
+        tail = []
+        while self._boundaries:
+            tail.append(b'--' + self._boundaries.pop() + b'--\r\n')
+        logger.debug(
+            'Message body truncated at {} bytes, closed {} MIME '
+            'multipart entities'.format(self.size, len(tail)))
+        if tail:
+            return head + b'\r\n' + b''.join(tail)
+        return head
+
+    def _scan(self, data):
+        """
+        Track the MIME structure in passed data.
+
+        """
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            line = line.rstrip(b'\r')
+            if self._part_headers is not None:
+                if line:
+                    self._part_headers.append(line)
+                    continue
+                self._end_part_headers()
+            elif line.startswith(b'--') and self._boundaries:
+                delimiter = line[2:].rstrip()
+                if delimiter == self._boundaries[-1]:
+                    self._part_headers = []
+                elif delimiter == self._boundaries[-1] + b'--':
+                    self._boundaries.pop()
+
+    def _end_part_headers(self):
+        """
+        Look for a nested multipart entity in the headers of a body part.
+
+        """
+        content_type = None
+        for header in self._part_headers:
+            if header[:1] in (b' ', b'\t'):
+                # Folded header line
+                if content_type is not None:
+                    content_type += header
+            elif header.lower().startswith(b'content-type:'):
+                content_type = header[13:]
+            elif content_type is not None:
+                break
+        self._part_headers = None
+        if content_type is not None:
+            boundary = multipart_boundary(content_type)
+            if boundary is not None:
+                self._boundaries.append(boundary)
@@ -0,0 +1,72 @@
+import email
+
+import pytest
+
+from .truncate import MimeTruncator, multipart_boundary
+
+
+@pytest.mark.parametrize('content_type,expected', [
+    (b'multipart/mixed; boundary="foo bar"', b'foo bar'),
+    (b' Multipart/Alternative;\r\n\tBOUNDARY=foo', b'foo'),
+    (b'text/plain; boundary=foo', None),
+    (b'multipart/mixed', None),
+    (b'', None),
+])
+def test_multipart_boundary(content_type, expected):
+    assert multipart_boundary(content_type) == expected
+
+
+def test_below_limit():
+    t = MimeTruncator(10)
+    assert t.feed(b'foo\r\n') == b'foo\r\n'
+    assert t.feed(b'bar\r\n') == b'bar\r\n'
+    assert t.truncated is False
+
+
+def test_plain_text():
+    t = MimeTruncator(12)
+    assert t.feed(b'foo\r\nbar') == b'foo\r\nbar'
+    # the partial line is finished, the rest is dropped
+    assert t.feed(b'bazbazbaz\r\n') == b'\r\n'
+    assert t.truncated is True
+    assert t.feed(b'qux\r\n') == b''
+
+
+def test_cut_at_line_end():
+    t = MimeTruncator(12)
+    assert t.feed(b'foo\r\nbar\r\nbaz\r\n') == b'foo\r\nbar\r\n'
+
+
+def test_multipart():
+    body = (
+        b'preamble\r\n'
+        b'--outer\r\n'
+        b'Content-Type: multipart/alternative;\r\n'
+        b'\tboundary="inner"\r\n'
+        b'\r\n'
+        b'--inner\r\n'
+        b'Content-Type: text/plain\r\n'
+        b'\r\n'
+        b'Hello\r\n'
+        b'--inner--\r\n'
+        b'--outer\r\n'
+        b'Content-Type: multipart/related; boundary=nested\r\n'
+        b'\r\n'
+        b'--nested\r\n'
+        b'Content-Type: application/octet-stream\r\n'
+        b'\r\n')
+    attachment = b'QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVo=\r\n' * 100
+    t = MimeTruncator(len(body) + 100, b'multipart/mixed; boundary="outer"')
+    result = t.feed(body[:50]) + t.feed(body[50:]) + t.feed(attachment)
+    assert t.truncated is True
+    assert result.startswith(body)
+    assert result.endswith(b'=\r\n\r\n--nested--\r\n--outer--\r\n')
+
+    msg = email.message_from_string(
+        (b'Content-Type: multipart/mixed; boundary="outer"\r\n\r\n' +
+         result).decode('ascii'))
+    assert msg.defects == []
+    parts = [part.get_content_type() for part in msg.walk()]
+    assert parts == [
+        'multipart/mixed', 'multipart/alternative', 'text/plain',
+        'multipart/related', 'application/octet-stream']
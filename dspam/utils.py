@@ -11,9 +11,16 @@ import os
 import resource
 import signal
 import sys
+import time
 
 logger = logging.getLogger(__name__)
 
+# A clock for measuring intervals, that is not affected by system time changes
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
 
 def daemonize(pidfile=None):
     """
@@ -84,6 +91,50 @@ def daemonize(pidfile=None):
     logger.debug('Process daemonized')
 
 
+def available_cpus(cgroup_root='/sys/fs/cgroup'):
+    """
+    Return the number of CPUs the process may use.
+
+    This is the number of CPUs in the affinity mask of the process, limited
+    by the CPU quota of its cgroup when one is set, so a container that is
+    given 2 CPUs on a larger host returns 2.
+
+    Args:
+    cgroup_root -- Where the cgroup filesystem is mounted.
+
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        cpus = multiprocessing.cpu_count()
+
+    # cgroup v2 has "QUOTA PERIOD" in cpu.max, v1 has one value per file
+    quota = period = None
+    try:
+        with open(os.path.join(cgroup_root, 'cpu.max')) as f:
+            quota, period = f.read().split()[:2]
+    except (EnvironmentError, ValueError):
+        try:
+            path = os.path.join(cgroup_root, 'cpu', 'cpu.cfs_quota_us')
+            with open(path) as f:
+                quota = f.read().strip()
+            path = os.path.join(cgroup_root, 'cpu', 'cpu.cfs_period_us')
+            with open(path) as f:
+                period = f.read().strip()
+        except EnvironmentError:
+            pass
+    try:
+        quota = int(quota)
+        period = int(period)
+    except (TypeError, ValueError):
+        # No limit: 'max' for v2, -1 for v1
+        return cpus
+    if quota > 0 and period > 0:
+        cpus = min(cpus, max(1, -(-quota // period)))
+    return cpus
+
+
 def config_str2dict(option_value):
     """
     Parse the value of a config option and convert it to a dictionary.
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Benchmark classification of a message with many recipients, in a single
+DSPAM transaction and with fan-out over parallel transactions.
+
+A stub DSPAM server is used, that takes a fixed time per recipient to
+process a message. Run from the repository root:
+
+    python misc/benchmark_fanout.py [--delay SECONDS] [--fanout N]
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dspam.client import DspamClient  # noqa: E402
+from dspam.conftest import StubDspamServer  # noqa: E402
+from dspam.fanout import WorkerPool, classify_recipients  # noqa: E402
+from dspam.pool import DspamClientPool  # noqa: E402
+
+MESSAGE = b'Subject: test\r\n\r\n' + b'Lorem ipsum dolor sit amet\r\n' * 1000
+CLIENT_ARGS = '--process --deliver=summary'
+
+
+def single(pool, recipients):
+    client = pool.get()
+    client.rset()
+    client.mailfrom(client_args=CLIENT_ARGS)
+    client.rcptto(recipients)
+    client.data(MESSAGE)
+    pool.put(client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--delay', type=float, default=0.002,
+                        help='Processing time per recipient, in seconds')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='Number of parallel transactions')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    server = StubDspamServer(os.path.join(tmpdir, 'dspam.sock'))
+    server.delay = args.delay
+    server.start()
+    pool = DspamClientPool(
+        min_size=args.fanout, max_size=args.fanout,
+        factory=lambda: DspamClient(server.socket, 'foo', 'secret'))
+    pool.fill()
+    workers = WorkerPool(args.fanout)
+
+    print('recipients  single (ms)  fanout={} (ms)  speedup'.format(
+        args.fanout))
+    for count in (1, 2, 5, 10, 25, 50, 100):
+        recipients = ['user{}@example.org'.format(i) for i in range(count)]
+        timings = []
+        for func in (lambda: single(pool, recipients),
+                     lambda: classify_recipients(
+                         pool, workers, MESSAGE, recipients, CLIENT_ARGS,
+                         args.fanout)):
+            best = None
+            for i in range(args.rounds):
+                start = time.time()
+                func()
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            timings.append(best * 1000)
+        print('{:>10}  {:>11.1f}  {:>14.1f}  {:>6.2f}x'.format(
+            count, timings[0], timings[1], timings[0] / timings[1]))
+
+    workers.close()
+    pool.close()
+    server.stop()
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,6 @@ setup(
             'dspam-milter = dspam.milter:main',
         ]
     },
-    install_requires = ['pymilter'],
+    install_requires = ['pymilter>=1.0.5'],
     zip_safe = True,
 )